@@ -1,7 +1,42 @@
 # pip install magenta
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+# Opt-in XLA compilation of train_step/val_step (GROOVE_JIT_COMPILE=1).
+# Compiled executables are kept in XLA_CACHE_DIR across runs. The flag must be
+# in the environment before TensorFlow initialises XLA, and releases before 2.9
+# (including the pinned 2.4.1) don't have it and abort on flags they don't know,
+# so it is only set when jit is requested on a TensorFlow that supports it.
+# Older versions compile again in every run.
+JIT_COMPILE = os.environ.get('GROOVE_JIT_COMPILE', '0') == '1'
+XLA_CACHE_DIR = os.environ.get('GROOVE_XLA_CACHE_DIR', './xla_cache')
+
+def installed_tf_version():
+  """(major, minor) of the installed TensorFlow, read without importing it."""
+  try:
+    from importlib import metadata
+    get_version = metadata.version
+  except ImportError:
+    # python 3.7
+    import pkg_resources
+    get_version = lambda name: pkg_resources.get_distribution(name).version
+  for name in ('tensorflow', 'tensorflow-cpu', 'tensorflow-gpu'):
+    try:
+      return tuple(int(part) for part in get_version(name).split('.')[:2])
+    except Exception:
+      continue
+  return (0, 0)
+
+XLA_PERSISTENT_CACHE = JIT_COMPILE and installed_tf_version() >= (2, 9)
+if XLA_PERSISTENT_CACHE:
+  os.makedirs(XLA_CACHE_DIR, exist_ok=True)
+  os.environ['TF_XLA_FLAGS'] = (os.environ.get('TF_XLA_FLAGS', '') +
+                                ' --tf_xla_persistent_cache_directory=' + XLA_CACHE_DIR).strip()
+
 import time
+import json
+import collections
+import contextlib
 import magenta
 import tensorflow as tf
 #print(tf.__version__)
@@ -21,6 +56,11 @@ import tensorflow as tf
 #!pip install tensorflow_datasets
 import tensorflow_datasets as tfds
 
+from PythonFiles.groove_tokens import CompactVocabulary
+from PythonFiles.groove_metrics import GrooveMetrics
+from PythonFiles.midi_tensors import midi_to_tensors_op
+from PythonFiles.packing import pack_dataset
+
 # Enable Eager Execution
 # tf.enable_eager_execution()
 
@@ -37,15 +77,20 @@ configs_hit_control = configs.CONFIG_MAP['groovae_2bar_hits_control_tfds']
 
 # Get dataset from TFDS and store it in a tf.Data Object
 
-def initialize_dataset_as_iterator(config, batch_size, is_training=False, cache_dataset=True):
+def initialize_dataset_as_iterator(config, batch_size, is_training=False, cache_dataset=True, vocab=None,
+                                   pack_length=None, deterministic=False):
+    # deterministic: the same examples in the same order on every pass, also for
+    # the training split. Files and examples are not shuffled and the converter
+    # keeps every window instead of sampling some (eval mode).
+    shuffle = is_training and not deterministic
     data_converter = config.data_converter
-    data_converter.set_mode('train' if is_training else 'eval')
+    data_converter.set_mode('train' if shuffle else 'eval')
 
         # tf.compat.v1.logging('Reading examples from TFDS: %s',config.tfds_name)
     dataset = tfds.load(
         config.tfds_name,
         split=tfds.Split.TRAIN if is_training else tfds.Split.VALIDATION,
-        shuffle_files=is_training,
+        shuffle_files=shuffle,
         try_gcs=False
     )
     
@@ -53,15 +98,11 @@ def initialize_dataset_as_iterator(config, batch_size, is_training=False, cache_
 
     # print(dataset)
 
-    midi_to_note = lambda x:[mm.midi_to_note_sequence(x.numpy()).SerializeToString()]
-
 #### FUNCTION 1
-    def _tf_midi_to_notesequence(ex):
-        return tf.py_function(
-            midi_to_note,
-            inp = [ex['midi']],
-            Tout= tf.string,
-            name='midi_to_note_sequence')
+    # MIDI bytes -> NoteSequence -> converter tensors in one py_function, without
+    # serializing the NoteSequence for convert_to_tensors_op to parse it back
+    def _tf_midi_to_tensors(ex):
+        return midi_to_tensors_op(ex['midi'], data_converter)
 
 
 ####FUNCTION 2
@@ -99,17 +140,13 @@ def initialize_dataset_as_iterator(config, batch_size, is_training=False, cache_
             # Don't remove padding for hierarchical examples.
             return padded_seq_1, padded_seq_2, padded_seq_3, length     
 
-#### MAP FUNCTION 1
-    dataset = (dataset.map(_tf_midi_to_notesequence,num_parallel_calls=tf.data.experimental.AUTOTUNE))
-
-    # print(dataset)
-
-#### MAP TO TENSORS
+#### MAP FUNCTION 1 (MIDI TO TENSORS)
     dataset = dataset.map(
-      tf.autograph.experimental.do_not_convert(
-          functools.partial(convert_to_tensors_op, converter=data_converter)),
+      tf.autograph.experimental.do_not_convert(_tf_midi_to_tensors),
       num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
+    # print(dataset)
+
 ####
     dataset = dataset.unbatch()
 
@@ -117,6 +154,16 @@ def initialize_dataset_as_iterator(config, batch_size, is_training=False, cache_
     dataset = dataset.map(_binary_to_decimal_2,
                           num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
+#### MAP TO COMPACT VOCABULARY IDS
+    if vocab is not None:
+        to_compact = tf.constant(vocab.to_compact)
+        dataset = dataset.map(lambda inp, tar: (tf.gather(to_compact, inp), tf.gather(to_compact, tar)),
+                              num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+#### PACK SEVERAL GROOVES INTO EACH ROW (see PythonFiles/packing.py)
+    if pack_length:
+        dataset = pack_dataset(dataset, pack_length)
+
 #### MAP FUNCTION3
     # dataset = dataset.map(
     #   _remove_pad_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
@@ -124,7 +171,7 @@ def initialize_dataset_as_iterator(config, batch_size, is_training=False, cache_
     # print(dataset)
 
 #### SHUFFLE IF IS_TRAINING
-    if is_training:
+    if shuffle:
         dataset = dataset.shuffle(buffer_size=10 * batch_size)
 
 
@@ -196,8 +243,10 @@ def scaled_dot_product_attention(q, k, v, mask):
   """Calculate the attention weights.
   q, k, v must have matching leading dimensions.
   k, v must have matching penultimate dimension, i.e.: seq_len_k = seq_len_v.
-  The mask has different shapes depending on its type(padding or look ahead) 
-  but it must be broadcastable for addition.
+  The mask has different shapes depending on its type(padding, look ahead or
+  segment, see create_masks) but it must be broadcastable for addition.
+  Positions where the mask is 1 are blocked, which is how packed rows keep
+  their segments from attending to each other.
   
   Args:
     q: query shape == (..., seq_len_q, depth)
@@ -236,21 +285,165 @@ def print_out(q, k, v):
   print ('Output is:')
   print (temp_out)
 
+class RelativeLocalAttention(tf.keras.layers.Layer):
+  """Bar-aligned local self-attention with relative position biases.
+
+  The sequence is cut into windows of `window` steps (one bar). Queries in
+  window b attend to the keys of windows b-1 and b (and b+1 unless causal),
+  plus the first `num_global` positions of the sequence, which every query
+  can see. Scores get a learned per-head bias indexed by the clipped
+  relative distance between query and key (global keys have one bias of
+  their own), replacing the absolute positional encodings. Scores are only
+  computed per window, so memory grows with seq_len * window rather than
+  seq_len ** 2.
+  """
+  def __init__(self, num_heads, window, num_global, causal):
+    super(RelativeLocalAttention, self).__init__()
+    self.num_heads = num_heads
+    self.window = window
+    self.num_global = num_global
+    self.causal = causal
+    self.max_distance = 2 * window
+
+    self.relative_bias = self.add_weight(
+        name='relative_bias', shape=(num_heads, 2 * self.max_distance + 1), initializer='zeros')
+    self.global_bias = self.add_weight(
+        name='global_bias', shape=(num_heads,), initializer='zeros')
+
+    # Window of keys seen by each block: previous, current (and next) block
+    self.key_blocks = [-1, 0] if causal else [-1, 0, 1]
+    key_offsets = np.concatenate([np.arange(window) + b * window for b in self.key_blocks])
+    self.key_offsets = tf.constant(key_offsets, dtype=tf.int32)  # (window_k,)
+    relative = key_offsets[np.newaxis, :] - np.arange(window)[:, np.newaxis]  # (window, window_k)
+    self.relative_index = tf.constant(np.clip(relative, -self.max_distance, self.max_distance)
+                                      + self.max_distance, dtype=tf.int32)
+    structural = relative > 0 if causal else np.zeros(relative.shape, dtype=bool)
+    self.structural_mask = tf.constant(structural, dtype=tf.float32)
+
+  def call(self, q, k, v, mask, q_offset=0):
+    """q, k, v: (batch_size, num_heads, seq_len, depth). mask is the usual
+    padding/look-ahead mask of scaled_dot_product_attention.
+
+    Self-attention over a whole sequence (q_offset == 0, same length) uses the
+    blocked computation; queries at positions q_offset.. over keys 0.. (the
+    cached decoding path) use an equivalent dense one."""
+    if mask is None:
+      mask = tf.zeros_like(k[:, :1, tf.newaxis, :, 0])
+    if isinstance(q_offset, int) and q_offset == 0 and q.shape[2] == k.shape[2]:
+      return self._blocked(q, k, v, mask)
+    return self._dense(q, k, v, mask, q_offset)
+
+  def _dense(self, q, k, v, mask, q_offset):
+    q_pos = tf.range(tf.shape(q)[2]) + q_offset
+    k_pos = tf.range(tf.shape(k)[2])
+    relative = k_pos[tf.newaxis, :] - q_pos[:, tf.newaxis]  # (seq_len_q, seq_len_k)
+    is_global = k_pos[tf.newaxis, :] < self.num_global
+    q_block = (q_pos // self.window)[:, tf.newaxis]
+    k_block = (k_pos // self.window)[tf.newaxis, :]
+    allowed = tf.logical_or(is_global, tf.logical_and(k_block >= q_block + self.key_blocks[0],
+                                                      k_block <= q_block + self.key_blocks[-1]))
+    if self.causal:
+      allowed = tf.logical_and(allowed, relative <= 0)
+
+    index = tf.clip_by_value(relative, -self.max_distance, self.max_distance) + self.max_distance
+    bias = tf.where(is_global[tf.newaxis], self.global_bias[:, tf.newaxis, tf.newaxis],
+                    tf.gather(self.relative_bias, index, axis=1))  # (num_heads, seq_len_q, seq_len_k)
+
+    dk = tf.cast(tf.shape(k)[-1], tf.float32)
+    logits = tf.matmul(q, k, transpose_b=True) / tf.math.sqrt(dk) + bias
+    blocked = tf.maximum(mask, 1. - tf.cast(allowed, tf.float32))
+    weights = tf.nn.softmax(logits + blocked * -1e9, axis=-1)
+    return tf.matmul(weights, v), None
+
+  def _blocked(self, q, k, v, mask):
+    batch_size, seq_len = tf.shape(q)[0], tf.shape(q)[2]
+    depth = q.shape[-1]
+    window = self.window
+    pad = (-seq_len) % window
+    n_blocks = (seq_len + pad) // window
+
+    # 1. = padded key; the last row of a (.., seq_len_q, seq_len_k) mask has no
+    # look-ahead part, so it is the key padding
+    key_padding = tf.pad(mask[:, 0, -1, :], [[0, 0], [0, pad]], constant_values=1.)
+    q, k, v = [tf.pad(x, [[0, 0], [0, 0], [0, pad], [0, 0]]) for x in (q, k, v)]
+
+    def blocks(x):
+      return tf.reshape(x, (batch_size, self.num_heads, n_blocks, window, depth))
+
+    def neighbours(x, fill):
+      # x: (..., n_blocks, window[, depth]) with the block axis at -2 or -3
+      axis = len(x.shape) - (3 if len(x.shape) == 5 else 2)
+      edge = tf.ones_like(tf.gather(x, [0], axis=axis)) * fill
+      shifted = {-1: tf.concat([edge, tf.gather(x, tf.range(n_blocks - 1), axis=axis)], axis=axis),
+                 0: x,
+                 1: tf.concat([tf.gather(x, tf.range(1, n_blocks), axis=axis), edge], axis=axis)}
+      return tf.concat([shifted[b] for b in self.key_blocks], axis=axis + 1)
+
+    q_blocks = blocks(q)                 # (batch_size, num_heads, n_blocks, window, depth)
+    k_window = neighbours(blocks(k), 0.)  # (batch_size, num_heads, n_blocks, window_k, depth)
+    v_window = neighbours(blocks(v), 0.)
+    padding_window = neighbours(tf.reshape(key_padding, (batch_size, n_blocks, window)), 1.)
+
+    # Keys that are also global are counted once, through the global part
+    key_pos = tf.range(n_blocks)[:, tf.newaxis, tf.newaxis] * window + self.key_offsets  # (n_blocks, 1, window_k)
+    local_blocked = tf.maximum(
+        tf.maximum(padding_window[:, tf.newaxis, :, tf.newaxis, :], self.structural_mask),
+        tf.cast(key_pos < self.num_global, tf.float32))  # (batch_size, 1, n_blocks, window, window_k)
+
+    scale = tf.math.sqrt(tf.cast(depth, tf.float32))
+    local_logits = tf.einsum('bhnqd,bhnkd->bhnqk', q_blocks, k_window) / scale
+    local_logits += tf.gather(self.relative_bias, self.relative_index, axis=1)[:, tf.newaxis]
+    local_logits += local_blocked * -1e9
+
+    n_global = tf.minimum(self.num_global, seq_len)
+    global_k, global_v = k[:, :, :n_global], v[:, :, :n_global]
+    global_logits = tf.einsum('bhnqd,bhgd->bhnqg', q_blocks, global_k) / scale
+    global_logits += self.global_bias[:, tf.newaxis, tf.newaxis, tf.newaxis]
+    global_blocked = key_padding[:, tf.newaxis, tf.newaxis, tf.newaxis, :n_global]
+    if self.causal:
+      q_pos = tf.reshape(tf.range(n_blocks * window), (n_blocks, window, 1))
+      global_blocked = tf.maximum(global_blocked, tf.cast(tf.range(n_global) > q_pos, tf.float32))
+    global_logits += global_blocked * -1e9
+
+    weights = tf.nn.softmax(tf.concat([local_logits, global_logits], axis=-1), axis=-1)
+    window_k = len(self.key_blocks) * window
+    local_weights, global_weights = weights[..., :window_k], weights[..., window_k:]
+    out = (tf.einsum('bhnqk,bhnkd->bhnqd', local_weights, v_window) +
+           tf.einsum('bhnqg,bhgd->bhnqd', global_weights, global_v))
+    out = tf.reshape(out, (batch_size, self.num_heads, n_blocks * window, depth))
+    return out[:, :, :seq_len], None
+
+
 class MultiHeadAttention(tf.keras.layers.Layer):
-  def __init__(self, d_model, num_heads):
+  def __init__(self, d_model, num_heads, attention='full', window=16, num_global=4, causal=False,
+               depth=None):
     super(MultiHeadAttention, self).__init__()
     self.num_heads = num_heads
     self.d_model = d_model
     
-    assert d_model % self.num_heads == 0
+    # depth is only given for pruned layers, which keep the per-head depth of
+    # the unpruned model with fewer heads (num_heads * depth < d_model)
+    assert depth is not None or d_model % self.num_heads == 0
     
-    self.depth = d_model // self.num_heads
+    self.depth = depth or d_model // self.num_heads
+    self.heads_dim = self.num_heads * self.depth
     
-    self.wq = tf.keras.layers.Dense(d_model)
-    self.wk = tf.keras.layers.Dense(d_model)
-    self.wv = tf.keras.layers.Dense(d_model)
+    self.wq = tf.keras.layers.Dense(self.heads_dim)
+    self.wk = tf.keras.layers.Dense(self.heads_dim)
+    self.wv = tf.keras.layers.Dense(self.heads_dim)
     
     self.dense = tf.keras.layers.Dense(d_model)
+
+    # attention='local' is only meant for self-attention, see RelativeLocalAttention
+    assert attention in ('full', 'local')
+    self.local_attention = (RelativeLocalAttention(num_heads, window, num_global, causal)
+                            if attention == 'local' else None)
+
+  def _attention(self, q, k, v, mask, q_offset=0):
+    if self.local_attention is None:
+      return scaled_dot_product_attention(q, k, v, mask)
+    # The local variant never materialises the full attention weights
+    return self.local_attention(q, k, v, mask, q_offset)
         
   def split_heads(self, x, batch_size):
     """Split the last dimension into (num_heads, depth).
@@ -259,7 +452,7 @@ class MultiHeadAttention(tf.keras.layers.Layer):
     x = tf.reshape(x, (batch_size, -1, self.num_heads, self.depth))
     return tf.transpose(x, perm=[0, 2, 1, 3])
     
-  def call(self, v, k, q, mask):
+  def call(self, v, k, q, mask, return_attention_weights=False):
     batch_size = tf.shape(q)[0]
     
     q = self.wq(q)  # (batch_size, seq_len, d_model)
@@ -272,18 +465,39 @@ class MultiHeadAttention(tf.keras.layers.Layer):
     
     # scaled_attention.shape == (batch_size, num_heads, seq_len_q, depth)
     # attention_weights.shape == (batch_size, num_heads, seq_len_q, seq_len_k)
-    scaled_attention, attention_weights = scaled_dot_product_attention(
-        q, k, v, mask)
+    scaled_attention, attention_weights = self._attention(q, k, v, mask)
     
     scaled_attention = tf.transpose(scaled_attention, perm=[0, 2, 1, 3])  # (batch_size, seq_len_q, num_heads, depth)
 
     concat_attention = tf.reshape(scaled_attention, 
-                                  (batch_size, -1, self.d_model))  # (batch_size, seq_len_q, d_model)
+                                  (batch_size, -1, self.heads_dim))  # (batch_size, seq_len_q, d_model)
 
     output = self.dense(concat_attention)  # (batch_size, seq_len_q, d_model)
+
+    # Drop the (batch_size, num_heads, seq_len_q, seq_len_k) weights unless the
+    # caller asked for them, so they can be freed as soon as the matmul is done.
+    if not return_attention_weights:
+      attention_weights = None
         
     return output, attention_weights
 
+  def project_kv(self, v, k):
+    """Projected and head-split values and keys, so that incremental decoding
+    can keep them in a cache instead of recomputing them every step."""
+    batch_size = tf.shape(k)[0]
+    return (self.split_heads(self.wv(v), batch_size),   # (batch_size, num_heads, seq_len_v, depth)
+            self.split_heads(self.wk(k), batch_size))   # (batch_size, num_heads, seq_len_k, depth)
+
+  def attend(self, q, v_heads, k_heads, mask, q_offset=0):
+    """Same as call, for queries over values/keys already returned by
+    project_kv. q_offset is the position of the first query."""
+    batch_size = tf.shape(q)[0]
+    q = self.split_heads(self.wq(q), batch_size)  # (batch_size, num_heads, seq_len_q, depth)
+    scaled_attention, _ = self._attention(q, k_heads, v_heads, mask, q_offset)
+    scaled_attention = tf.transpose(scaled_attention, perm=[0, 2, 1, 3])
+    concat_attention = tf.reshape(scaled_attention, (batch_size, -1, self.heads_dim))
+    return self.dense(concat_attention)  # (batch_size, seq_len_q, d_model)
+
 
 # Point wise feed forward layer
 
@@ -292,13 +506,38 @@ def point_wise_feed_forward_network(d_model, dff):
       tf.keras.layers.Dense(dff, activation='relu'),  # (batch_size, seq_len, dff)
       tf.keras.layers.Dense(d_model)])  # (batch_size, seq_len, d_model)
 
+# Activation rematerialization
+
+def new_dropout_seed():
+  return tf.random.uniform([2], maxval=2 ** 31 - 1, dtype=tf.int32)
+
+def apply_dropout(layer, x, training, seed=None, offset=0):
+  """layer (a Dropout) applied to x. With a seed the dropout mask only depends
+  on seed + offset, so that a recomputed forward pass drops the same units."""
+  if seed is None:
+    return layer(x, training=training)
+  if not training or layer.rate == 0:
+    return x
+  keep = tf.random.stateless_uniform(tf.shape(x), seed + offset) >= layer.rate
+  return x * tf.cast(keep, x.dtype) / (1. - layer.rate)
+
+def recompute(fn, *tensors):
+  """fn(*tensors) under tf.recompute_grad: only the inputs are kept for the
+  backward pass, which runs fn again to get the activations back. None
+  arguments (e.g. a missing mask) are passed to fn as None."""
+  present = [t for t in tensors if t is not None]
+  def forward(*args):
+    args = iter(args)
+    return fn(*[None if t is None else next(args) for t in tensors])
+  return tf.recompute_grad(forward)(*present)
+
 # Encoder
 
 class EncoderLayer(tf.keras.layers.Layer):
-  def __init__(self, d_model, num_heads, dff, rate=0.1):
+  def __init__(self, d_model, num_heads, dff, rate=0.1, attention='full', recompute=False, depth=None):
     super(EncoderLayer, self).__init__()
 
-    self.mha = MultiHeadAttention(d_model, num_heads)
+    self.mha = MultiHeadAttention(d_model, num_heads, attention=attention, depth=depth)
     self.ffn = point_wise_feed_forward_network(d_model, dff)
 
     self.layernorm1 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
@@ -306,45 +545,73 @@ class EncoderLayer(tf.keras.layers.Layer):
     
     self.dropout1 = tf.keras.layers.Dropout(rate)
     self.dropout2 = tf.keras.layers.Dropout(rate)
+
+    # Recompute the attention/FFN activations in the backward pass instead of
+    # keeping them (training only)
+    self.recompute = recompute
+
+  def build(self, input_shape):
+    if self.recompute:
+      # tf.recompute_grad must not create variables: build the sublayers now
+      self._forward(tf.zeros((1, 1, input_shape[-1])), None, False)
+    super(EncoderLayer, self).build(input_shape)
     
   def call(self, x, training, mask):
+    if self.recompute and training:
+      seed = new_dropout_seed()
+      return recompute(lambda x, mask: self._forward(x, mask, training, seed), x, mask)
+    return self._forward(x, mask, training)
+
+  def _forward(self, x, mask, training, seed=None):
 
     attn_output, _ = self.mha(x, x, x, mask)  # (batch_size, input_seq_len, d_model)
-    attn_output = self.dropout1(attn_output, training=training)
+    attn_output = apply_dropout(self.dropout1, attn_output, training, seed, 0)
     out1 = self.layernorm1(x + attn_output)  # (batch_size, input_seq_len, d_model)
     
     ffn_output = self.ffn(out1)  # (batch_size, input_seq_len, d_model)
-    ffn_output = self.dropout2(ffn_output, training=training)
+    ffn_output = apply_dropout(self.dropout2, ffn_output, training, seed, 1)
     out2 = self.layernorm2(out1 + ffn_output)  # (batch_size, input_seq_len, d_model)
     
     return out2
 
 class Encoder(tf.keras.layers.Layer):
   def __init__(self, num_layers, d_model, num_heads, dff, input_vocab_size,
-               maximum_position_encoding, rate=0.1):
+               maximum_position_encoding, rate=0.1, attention='full', recompute_layers=(),
+               layer_sizes=None):
     super(Encoder, self).__init__()
 
     self.d_model = d_model
     self.num_layers = num_layers
+    # Local attention encodes positions with relative biases instead
+    self.absolute_positions = attention == 'full'
     
     self.embedding = tf.keras.layers.Embedding(input_vocab_size, d_model)
     self.pos_encoding = positional_encoding(maximum_position_encoding, 
                                             self.d_model)
     
     
-    self.enc_layers = [EncoderLayer(d_model, num_heads, dff, rate) 
-                       for _ in range(num_layers)]
+    if layer_sizes is None:
+      self.enc_layers = [EncoderLayer(d_model, num_heads, dff, rate, attention, i in recompute_layers) 
+                         for i in range(num_layers)]
+    else:
+      # Per-layer {'num_heads', 'dff'} of a pruned model (see Transformer)
+      self.enc_layers = [EncoderLayer(d_model, sizes['num_heads'], sizes['dff'], rate, attention,
+                                      i in recompute_layers, depth=d_model // num_heads)
+                         for i, sizes in enumerate(layer_sizes)]
   
     self.dropout = tf.keras.layers.Dropout(rate)
         
-  def call(self, x, training, mask):
+  def call(self, x, training, mask, positions=None):
+    # positions: optional (batch_size, input_seq_len) position of every token,
+    # which restarts at 0 for every segment of a packed row
 
     seq_len = tf.shape(x)[1]
     
     # adding embedding and position encoding.
     x = self.embedding(x)  # (batch_size, input_seq_len, d_model)
     x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
-    x += self.pos_encoding[:, :seq_len, :]
+    if self.absolute_positions:
+      x += self.pos_encoding[:, :seq_len, :] if positions is None else tf.gather(self.pos_encoding[0], positions)
 
     x = self.dropout(x, training=training)
     
@@ -356,11 +623,13 @@ class Encoder(tf.keras.layers.Layer):
 # Decoder
 
 class DecoderLayer(tf.keras.layers.Layer):
-  def __init__(self, d_model, num_heads, dff, rate=0.1):
+  def __init__(self, d_model, num_heads, dff, rate=0.1, attention='full', recompute=False, depth=None,
+               cross_num_heads=None):
     super(DecoderLayer, self).__init__()
 
-    self.mha1 = MultiHeadAttention(d_model, num_heads)
-    self.mha2 = MultiHeadAttention(d_model, num_heads)
+    self.mha1 = MultiHeadAttention(d_model, num_heads, attention=attention, causal=True, depth=depth)
+    # Encoder-decoder attention always sees the whole input
+    self.mha2 = MultiHeadAttention(d_model, cross_num_heads or num_heads, depth=depth)
 
     self.ffn = point_wise_feed_forward_network(d_model, dff)
  
@@ -371,89 +640,208 @@ class DecoderLayer(tf.keras.layers.Layer):
     self.dropout1 = tf.keras.layers.Dropout(rate)
     self.dropout2 = tf.keras.layers.Dropout(rate)
     self.dropout3 = tf.keras.layers.Dropout(rate)
-    
+
+    # See EncoderLayer
+    self.recompute = recompute
+
+  def build(self, input_shape):
+    if self.recompute:
+      zeros = tf.zeros((1, 1, input_shape[-1]))
+      self._forward(zeros, zeros, False, None, None)
+    super(DecoderLayer, self).build(input_shape)
     
   def call(self, x, enc_output, training, 
-           look_ahead_mask, padding_mask):
+           look_ahead_mask, padding_mask, return_attention_weights=False):
+    # Attention weights that are asked for can't come out of recompute_grad
+    if self.recompute and training and not return_attention_weights:
+      seed = new_dropout_seed()
+      out3 = recompute(
+          lambda x, enc_output, look_ahead_mask, padding_mask: self._forward(
+              x, enc_output, training, look_ahead_mask, padding_mask, seed=seed)[0],
+          x, enc_output, look_ahead_mask, padding_mask)
+      return out3, None, None
+    return self._forward(x, enc_output, training, look_ahead_mask, padding_mask,
+                         return_attention_weights)
+
+  def _forward(self, x, enc_output, training, 
+               look_ahead_mask, padding_mask, return_attention_weights=False, seed=None):
     # enc_output.shape == (batch_size, input_seq_len, d_model)
 
-    attn1, attn_weights_block1 = self.mha1(x, x, x, look_ahead_mask)  # (batch_size, target_seq_len, d_model)
-    attn1 = self.dropout1(attn1, training=training)
+    attn1, attn_weights_block1 = self.mha1(
+        x, x, x, look_ahead_mask, return_attention_weights)  # (batch_size, target_seq_len, d_model)
+    attn1 = apply_dropout(self.dropout1, attn1, training, seed, 0)
     out1 = self.layernorm1(attn1 + x)
     
     attn2, attn_weights_block2 = self.mha2(
-        enc_output, enc_output, out1, padding_mask)  # (batch_size, target_seq_len, d_model)
-    attn2 = self.dropout2(attn2, training=training)
+        enc_output, enc_output, out1, padding_mask,
+        return_attention_weights)  # (batch_size, target_seq_len, d_model)
+    attn2 = apply_dropout(self.dropout2, attn2, training, seed, 1)
     out2 = self.layernorm2(attn2 + out1)  # (batch_size, target_seq_len, d_model)
     
     ffn_output = self.ffn(out2)  # (batch_size, target_seq_len, d_model)
-    ffn_output = self.dropout3(ffn_output, training=training)
+    ffn_output = apply_dropout(self.dropout3, ffn_output, training, seed, 2)
     out3 = self.layernorm3(ffn_output + out2)  # (batch_size, target_seq_len, d_model)
     
     return out3, attn_weights_block1, attn_weights_block2
 
+  def call_cached(self, x, cache, look_ahead_mask, padding_mask):
+    """Inference-only call for the new positions x after the ones in cache.
+
+    cache holds the self-attention values/keys of the earlier positions ('v',
+    'k') and the projected encoder output ('enc_v', 'enc_k'). Returns the
+    output for x and the cache extended with x's values/keys.
+    """
+    past = tf.shape(cache['k'])[2]
+    v, k = self.mha1.project_kv(x, x)
+    v = tf.concat([cache['v'], v], axis=2)
+    k = tf.concat([cache['k'], k], axis=2)
+
+    attn1 = self.mha1.attend(x, v, k, look_ahead_mask, q_offset=past)  # (batch_size, new_len, d_model)
+    out1 = self.layernorm1(attn1 + x)
+
+    attn2 = self.mha2.attend(out1, cache['enc_v'], cache['enc_k'], padding_mask)
+    out2 = self.layernorm2(attn2 + out1)
+
+    out3 = self.layernorm3(self.ffn(out2) + out2)
+    return out3, dict(cache, v=v, k=k)
+
 class Decoder(tf.keras.layers.Layer):
   def __init__(self, num_layers, d_model, num_heads, dff, target_vocab_size,
-               maximum_position_encoding, rate=0.1):
+               maximum_position_encoding, rate=0.1, attention='full', recompute_layers=(),
+               layer_sizes=None):
     super(Decoder, self).__init__()
 
     self.d_model = d_model
     self.num_layers = num_layers
+    self.absolute_positions = attention == 'full'
     
     self.embedding = tf.keras.layers.Embedding(target_vocab_size, d_model)
     self.pos_encoding = positional_encoding(maximum_position_encoding, d_model)
     
-    self.dec_layers = [DecoderLayer(d_model, num_heads, dff, rate) 
-                       for _ in range(num_layers)]
+    if layer_sizes is None:
+      self.dec_layers = [DecoderLayer(d_model, num_heads, dff, rate, attention, i in recompute_layers) 
+                         for i in range(num_layers)]
+    else:
+      # Per-layer {'num_heads', 'cross_num_heads', 'dff'} of a pruned model
+      self.dec_layers = [DecoderLayer(d_model, sizes['num_heads'], sizes['dff'], rate, attention,
+                                      i in recompute_layers, depth=d_model // num_heads,
+                                      cross_num_heads=sizes['cross_num_heads'])
+                         for i, sizes in enumerate(layer_sizes)]
     self.dropout = tf.keras.layers.Dropout(rate)
+
+    # Optional callable(name, weights) used by analysis code to observe the
+    # attention maps without them being returned from every forward pass.
+    self.attention_hook = None
     
   def call(self, x, enc_output, training, 
-           look_ahead_mask, padding_mask):
+           look_ahead_mask, padding_mask, return_attention_weights=False, positions=None):
 
     seq_len = tf.shape(x)[1]
-    attention_weights = {}
+    capture = return_attention_weights or self.attention_hook is not None
+    attention_weights = {} if return_attention_weights else None
     
     x = self.embedding(x)  # (batch_size, target_seq_len, d_model)
     x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
-    x += self.pos_encoding[:, :seq_len, :]
+    if self.absolute_positions:
+      x += self.pos_encoding[:, :seq_len, :] if positions is None else tf.gather(self.pos_encoding[0], positions)
     
     x = self.dropout(x, training=training)
 
     for i in range(self.num_layers):
       x, block1, block2 = self.dec_layers[i](x, enc_output, training,
-                                             look_ahead_mask, padding_mask)
-      
-      attention_weights['decoder_layer{}_block1'.format(i+1)] = block1
-      attention_weights['decoder_layer{}_block2'.format(i+1)] = block2
+                                             look_ahead_mask, padding_mask,
+                                             capture)
+      if not capture:
+        continue
+
+      blocks = {'decoder_layer{}_block1'.format(i+1): block1,
+                'decoder_layer{}_block2'.format(i+1): block2}
+      for name, weights in blocks.items():
+        if self.attention_hook is not None:
+          self.attention_hook(name, weights)
+        if return_attention_weights:
+          attention_weights[name] = weights
     
     # x.shape == (batch_size, target_seq_len, d_model)
+    # attention_weights is None unless return_attention_weights=True
     return x, attention_weights
 
+  def init_cache(self, enc_output):
+    """Empty incremental-decoding state for a batch. The encoder output is
+    projected once per layer here and reused by every call_cached."""
+    batch_size = tf.shape(enc_output)[0]
+    layers = []
+    for layer in self.dec_layers:
+      enc_v, enc_k = layer.mha2.project_kv(enc_output, enc_output)
+      empty = tf.zeros((batch_size, layer.mha1.num_heads, 0, layer.mha1.depth))
+      layers.append({'v': empty, 'k': empty, 'enc_v': enc_v, 'enc_k': enc_k})
+    return {'tokens': tf.zeros((batch_size, 0), dtype=tf.int64), 'layers': layers}
+
+  def call_cached(self, x, cache, padding_mask):
+    """Decodes the new tokens x (batch_size, new_len) that follow the tokens
+    already in cache, without recomputing them. Applies the same look-ahead
+    and target padding masks as call in inference mode.
+
+    Returns (batch_size, new_len, d_model) and the extended cache.
+    """
+    past = tf.shape(cache['tokens'])[1]
+    tokens = tf.concat([cache['tokens'], x], axis=1)
+    total = tf.shape(tokens)[1]
+    look_ahead_mask = tf.maximum(create_padding_mask(tokens),
+                                 create_look_ahead_mask(total)[past:, :])
+
+    x = self.embedding(x)  # (batch_size, new_len, d_model)
+    x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
+    if self.absolute_positions:
+      x += self.pos_encoding[:, past:total, :]
+
+    layers = []
+    for layer, layer_cache in zip(self.dec_layers, cache['layers']):
+      x, layer_cache = layer.call_cached(x, layer_cache, look_ahead_mask, padding_mask)
+      layers.append(layer_cache)
+
+    return x, {'tokens': tokens, 'layers': layers}
+
 
 # Assemble the transformer
 
 
 class Transformer(tf.keras.Model):
   def __init__(self, num_layers, d_model, num_heads, dff, input_vocab_size, 
-               target_vocab_size, pe_input, pe_target, rate=0.1):
+               target_vocab_size, pe_input, pe_target, rate=0.1, attention='full',
+               recompute_layers=(), layer_sizes=None):
     super(Transformer, self).__init__()
 
+    # recompute_layers: names of the layers that rematerialize their activations,
+    # 'encoder0', 'decoder1', ...
+    # layer_sizes: optional {'encoder': [...], 'decoder': [...]} heads and FFN
+    # units per layer of a pruned model (prune.py). Heads keep the depth
+    # d_model // num_heads of the unpruned model.
+    layer_sizes = layer_sizes or {}
     self.encoder = Encoder(num_layers, d_model, num_heads, dff, 
-                           input_vocab_size, pe_input, rate)
+                           input_vocab_size, pe_input, rate, attention,
+                           [i for i in range(num_layers) if 'encoder%d' % i in recompute_layers],
+                           layer_sizes.get('encoder'))
 
     self.decoder = Decoder(num_layers, d_model, num_heads, dff, 
-                           target_vocab_size, pe_target, rate)
+                           target_vocab_size, pe_target, rate, attention,
+                           [i for i in range(num_layers) if 'decoder%d' % i in recompute_layers],
+                           layer_sizes.get('decoder'))
 
     self.final_layer = tf.keras.layers.Dense(target_vocab_size)
     
   def call(self, inp, tar, training, enc_padding_mask, 
-           look_ahead_mask, dec_padding_mask):
+           look_ahead_mask, dec_padding_mask, return_attention_weights=False,
+           inp_positions=None, tar_positions=None):
+    # inp_positions/tar_positions: per-segment positions of packed rows
 
-    enc_output = self.encoder(inp, training, enc_padding_mask)  # (batch_size, inp_seq_len, d_model)
+    enc_output = self.encoder(inp, training, enc_padding_mask,
+                              positions=inp_positions)  # (batch_size, inp_seq_len, d_model)
     
     # dec_output.shape == (batch_size, tar_seq_len, d_model)
     dec_output, attention_weights = self.decoder(
-        tar, enc_output, training, look_ahead_mask, dec_padding_mask)
+        tar, enc_output, training, look_ahead_mask, dec_padding_mask,
+        return_attention_weights, positions=tar_positions)
     
     final_output = self.final_layer(dec_output)  # (batch_size, tar_seq_len, target_vocab_size)
     
@@ -468,6 +856,26 @@ class Transformer(tf.keras.Model):
     target_vocab_size = tokenizer_en.vocab_size + 2
     dropout_rate = 0.1
 
+@contextlib.contextmanager
+def capture_attention_weights(transformer):
+  """Collect the decoder attention maps of every forward pass in the block.
+
+  Training and serving never return attention weights; analysis notebooks
+  can opt in with:
+
+    with capture_attention_weights(transformer) as weights:
+      transformer(inp, tar, False, enc_mask, combined_mask, dec_mask)
+    weights['decoder_layer1_block2']  # (batch_size, num_heads, seq_len_q, seq_len_k)
+  """
+  weights = {}
+  previous_hook = transformer.decoder.attention_hook
+  transformer.decoder.attention_hook = weights.__setitem__
+  try:
+    yield weights
+  finally:
+    transformer.decoder.attention_hook = previous_hook
+
+
 class CustomSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
   def __init__(self, d_model, warmup_steps=4000):
     super(CustomSchedule, self).__init__()
@@ -503,8 +911,11 @@ temp_learning_rate_schedule = CustomSchedule(d_model)
 
 loss_object = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True, reduction='none')
 
-def loss_function(real, pred):
-  mask = tf.math.logical_not(tf.math.equal(real, 0))
+def loss_function(real, pred, mask=None):
+  # mask: (batch_size, seq_len) validity of the targets, see target_mask.
+  # Without it every step counts.
+  if mask is None:
+    mask = target_mask(real)
   loss_ = loss_object(real, pred)
 
   mask = tf.cast(mask, dtype=loss_.dtype)
@@ -531,24 +942,109 @@ d_model = 128
 dff = 512
 num_heads = 8
 
-input_vocab_size = 512 + 2
-target_vocab_size = 512 + 2
+# Optional compact vocabulary written by build_vocab.py (GROOVE_VOCAB=vocab.npz).
+# The data pipeline, the embeddings and final_layer then work on compact ids;
+# encode_tokens/decode_tokens convert at the generation boundary.
+vocab = CompactVocabulary.load(os.environ['GROOVE_VOCAB']) if os.environ.get('GROOVE_VOCAB') else None
+
+input_vocab_size = (vocab.size if vocab else 512) + 2
+target_vocab_size = (vocab.size if vocab else 512) + 2
+# Positional encodings are sized by sequence length, not by the vocabulary
+max_position_encoding = 512 + 2
 dropout_rate = 0.25
 
+# Self-attention variant (GROOVE_ATTENTION): 'full', or 'local' for bar-aligned
+# windows with relative position biases (RelativeLocalAttention) for 4-bar and
+# longer sequences
+attention = os.environ.get('GROOVE_ATTENTION', 'full')
+
+# Sequence packing (GROOVE_PACK_LENGTH=128): several grooves per fixed-length row,
+# kept apart by segment ids instead of padding every groove (PythonFiles/packing.py)
+PACK_LENGTH = int(os.environ.get('GROOVE_PACK_LENGTH', '0')) or None
+# RelativeLocalAttention derives its windows and padding from absolute positions
+assert PACK_LENGTH is None or attention == 'full', 'packing needs GROOVE_ATTENTION=full'
+
 EPOCHS = 1
 
+# Per-run overrides of the hyperparameters above, e.g. from sweep.py:
+# GROOVE_HPARAMS='{"num_layers": 4, "d_model": 256, "dropout_rate": 0.1}'
+HPARAMS = json.loads(os.environ.get('GROOVE_HPARAMS', '{}'))
+num_layers = HPARAMS.get('num_layers', num_layers)
+d_model = HPARAMS.get('d_model', d_model)
+dff = HPARAMS.get('dff', dff)
+num_heads = HPARAMS.get('num_heads', num_heads)
+dropout_rate = HPARAMS.get('dropout_rate', dropout_rate)
+EPOCHS = HPARAMS.get('EPOCHS', EPOCHS)
+
+# With JIT_COMPILE every batch is padded up to one of these lengths, so XLA
+# compiles at most len(SEQ_LEN_BUCKETS) executables per step function.
+SEQ_LEN_BUCKETS = (16, 32, 64, 128)
+
+# Per-voice hit precision/recall, kick/snare/hat F1 and hit density of the
+# validation predictions, accumulated inside val_step
+val_groove_metrics = GrooveMetrics(to_token=vocab.to_token if vocab else None, name='val_groove')
+
+# Activation rematerialization (GROOVE_RECOMPUTE): 'all', or the layers to
+# recompute, e.g. 'encoder0,decoder1'. Their attention/FFN activations are
+# recomputed in the backward pass instead of kept, which lowers peak memory for
+# larger batches at the cost of one more forward pass through them.
+RECOMPUTE = os.environ.get('GROOVE_RECOMPUTE', '')
+recompute_layers = (['%s%d' % (stack, i) for stack in ('encoder', 'decoder') for i in range(num_layers)]
+                    if RECOMPUTE == 'all' else [name for name in RECOMPUTE.split(',') if name])
+
 # Create the Transformer
 
 transformer = Transformer(num_layers, d_model, num_heads, dff,
                           input_vocab_size, target_vocab_size, 
-                          pe_input=input_vocab_size, 
-                          pe_target=target_vocab_size,
-                          rate=dropout_rate)
+                          pe_input=max_position_encoding, 
+                          pe_target=max_position_encoding,
+                          rate=dropout_rate,
+                          attention=attention,
+                          recompute_layers=recompute_layers)
 
 
 # Training 
 
-def create_masks(inp, tar):
+def create_segment_mask(q_segments, k_segments):
+  """1. where a query may not attend to a key: a different segment, or a
+  padding key (segment 0). (batch_size, 1, seq_len_q, seq_len_k)"""
+  blocked = tf.logical_or(tf.not_equal(q_segments[:, :, tf.newaxis], k_segments[:, tf.newaxis, :]),
+                          tf.equal(k_segments, 0)[:, tf.newaxis, :])
+  return tf.cast(blocked, tf.float32)[:, tf.newaxis, :, :]
+
+
+def target_mask(tar_real, tar_segments=None, tar_lengths=None):
+  """Validity of every target step for loss_function and the metrics.
+
+  Token 0 is a real step without hits, so validity never comes from the
+  tokens. tar_lengths (batch_size,) are the lengths of tar before
+  pad_to_bucket, the steps after them are padding. Unpacked batches without
+  lengths are all valid: the grooves are a fixed 32 steps and never padded.
+
+  For packed rows (tar_segments of the whole tar, before the shift) a step is
+  valid when it is not padding and continues the same segment as the step it
+  is predicted from.
+  """
+  if tar_lengths is not None:
+    # tar_real[:, i] is tar[:, i + 1]
+    return tf.sequence_mask(tar_lengths - 1, tf.shape(tar_real)[1], dtype=tf.float32)
+  if tar_segments is None:
+    return tf.ones_like(tar_real, dtype=tf.float32)
+  valid = tf.logical_and(tf.equal(tar_segments[:, :-1], tar_segments[:, 1:]),
+                         tf.not_equal(tar_segments[:, 1:], 0))
+  return tf.cast(valid, tf.float32)
+
+
+def create_masks(inp, tar, inp_segments=None, tar_segments=None):
+  # Packed rows: attention stays within a segment (inp_segments/tar_segments
+  # of inp and tar_inp, see PythonFiles/packing.py)
+  if inp_segments is not None:
+    enc_padding_mask = create_segment_mask(inp_segments, inp_segments)
+    dec_padding_mask = create_segment_mask(tar_segments, inp_segments)
+    look_ahead_mask = create_look_ahead_mask(tf.shape(tar)[1])
+    combined_mask = tf.maximum(create_segment_mask(tar_segments, tar_segments), look_ahead_mask)
+    return enc_padding_mask, combined_mask, dec_padding_mask
+
   # Encoder padding mask
   enc_padding_mask = create_padding_mask(inp)
   
@@ -566,6 +1062,58 @@ def create_masks(inp, tar):
   return enc_padding_mask, combined_mask, dec_padding_mask
 
 
+def pad_to_bucket(inp, tar, buckets=SEQ_LEN_BUCKETS):
+  """Right-pad a batch with token 0 up to the smallest bucket that fits.
+
+  inp and tar are both padded to the bucket, so the 32-step grooves of this
+  dataset fill the 32 bucket without any padding. Padded inputs are masked out
+  of attention by create_padding_mask; the returned tar_lengths keep padded
+  targets out of the loss and the metrics (see bucket_train_step). Batches
+  longer than the largest bucket are returned unpadded (and compile on their own).
+  """
+  tar_lengths = tf.fill([tf.shape(tar)[0]], tf.shape(tar)[1])
+  seq_len = max(int(inp.shape[1]), int(tar.shape[1]))
+  bucket = next((b for b in buckets if b >= seq_len), None)
+  if bucket is None:
+    return inp, tar, tar_lengths
+
+  inp = tf.pad(inp, [[0, 0], [0, bucket - int(inp.shape[1])]])
+  tar = tf.pad(tar, [[0, 0], [0, bucket - int(tar.shape[1])]])
+  return inp, tar, tar_lengths
+
+
+class BucketTimer(object):
+  """Wall time of a step function per sequence-length bucket.
+
+  The first call of a bucket includes tracing and XLA compilation; the
+  following ones are the steady state.
+  """
+  def __init__(self, name):
+    self.name = name
+    self.compile_secs = {}
+    self.step_secs = collections.defaultdict(list)
+
+  def __call__(self, step_fn, inp, tar, *args):
+    bucket = int(inp.shape[1])
+    start = time.time()
+    result = step_fn(inp, tar, *args)
+    elapsed = time.time() - start
+
+    if bucket not in self.compile_secs:
+      self.compile_secs[bucket] = elapsed
+      print ('{}: compiled bucket {} in {:.2f} secs'.format(self.name, bucket, elapsed))
+    else:
+      self.step_secs[bucket].append(elapsed)
+    return result
+
+  def report(self):
+    for bucket in sorted(self.compile_secs):
+      steps = self.step_secs[bucket]
+      steady = sum(steps) / len(steps) if steps else float('nan')
+      print ('{}: bucket {} compile {:.2f} secs, steady state {:.2f} ms/step over {} steps'.format(
+          self.name, bucket, self.compile_secs[bucket], 1000 * steady, len(steps)))
+
+
 checkpoint_path = "./checkpoints/train"
 
 ckpt = tf.train.Checkpoint(transformer=transformer,
@@ -573,10 +1121,6 @@ ckpt = tf.train.Checkpoint(transformer=transformer,
 
 ckpt_manager = tf.train.CheckpointManager(ckpt, checkpoint_path, max_to_keep=5)
 
-# if a checkpoint exists, restore the latest checkpoint.
-if ckpt_manager.latest_checkpoint:
-  ckpt.restore(ckpt_manager.latest_checkpoint)
-  print ('Latest checkpoint restored!!')
 
 
 
@@ -591,10 +1135,27 @@ train_step_signature = [
     tf.TensorSpec(shape=(None, None), dtype=tf.int64),
 ]
 
-@tf.function(input_signature=train_step_signature)
-def train_step(inp, tar):
+# Bucketed batches (pad_to_bucket) also carry the unpadded target lengths
+bucket_step_signature = train_step_signature + [
+    tf.TensorSpec(shape=(None,), dtype=tf.int32),
+]
+
+def step_function(input_signature):
+  """tf.function decorator for the train/val steps, XLA-compiled when
+  JIT_COMPILE is set. XLA still specialises on the concrete shapes, which is
+  why the training loop pads batches with pad_to_bucket in that mode."""
+  if not JIT_COMPILE:
+    return tf.function(input_signature=input_signature)
+  try:
+    return tf.function(input_signature=input_signature, jit_compile=True)
+  except TypeError:
+    # tensorflow<2.5 calls it experimental_compile
+    return tf.function(input_signature=input_signature, experimental_compile=True)
+
+def _train_batch(inp, tar, tar_lengths=None):
   tar_inp = tar[:, :-1]
   tar_real = tar[:, 1:]
+  mask = target_mask(tar_real, tar_lengths=tar_lengths)
   
   enc_padding_mask, combined_mask, dec_padding_mask = create_masks(inp, tar_inp)
   
@@ -604,13 +1165,21 @@ def train_step(inp, tar):
                                  enc_padding_mask, 
                                  combined_mask, 
                                  dec_padding_mask)
-    loss = loss_function(tar_real, predictions)
+    loss = loss_function(tar_real, predictions, mask)
 
   gradients = tape.gradient(loss, transformer.trainable_variables)    
   optimizer.apply_gradients(zip(gradients, transformer.trainable_variables))
   
   train_loss(loss)
-  train_accuracy(tar_real, predictions)
+  train_accuracy(tar_real, predictions, sample_weight=mask)
+
+@step_function(train_step_signature)
+def train_step(inp, tar):
+  _train_batch(inp, tar)
+
+@step_function(bucket_step_signature)
+def bucket_train_step(inp, tar, tar_lengths):
+  _train_batch(inp, tar, tar_lengths)
 
 transformer.call  
 
@@ -622,10 +1191,10 @@ val_step_signature = [
     tf.TensorSpec(shape=(None, None), dtype=tf.int64),
 ]
 
-@tf.function(input_signature=val_step_signature)
-def val_step(inp, tar):
+def _val_batch(inp, tar, tar_lengths=None):
   tar_inp = tar[:, :-1]
   tar_real = tar[:, 1:]
+  mask = target_mask(tar_real, tar_lengths=tar_lengths)
   
   enc_padding_mask, combined_mask, dec_padding_mask = create_masks(inp, tar_inp)
   
@@ -635,71 +1204,204 @@ def val_step(inp, tar):
                                 enc_padding_mask, 
                                 combined_mask, 
                                 dec_padding_mask)
-  loss = loss_function(tar_real, predictions)
+  loss = loss_function(tar_real, predictions, mask)
   
   val_loss(loss)
-  val_accuracy(tar_real, predictions)
+  val_accuracy(tar_real, predictions, sample_weight=mask)
+  val_groove_metrics.update_state(tar_real, predictions, sample_weight=mask)
+
+@step_function(val_step_signature)
+def val_step(inp, tar):
+  _val_batch(inp, tar)
+
+@step_function(bucket_step_signature)
+def bucket_val_step(inp, tar, tar_lengths):
+  _val_batch(inp, tar, tar_lengths)
+
+
+# Steps on packed rows (GROOVE_PACK_LENGTH): segment ids and per-segment
+# positions come with every batch, and padding and segment boundaries are
+# left out of the loss and the metrics.
+
+packed_step_signature = [
+    tf.TensorSpec(shape=(None, None), dtype=tf.int64),
+    tf.TensorSpec(shape=(None, None), dtype=tf.int64),
+    tf.TensorSpec(shape=(None, None), dtype=tf.int32),
+    tf.TensorSpec(shape=(None, None), dtype=tf.int32),
+    tf.TensorSpec(shape=(None, None), dtype=tf.int32),
+    tf.TensorSpec(shape=(None, None), dtype=tf.int32),
+]
+
+def _packed_forward(inp, tar, inp_segments, tar_segments, inp_positions, tar_positions, training):
+  tar_inp = tar[:, :-1]
+  tar_real = tar[:, 1:]
+  enc_padding_mask, combined_mask, dec_padding_mask = create_masks(
+      inp, tar_inp, inp_segments, tar_segments[:, :-1])
+  predictions, _ = transformer(inp, tar_inp, training,
+                               enc_padding_mask, combined_mask, dec_padding_mask,
+                               inp_positions=inp_positions, tar_positions=tar_positions[:, :-1])
+  mask = target_mask(tar_real, tar_segments)
+  return tar_real, predictions, mask, loss_function(tar_real, predictions, mask)
+
+@step_function(packed_step_signature)
+def packed_train_step(inp, tar, inp_segments, tar_segments, inp_positions, tar_positions):
+  with tf.GradientTape() as tape:
+    tar_real, predictions, mask, loss = _packed_forward(
+        inp, tar, inp_segments, tar_segments, inp_positions, tar_positions, True)
+
+  gradients = tape.gradient(loss, transformer.trainable_variables)
+  optimizer.apply_gradients(zip(gradients, transformer.trainable_variables))
+
+  train_loss(loss)
+  train_accuracy(tar_real, predictions, sample_weight=mask)
+
+@step_function(packed_step_signature)
+def packed_val_step(inp, tar, inp_segments, tar_segments, inp_positions, tar_positions):
+  tar_real, predictions, mask, loss = _packed_forward(
+      inp, tar, inp_segments, tar_segments, inp_positions, tar_positions, False)
+
+  val_loss(loss)
+  val_accuracy(tar_real, predictions, sample_weight=mask)
+  val_groove_metrics.update_state(tar_real, predictions, sample_weight=mask)
+
+
+# Inference
+
+def restore_latest_checkpoint():
+  """Restores the latest checkpoint in checkpoint_path, if there is one, and
+  returns its path (None otherwise)."""
+  if ckpt_manager.latest_checkpoint:
+    ckpt.restore(ckpt_manager.latest_checkpoint)
+    print ('Latest checkpoint restored!!')
+  return ckpt_manager.latest_checkpoint
+
+
+def encode_tokens(tokens):
+  """Drum tokens -> model ids (the identity without a compact vocabulary)."""
+  return tokens if vocab is None else vocab.encode(tokens)
+
+
+def decode_tokens(ids):
+  """Model ids -> drum tokens, e.g. for the output of greedy_decode."""
+  return ids if vocab is None else vocab.decode(ids)
+
+
+def greedy_decode(transformer, inp, max_len=None, start=None):
+  """Batched greedy decoding of the target tokens for a batch of inputs.
+
+  The encoder runs once; the decoder runs once per generated step on the new
+  token only, reusing the cached keys/values of the earlier ones. Decoding is
+  seeded with `start` (one token per sequence), by default the first input
+  step, the same way train_step teacher-forces from tar[:, 0].
+
+  Args:
+    inp: (batch_size, inp_seq_len) int64 input tokens
+    max_len: length of the returned sequences, seed included. Defaults to
+      inp_seq_len.
+    start: optional (batch_size,) seed tokens
+
+  Returns:
+    (batch_size, max_len) int64 tokens
+  """
+  inp = tf.convert_to_tensor(inp, dtype=tf.int64)
+  max_len = max_len or int(inp.shape[1])
+  start = inp[:, 0] if start is None else tf.convert_to_tensor(start, dtype=tf.int64)
+  next_token = tf.expand_dims(start, 1)
+
+  padding_mask = create_padding_mask(inp)
+  enc_output = transformer.encoder(inp, False, padding_mask)
+  cache = transformer.decoder.init_cache(enc_output)
+  for _ in range(max_len - 1):
+    dec_output, cache = transformer.decoder.call_cached(next_token, cache, padding_mask)
+    predictions = transformer.final_layer(dec_output[:, -1:, :])  # (batch_size, 1, vocab_size)
+    next_token = tf.argmax(predictions, axis=-1)
+
+  return tf.concat([cache['tokens'], next_token], axis=-1)
 
 
 # Train Loop
 
-loss = []
-val_Loss = []
-for epoch in range(EPOCHS):
+if __name__ == '__main__':
+  restore_latest_checkpoint()
+
+  loss = []
+  val_Loss = []
+  train_timer = BucketTimer('train_step')
+  val_timer = BucketTimer('val_step')
+  for epoch in range(EPOCHS):
 
-  import os
-  os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-  start = time.time()
+    import os
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    start = time.time()
 
-  loss.append(train_loss.result().numpy())
-  val_Loss.append(val_loss.result().numpy())
+    loss.append(train_loss.result().numpy())
+    val_Loss.append(val_loss.result().numpy())
   
-  train_loss.reset_states()
-  train_accuracy.reset_states()
-  val_loss.reset_states()
-  val_accuracy.reset_states()
-
-  train_dataset = initialize_dataset_as_iterator(configs_add_closed_hh,64,is_training = True)
-  val_dataset = initialize_dataset_as_iterator(configs_add_closed_hh,64)
-
-  for (batch,(inp,tar)) in enumerate(train_dataset):
-    train_step(inp, tar)
-    if batch % 50 == 0:
-      print ('Epoch {} Batch {} Loss {:.4f} Accuracy {:.4f}'.format(
-          epoch + 1, batch, train_loss.result(), train_accuracy.result()))
-
-  for (batch,(inp,tar)) in enumerate(val_dataset):
-    val_step(inp, tar)
-    if batch % 50 == 0:
-      print ('Validation: Epoch {} Batch {} Loss {:.4f} Accuracy {:.4f}'.format(
-          epoch + 1, batch, val_loss.result(), val_accuracy.result()))
+    train_loss.reset_states()
+    train_accuracy.reset_states()
+    val_loss.reset_states()
+    val_accuracy.reset_states()
+    val_groove_metrics.reset_states()
+
+    train_dataset = initialize_dataset_as_iterator(configs_add_closed_hh,64,is_training = True, vocab=vocab,
+                                                   pack_length=PACK_LENGTH)
+    val_dataset = initialize_dataset_as_iterator(configs_add_closed_hh,64, vocab=vocab,
+                                                 pack_length=PACK_LENGTH)
+
+    for (batch,(inp,tar,*packed)) in enumerate(train_dataset):
+      if PACK_LENGTH:
+        # Packed rows all have PACK_LENGTH steps, no bucketing needed
+        packed_train_step(inp, tar, *packed)
+      elif JIT_COMPILE:
+        train_timer(bucket_train_step, *pad_to_bucket(inp, tar))
+      else:
+        train_step(inp, tar)
+      if batch % 50 == 0:
+        print ('Epoch {} Batch {} Loss {:.4f} Accuracy {:.4f}'.format(
+            epoch + 1, batch, train_loss.result(), train_accuracy.result()))
+
+    for (batch,(inp,tar,*packed)) in enumerate(val_dataset):
+      if PACK_LENGTH:
+        packed_val_step(inp, tar, *packed)
+      elif JIT_COMPILE:
+        val_timer(bucket_val_step, *pad_to_bucket(inp, tar))
+      else:
+        val_step(inp, tar)
+      if batch % 50 == 0:
+        print ('Validation: Epoch {} Batch {} Loss {:.4f} Accuracy {:.4f}'.format(
+            epoch + 1, batch, val_loss.result(), val_accuracy.result()))
   
 
-  if (epoch + 1) % 2 == 0:
-    ckpt_save_path = ckpt_manager.save()
-    print ('Saving checkpoint for epoch {} at {}'.format(epoch+1,
-                                                         ckpt_save_path))
+    if (epoch + 1) % 2 == 0:
+      ckpt_save_path = ckpt_manager.save()
+      print ('Saving checkpoint for epoch {} at {}'.format(epoch+1,
+                                                           ckpt_save_path))
     
-  print ('Epoch {} Loss {:.4f} Accuracy {:.4f}'.format(epoch + 1, 
-                                                train_loss.result(), 
-                                                train_accuracy.result()))
+    print ('Epoch {} Loss {:.4f} Accuracy {:.4f}'.format(epoch + 1, 
+                                                  train_loss.result(), 
+                                                  train_accuracy.result()))
+    print ('Validation groove metrics: {}'.format(val_groove_metrics.report()))
+
+    if JIT_COMPILE:
+      train_timer.report()
+      val_timer.report()
 
-  print ('Time taken for 1 epoch: {} secs\n'.format(time.time() - start))
+    print ('Time taken for 1 epoch: {} secs\n'.format(time.time() - start))
 
 
-N = np.arange(0, EPOCHS)
-plt.style.use("ggplot")
-plt.figure()
-plt.plot(N, loss, label="train_loss")
-plt.plot(N, val_Loss, label="val_loss")
-plt.title("Training Loss")
-plt.xlabel("Epoch #")
-plt.ylabel("Loss")
-plt.legend(loc="lower left")
-plt.savefig("losses.png")
+  N = np.arange(0, EPOCHS)
+  plt.style.use("ggplot")
+  plt.figure()
+  plt.plot(N, loss, label="train_loss")
+  plt.plot(N, val_Loss, label="val_loss")
+  plt.title("Training Loss")
+  plt.xlabel("Epoch #")
+  plt.ylabel("Loss")
+  plt.legend(loc="lower left")
+  plt.savefig("losses.png")
 
-print(loss)
+  print(loss)
 
-transformwe.summary()
+  transformwe.summary()
 
-print(dir(transformer.layers[2]))
\ No newline at end of file
+  print(dir(transformer.layers[2]))
\ No newline at end of file
@@ -1,10 +1,17 @@
 import tensorflow as tf
 import tensorflow_datasets as tfds
 import numpy
+import os
+import time
 import magenta.music as mm
 from magenta.models.music_vae.data import GrooveConverter
 from magenta.models.music_vae import configs
 from magenta.models.music_vae import data
+try:
+    from PythonFiles.midi_tensors import midi_to_tensors_op, note_sequence_to_tensors
+except ImportError:
+    # PythonFiles itself is on the path
+    from midi_tensors import midi_to_tensors_op, note_sequence_to_tensors
 tf.enable_eager_execution()
 
 #Load and process data
@@ -59,12 +66,10 @@ def get_dataset(config,is_training=False,cache_dataset=True):
         try_gcs=False
     )
 
-    def _tf_midi_to_notesequence(ex):
-        return tf.py_function(
-            lambda x:[mm.midi_to_note_sequence(x.numpy()).SerializeToString()],
-            inp = [ex['midi']],
-            Tout= tf.string,
-            name='midi_to_note_sequence')
+    # MIDI bytes -> converter tensors in one py_function (no NoteSequence
+    # SerializeToString/parse round-trip between two map stages)
+    def _tf_midi_to_tensors(ex):
+        return midi_to_tensors_op(ex['midi'], data_converter)
 
     def _remove_pad_fn(padded_seq_1, padded_seq_2, padded_seq_3, length):
         if length.shape.ndims == 0:
@@ -74,12 +79,8 @@ def get_dataset(config,is_training=False,cache_dataset=True):
             # Don't remove padding for hierarchical examples.
             return padded_seq_1, padded_seq_2, padded_seq_3, length
 
-    dataset = (dataset.map(
-        _tf_midi_to_notesequence,
-        num_parallel_calls=tf.data.experimental.AUTOTUNE))
-
     dataset = (dataset
-               .map(data_converter.tf_to_tensors,
+               .map(_tf_midi_to_tensors,
                     num_parallel_calls=tf.data.experimental.AUTOTUNE)
                .flat_map(lambda *t: tf.data.Dataset.from_tensor_slices(t))
                .map(_remove_pad_fn,
@@ -106,4 +107,103 @@ def get_input_output_tensors(dataset):
     inputs,outputs, ctrl, seqlen = next(dataset)
 
 
-    return inputs, outputs
\ No newline at end of file
+    return inputs, outputs
+
+
+#Single-parse fan-out: every MIDI is parsed once and converted by all configs
+
+FANOUT_CONFIGS = {
+    'config_2_bar': config_2_bar,
+    'config_tap_fixed_velocity': config_tap_fixed_velocity,
+    'config_tap_fixed_velocity_dropout': config_tap_fixed_velocity_dropout,
+    'configs_add_closed_hh': configs_add_closed_hh,
+    'configs_hit_control': configs_hit_control,
+}
+
+def get_fanout_dataset(config_names=None, is_training=False):
+    '''
+    One element per MIDI of the split: a dict from config name to that config's
+    (input_sequence, output_sequence, control_sequence, sequence_length) windows,
+    each with a leading window dimension. The MIDI is parsed into a NoteSequence
+    once and every config's data_converter runs on that same NoteSequence, instead
+    of one tfds.load + parse per config. All configs must share the TFDS dataset.
+    '''
+    config_names = list(config_names or FANOUT_CONFIGS)
+    selected = [FANOUT_CONFIGS[name] for name in config_names]
+    tfds_names = set(config.tfds_name for config in selected)
+    assert len(tfds_names) == 1, 'configs read different TFDS datasets: {}'.format(tfds_names)
+    for config in selected:
+        config.data_converter.set_mode('train' if is_training else 'eval')
+
+    dataset = tfds.load(
+        tfds_names.pop(),
+        split=tfds.Split.TRAIN if is_training else tfds.Split.VALIDATION,
+        shuffle_files=is_training,
+        try_gcs=False
+    )
+
+    def _convert_all(midi):
+        note_sequence = mm.midi_to_note_sequence(midi.numpy())
+        outputs = []
+        for config in selected:
+            outputs += note_sequence_to_tensors(note_sequence, config.data_converter)
+        return outputs
+
+    def _fanout(ex):
+        flat = tf.py_function(
+            _convert_all,
+            inp = [ex['midi']],
+            Tout = [dtype for config in selected for dtype in (
+                tf.as_dtype(config.data_converter.input_dtype),
+                tf.as_dtype(config.data_converter.output_dtype),
+                tf.as_dtype(config.data_converter.control_dtype), tf.int32)],
+            name='midi_to_all_configs')
+        per_config = {}
+        for i, (name, config) in enumerate(zip(config_names, selected)):
+            converter = config.data_converter
+            inputs, outputs, controls, lengths = flat[4 * i:4 * i + 4]
+            inputs.set_shape([None, None, converter.input_depth])
+            outputs.set_shape([None, None, converter.output_depth])
+            controls.set_shape([None, None, converter.control_depth])
+            lengths.set_shape([None])
+            per_config[name] = (inputs, outputs, controls, lengths)
+        return per_config
+
+    return dataset.map(_fanout, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+def select_config(fanout_dataset, config_name):
+    '''
+    The windows of one config of a get_fanout_dataset, one element per window,
+    as in get_dataset before batching
+    '''
+    return fanout_dataset.flat_map(
+        lambda per_config: tf.data.Dataset.from_tensor_slices(per_config[config_name]))
+
+def save_fanout_arrays(output_dir, config_names=None, is_training=False):
+    '''
+    Converts a split for all configs in a single pass and writes one
+    <output_dir>/<config name>.npz per config. source[i] is the index of the
+    MIDI that window i came from, which aligns the windows across configs.
+    '''
+    config_names = list(config_names or FANOUT_CONFIGS)
+    os.makedirs(output_dir, exist_ok=True)
+    collected = {name: ([], [], [], [], []) for name in config_names}
+
+    start = time.time()
+    for index, per_config in enumerate(tfds.as_numpy(get_fanout_dataset(config_names, is_training))):
+        for name in config_names:
+            if not len(per_config[name][3]):
+                continue
+            for arrays, value in zip(collected[name], per_config[name]):
+                arrays.append(value)
+            collected[name][4].append(numpy.full(len(per_config[name][3]), index, dtype=numpy.int64))
+
+    for name, (inputs, outputs, controls, lengths, source) in collected.items():
+        if not lengths:
+            continue
+        # Windows of one config all have the same length for the 2-bar GrooVAE configs
+        numpy.savez(os.path.join(output_dir, name + '.npz'),
+                    inputs=numpy.concatenate(inputs), outputs=numpy.concatenate(outputs),
+                    controls=numpy.concatenate(controls), lengths=numpy.concatenate(lengths),
+                    source=numpy.concatenate(source))
+    tf.logging.info('Converted %d configs in %.1f secs', len(config_names), time.time() - start)
@@ -0,0 +1,170 @@
+import concurrent.futures
+import os
+import wave
+from typing import List, Optional
+
+import numpy as np
+
+from PythonFiles import groove_tokens as gt
+
+
+#######################################################################################
+#######################################################################################
+##################### SAMPLE-BASED DRUM RENDERER ######################################
+#######################################################################################
+#######################################################################################
+# Renders batches of grooves (token or hit arrays, optionally with velocities and
+# offsets) to audio by mixing one one-shot sample per drum voice, instead of going
+# through NoteSequence -> midi_synth/fluidsynth one sequence at a time.
+#
+# A sample directory holds one WAV per voice, named after groove_tokens.DRUM_VOICES
+# (kick.wav, snare.wav, closed_hh.wav, ...). Voices without a file stay silent.
+#
+#   bank = load_sample_bank("samples/")
+#   audio = render_batch(tokens, bank, bpm=120)            # (batch_size, n_samples)
+#   paths = render_to_files(tokens, "samples/", "output/audio", processes=16)
+
+SAMPLE_RATE = 44100
+
+
+def read_wav(path: str, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    '''
+    Reads a PCM WAV file as mono float32 in [-1, 1], linearly resampled to sample_rate
+    '''
+    with wave.open(path, "rb") as f:
+        n_channels, width, rate = f.getnchannels(), f.getsampwidth(), f.getframerate()
+        raw = f.readframes(f.getnframes())
+
+    if width == 1:
+        audio = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128.) / 128.
+    elif width == 3:
+        # 24 bit: place the 3 bytes in the top of an int32
+        data = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3)
+        padded = np.zeros((len(data), 4), dtype=np.uint8)
+        padded[:, 1:] = data
+        audio = padded.view("<i4").ravel().astype(np.float32) / 2 ** 31
+    else:
+        dtype = {2: "<i2", 4: "<i4"}[width]
+        audio = np.frombuffer(raw, dtype=dtype).astype(np.float32) / 2 ** (8 * width - 1)
+    audio = audio.reshape(-1, n_channels).mean(axis=1)
+
+    if rate != sample_rate:
+        n_out = int(round(len(audio) * sample_rate / rate))
+        audio = np.interp(np.arange(n_out) * rate / sample_rate, np.arange(len(audio)), audio).astype(np.float32)
+    return audio
+
+
+def write_wav(path: str, audio: np.ndarray, sample_rate: int = SAMPLE_RATE):
+    '''
+    Writes mono float audio in [-1, 1] as a 16-bit PCM WAV file
+    '''
+    pcm = (np.clip(audio, -1., 1.) * 32767).astype("<i2")
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(pcm.tobytes())
+
+
+def load_sample_bank(samples_dir: str, sample_rate: int = SAMPLE_RATE) -> List[np.ndarray]:
+    '''
+    Output:
+        (1) one float32 one-shot per voice of DRUM_VOICES (empty for missing files)
+    '''
+    bank = []
+    for voice in gt.DRUM_VOICES:
+        path = os.path.join(samples_dir, voice + ".wav")
+        bank.append(read_wav(path, sample_rate) if os.path.exists(path) else np.zeros(0, dtype=np.float32))
+    return bank
+
+
+def render_batch(grooves, bank: List[np.ndarray], velocities=None, offsets=None, bpm: float = 120.,
+                 sample_rate: int = SAMPLE_RATE, normalize: bool = True) -> np.ndarray:
+    '''
+    Mixes a batch of grooves with vectorized overlap-add
+
+    Inputs:
+        (1) grooves: (batch_size, steps) drum tokens or (batch_size, steps, >= NUM_VOICES) hits
+        (2) bank: per-voice samples from load_sample_bank
+        (3) velocities (opt): (batch_size, steps, NUM_VOICES) in [0, 1], 0.8 by default
+        (4) offsets (opt): (batch_size, steps, NUM_VOICES) timing offsets in [-0.5, 0.5] steps
+        (5) bpm (opt): tempo, one step is a 16th note
+        (6) normalize (opt): scale each groove to a peak of 0.9 (only grooves that would clip otherwise)
+
+    Output:
+        (1) float32 audio of shape (batch_size, n_samples), long enough for the
+                last hit to ring out
+    '''
+    grooves = np.asarray(grooves)
+    hits = gt.tokens_to_hits(grooves) if grooves.ndim == 2 else grooves[..., :gt.NUM_VOICES] > 0.5
+    batch_size, steps, _ = hits.shape
+    velocities = np.full(hits.shape, 0.8) if velocities is None else np.asarray(velocities)[..., :gt.NUM_VOICES]
+    offsets = np.zeros(hits.shape) if offsets is None else np.asarray(offsets)[..., :gt.NUM_VOICES]
+
+    samples_per_step = sample_rate * 60. / bpm / 4
+    tail = max(len(sample) for sample in bank)
+    n_samples = int(np.ceil((steps + 0.5) * samples_per_step)) + tail
+    n_fft = 1 << int(np.ceil(np.log2(n_samples)))
+
+    # Overlap-add of every hit is the convolution of a per-voice impulse train (one
+    # velocity-weighted impulse per onset) with the voice's sample, done for the whole
+    # batch at once in the frequency domain. Onsets are clipped to n_samples - tail,
+    # so every hit ends within n_samples <= n_fft and nothing wraps around.
+    spectrum = np.zeros((batch_size, n_fft // 2 + 1), dtype=np.complex128)
+    for voice, sample in enumerate(bank):
+        b, step = np.nonzero(hits[:, :, voice])
+        if len(sample) == 0 or len(b) == 0:
+            continue
+        onset = np.round((step + offsets[b, step, voice]) * samples_per_step).astype(np.int64)
+        onset = onset.clip(0, n_samples - tail)
+        impulses = np.bincount(b * n_fft + onset, weights=velocities[b, step, voice],
+                               minlength=batch_size * n_fft).reshape(batch_size, n_fft)
+        spectrum += np.fft.rfft(impulses, axis=1) * np.fft.rfft(sample, n_fft)
+
+    out = np.fft.irfft(spectrum, n_fft, axis=1)[:, :n_samples]
+    if normalize:
+        peak = np.abs(out).max(axis=1, keepdims=True)
+        out *= np.where(peak > 0.9, 0.9 / np.maximum(peak, 1e-9), 1.)
+    return out.astype(np.float32)
+
+
+_worker_bank = None
+
+
+def _init_worker(samples_dir: str, sample_rate: int):
+    global _worker_bank
+    _worker_bank = load_sample_bank(samples_dir, sample_rate)
+
+
+def _render_chunk(paths, grooves, velocities, offsets, bpm, sample_rate):
+    audio = render_batch(grooves, _worker_bank, velocities, offsets, bpm, sample_rate)
+    for path, groove_audio in zip(paths, audio):
+        write_wav(path, groove_audio, sample_rate)
+    return paths
+
+
+def render_to_files(grooves, samples_dir: str, output_dir: str, velocities=None, offsets=None,
+                    bpm: float = 120., sample_rate: int = SAMPLE_RATE, prefix: str = "groove",
+                    processes: Optional[int] = None, chunk_size: int = 64) -> List[str]:
+    '''
+    Renders a large batch to "<output_dir>/<prefix>_<index>.wav" across a process pool.
+    Every worker loads the sample bank once and renders chunk_size grooves per task.
+
+    Output:
+        (1) paths of the written files, in batch order
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    grooves = np.asarray(grooves)
+    paths = [os.path.join(output_dir, f"{prefix}_{i:05d}.wav") for i in range(len(grooves))]
+
+    def chunk(array, start):
+        return None if array is None else np.asarray(array)[start:start + chunk_size]
+
+    with concurrent.futures.ProcessPoolExecutor(processes, initializer=_init_worker,
+                                                initargs=(samples_dir, sample_rate)) as pool:
+        futures = [pool.submit(_render_chunk, paths[start:start + chunk_size], grooves[start:start + chunk_size],
+                               chunk(velocities, start), chunk(offsets, start), bpm, sample_rate)
+                   for start in range(0, len(grooves), chunk_size)]
+        for future in futures:
+            future.result()
+    return paths
@@ -0,0 +1,245 @@
+import collections
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from typing import Callable, Optional, Union
+
+import numpy as np
+
+
+#######################################################################################
+#######################################################################################
+##################### GENERATION RESULT CACHE #########################################
+#######################################################################################
+#######################################################################################
+# Two-tier cache of generated grooves: an in-process LRU in front of an on-disk store
+# shared by every process that points at the same directory. Entries are keyed by
+# cache_key, a hash of the input tokens, the model checkpoint and the decoding
+# parameters, and hold either generated tokens (np.ndarray) or MIDI bytes.
+#
+#   cache = GenerationCache("./generation_cache")
+#   key = cache_key(tokens, checkpoint, strategy="greedy")
+#   tokens = cache.get_or_compute(key, lambda: generate(tokens))
+#
+# Only deterministic generations should be cached: greedy decoding, or sampling with
+# an explicit seed (see is_cacheable).
+
+Value = Union[np.ndarray, bytes]
+
+# Temporary files older than this are left over from a crash mid-write
+STALE_TMP_SECS = 3600.
+
+
+def is_cacheable(strategy: str, temperature: float = 0., seed: Optional[int] = None) -> bool:
+    '''
+    Whether the same inputs always give the same output
+    '''
+    return strategy == "greedy" or temperature == 0 or seed is not None
+
+
+def cache_key(tokens, checkpoint: Optional[str], strategy: str = "greedy", temperature: float = 0.,
+              seed: Optional[int] = None, **params) -> str:
+    '''
+    Canonical hash of a generation request
+
+    Inputs:
+        (1) tokens: input drum tokens (any int array-like, hashed as int64)
+        (2) checkpoint: model checkpoint id, e.g. the path of the restored checkpoint
+        (3) strategy, temperature, seed: decoding parameters
+        (4) params: anything else the output depends on (output format, bpm, ...)
+
+    Output:
+        (1) hex sha256 digest
+    '''
+    tokens = np.ascontiguousarray(tokens, dtype="<i8")
+    header = json.dumps({"checkpoint": checkpoint, "strategy": strategy, "temperature": float(temperature),
+                         "seed": seed, "shape": tokens.shape, "params": params}, sort_keys=True)
+    digest = hashlib.sha256(header.encode())
+    digest.update(tokens.tobytes())
+    return digest.hexdigest()
+
+
+def _encode(value: Value) -> bytes:
+    if isinstance(value, bytes):
+        return b"B" + value
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(value), allow_pickle=False)
+    return b"N" + buffer.getvalue()
+
+
+def _decode(data: bytes) -> Value:
+    if data[:1] == b"B":
+        return data[1:]
+    return np.load(io.BytesIO(data[1:]), allow_pickle=False)
+
+
+class GenerationCache(object):
+    '''
+    Inputs:
+        (1) cache_dir (opt): on-disk store, memory only when None
+        (2) max_memory_bytes (opt): size of the in-process LRU
+        (3) max_disk_bytes (opt): size of the on-disk store, oldest entries go first
+        (4) max_age_secs (opt): entries older than this are misses and get removed
+
+    get/put/get_or_compute are thread-safe. stats() returns the hit/miss counters.
+    '''
+    def __init__(self, cache_dir: Optional[str] = None, max_memory_bytes: int = 64 << 20,
+                 max_disk_bytes: int = 1 << 30, max_age_secs: Optional[float] = None):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.max_age_secs = max_age_secs
+
+        self._memory = collections.OrderedDict()  # key -> (value, nbytes, written)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+
+        self._disk_bytes = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._disk_bytes = sum(size for _, size, _ in self._disk_entries())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".bin")
+
+    def _expired(self, written: float) -> bool:
+        return self.max_age_secs is not None and time.time() - written > self.max_age_secs
+
+    def _disk_entries(self, suffix: str = ".bin"):
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(suffix):
+                    stat = entry.stat()
+                    yield entry.path, stat.st_size, stat.st_mtime
+
+    ##### In-process tier
+
+    def _remember(self, key: str, value: Value, written: float):
+        nbytes = len(value) if isinstance(value, bytes) else value.nbytes
+        if nbytes > self.max_memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= self._memory.pop(key)[1]
+        self._memory[key] = (value, nbytes, written)
+        self._memory_bytes += nbytes
+        while self._memory_bytes > self.max_memory_bytes:
+            _, (_, evicted_bytes, _) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted_bytes
+            self.counters["memory_evictions"] += 1
+
+    ##### On-disk tier
+
+    def _read_disk(self, key: str):
+        path = self._path(key)
+        try:
+            written = os.path.getmtime(path)
+            if self._expired(written):
+                self._remove(path)
+                self.counters["expired"] += 1
+                return None
+            with open(path, "rb") as f:
+                return _decode(f.read()), written
+        except (OSError, ValueError):
+            # Missing, or removed/rewritten by another process in between
+            return None
+
+    def _write_disk(self, key: str, value: Value):
+        data = _encode(value)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(data)
+        try:
+            # Overwriting a key replaces its old file
+            self._disk_bytes -= os.path.getsize(path)
+        except OSError:
+            pass
+        os.replace(tmp, path)
+        self._disk_bytes += len(data)
+        if self._disk_bytes > self.max_disk_bytes:
+            self._evict_disk()
+
+    def _remove(self, path: str):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self._disk_bytes -= size
+        except OSError:
+            pass
+
+    def _evict_disk(self):
+        '''
+        Removes temporary files left behind by interrupted writes (older than
+        STALE_TMP_SECS, so writes in progress in other processes are kept), expired
+        entries, then the oldest ones down to 90% of max_disk_bytes. Sizes are
+        re-read from the directory, which other processes may share.
+        '''
+        now = time.time()
+        for path, _, written in list(self._disk_entries(".tmp")):
+            if now - written > STALE_TMP_SECS:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+        entries = sorted(self._disk_entries(), key=lambda entry: entry[2])
+        self._disk_bytes = sum(size for _, size, _ in entries)
+        target = 0.9 * self.max_disk_bytes
+        for path, size, written in entries:
+            if self._disk_bytes <= target and not self._expired(written):
+                break
+            self._remove(path)
+            self.counters["disk_evictions"] += 1
+
+    ##### Public interface
+
+    def get(self, key: str) -> Optional[Value]:
+        with self._lock:
+            if key in self._memory:
+                value, _, written = self._memory[key]
+                if not self._expired(written):
+                    self._memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return value
+                self._memory_bytes -= self._memory.pop(key)[1]
+                self.counters["expired"] += 1
+
+            found = self._read_disk(key) if self.cache_dir is not None else None
+            if found is None:
+                self.counters["misses"] += 1
+                return None
+            value, written = found
+            self._remember(key, value, written)
+            self.counters["disk_hits"] += 1
+            return value
+
+    def put(self, key: str, value: Value):
+        if not isinstance(value, bytes):
+            value = np.asarray(value)
+        with self._lock:
+            self._remember(key, value, time.time())
+            if self.cache_dir is not None:
+                self._write_disk(key, value)
+            self.counters["puts"] += 1
+
+    def get_or_compute(self, key: str, compute: Callable[[], Value]) -> Value:
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+            return dict(self.counters, lookups=lookups, hit_rate=hits / lookups if lookups else 0.,
+                        memory_entries=len(self._memory), memory_bytes=self._memory_bytes,
+                        disk_bytes=self._disk_bytes)
@@ -0,0 +1,124 @@
+from typing import Optional
+
+import numpy as np
+import tensorflow as tf
+
+from PythonFiles import groove_tokens as gt
+
+
+#######################################################################################
+#######################################################################################
+##################### IN-GRAPH GROOVE METRICS #########################################
+#######################################################################################
+#######################################################################################
+# Musically meaningful validation metrics computed on the packed tokens inside the
+# step function: tokens are unpacked into hit vectors with bit operations (the
+# in-graph equivalent of groove_tokens.tokens_to_hits) and only a few counters are
+# accumulated per batch, so nothing is converted back to NoteSequences.
+
+# Voices, by index in groove_tokens.DRUM_VOICES, that make up the F1 groups
+VOICE_GROUPS = {"kick": [0], "snare": [1], "hat": [2, 3]}
+
+
+def tokens_to_hits(tokens: tf.Tensor) -> tf.Tensor:
+    '''
+    (...,) int tokens -> (..., NUM_VOICES) float32 hits; reserved tokens have no hits
+    '''
+    tokens = tf.cast(tokens, tf.int64)
+    tokens = tf.where(tokens < gt.NUM_TOKENS, tokens, tf.zeros_like(tokens))
+    bits = tf.bitwise.right_shift(tokens[..., tf.newaxis], tf.range(gt.NUM_VOICES, dtype=tf.int64))
+    return tf.cast(tf.bitwise.bitwise_and(bits, 1), tf.float32)
+
+
+def _f1(tp, fp, fn):
+    return 2. * tp / np.maximum(2. * tp + fp + fn, 1.)
+
+
+class GrooveMetrics(tf.keras.metrics.Metric):
+    '''
+    Streaming per-voice hit confusion counts and hit density statistics of the
+    greedy (argmax) predictions
+
+    Inputs:
+        (1) to_token (opt): compact id -> token table (CompactVocabulary.to_token)
+                when the model works on a compact vocabulary
+        (2) name (opt)
+
+    update_state(y_true, y_pred, sample_weight=None) takes the target tokens/ids
+    (batch_size, seq_len) and the logits (batch_size, seq_len, vocab_size), like
+    SparseCategoricalAccuracy. result() returns a dict of scalars and report()
+    formats it for the end of an epoch.
+    '''
+    def __init__(self, to_token: Optional[np.ndarray] = None, name: str = 'groove_metrics', **kwargs):
+        super(GrooveMetrics, self).__init__(name=name, **kwargs)
+        self.to_token = None if to_token is None else tf.constant(to_token, dtype=tf.int64)
+
+        def counter(name, shape=()):
+            return self.add_weight(name, shape=shape, initializer='zeros')
+
+        self.true_positives = counter('true_positives', (gt.NUM_VOICES,))
+        self.false_positives = counter('false_positives', (gt.NUM_VOICES,))
+        self.false_negatives = counter('false_negatives', (gt.NUM_VOICES,))
+        self.predicted_hits = counter('predicted_hits')
+        self.target_hits = counter('target_hits')
+        self.density_abs_error = counter('density_abs_error')
+        self.sequences = counter('sequences')
+        self.steps = counter('steps')
+
+    def _hits(self, ids):
+        ids = tf.cast(ids, tf.int64)
+        return tokens_to_hits(ids if self.to_token is None else tf.gather(self.to_token, ids))
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        true_hits = self._hits(y_true)
+        pred_hits = self._hits(tf.argmax(y_pred, axis=-1))
+        if sample_weight is None:
+            weight = tf.ones_like(true_hits[..., 0])
+        else:
+            weight = tf.cast(sample_weight, tf.float32)
+        true_hits *= weight[..., tf.newaxis]
+        pred_hits *= weight[..., tf.newaxis]
+
+        self.true_positives.assign_add(tf.reduce_sum(true_hits * pred_hits, axis=[0, 1]))
+        self.false_positives.assign_add(tf.reduce_sum((1. - true_hits) * pred_hits, axis=[0, 1]))
+        self.false_negatives.assign_add(tf.reduce_sum(true_hits * (1. - pred_hits), axis=[0, 1]))
+
+        # Hits per step of every sequence
+        steps = tf.maximum(tf.reduce_sum(weight, axis=1), 1.)
+        true_density = tf.reduce_sum(true_hits, axis=[1, 2]) / steps
+        pred_density = tf.reduce_sum(pred_hits, axis=[1, 2]) / steps
+        self.predicted_hits.assign_add(tf.reduce_sum(pred_hits))
+        self.target_hits.assign_add(tf.reduce_sum(true_hits))
+        self.density_abs_error.assign_add(tf.reduce_sum(tf.abs(pred_density - true_density)))
+        self.sequences.assign_add(tf.cast(tf.shape(weight)[0], tf.float32))
+        self.steps.assign_add(tf.reduce_sum(weight))
+
+    def result(self):
+        tp, fp, fn = self.true_positives, self.false_positives, self.false_negatives
+        results = {
+            'density_mae': self.density_abs_error / tf.maximum(self.sequences, 1.),
+            'predicted_density': self.predicted_hits / tf.maximum(self.steps, 1.),
+            'target_density': self.target_hits / tf.maximum(self.steps, 1.),
+        }
+        for group, voices in VOICE_GROUPS.items():
+            group_tp, group_fp, group_fn = (tf.reduce_sum(tf.gather(x, voices)) for x in (tp, fp, fn))
+            results[group + '_f1'] = 2. * group_tp / tf.maximum(2. * group_tp + group_fp + group_fn, 1.)
+        return results
+
+    def per_voice(self):
+        '''
+        Precision, recall and F1 of every voice in DRUM_VOICES as NumPy arrays
+        '''
+        tp, fp, fn = (x.numpy() for x in (self.true_positives, self.false_positives, self.false_negatives))
+        return {'precision': tp / np.maximum(tp + fp, 1.),
+                'recall': tp / np.maximum(tp + fn, 1.),
+                'f1': _f1(tp, fp, fn)}
+
+    def report(self) -> str:
+        results = {k: float(v) for k, v in self.result().items()}
+        lines = [' '.join('{} {:.4f}'.format(k, v) for k, v in results.items())]
+        per_voice = self.per_voice()
+        for i, voice in enumerate(gt.DRUM_VOICES):
+            lines.append('  {:<10} precision {:.4f} recall {:.4f} f1 {:.4f}'.format(
+                voice, per_voice['precision'][i], per_voice['recall'][i], per_voice['f1'][i]))
+        return '\n'.join(lines)
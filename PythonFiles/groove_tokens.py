@@ -0,0 +1,212 @@
+import struct
+from typing import Optional
+
+import numpy as np
+
+
+#######################################################################################
+#######################################################################################
+##################### DRUM TOKENS <-> HIT VECTORS #####################################
+#######################################################################################
+#######################################################################################
+# The Transformer in Code.py reads and predicts one token per 16th-note step. A token
+# packs the 9 GrooVAE hit channels of that step as a binary number
+# (see _binary_to_decimal_2 in Code.py): bit i is set when drum voice i is hit.
+# Everything here is plain NumPy so it can be used where TensorFlow is not installed.
+
+NUM_VOICES = 9
+NUM_TOKENS = 2 ** NUM_VOICES
+STEPS_PER_BAR = 16
+
+# Order of the hit channels in GrooveConverter (magenta's ROLAND_DRUM_PITCH_CLASSES)
+# and the General MIDI pitch used for each voice when writing MIDI.
+DRUM_VOICES = ["kick", "snare", "closed_hh", "open_hh", "low_tom", "mid_tom", "high_tom", "crash", "ride"]
+DRUM_PITCHES = [36, 38, 42, 46, 45, 48, 50, 49, 51]
+
+# Voice that tap inputs are written to
+TAP_VOICE = DRUM_VOICES.index("closed_hh")
+
+_BIT_WEIGHTS = 2 ** np.arange(NUM_VOICES, dtype=np.int64)
+
+
+def hits_to_tokens(hits) -> np.ndarray:
+    '''
+    Packs hit vectors into tokens
+
+    Inputs:
+        (1) hits: array of shape (..., steps, >= NUM_VOICES), values > 0.5 count as hits.
+                Extra channels (velocities, offsets) are ignored
+
+    Output:
+        (1) int64 tokens of shape (..., steps)
+    '''
+    hits = np.asarray(hits)[..., :NUM_VOICES] > 0.5
+    return hits.astype(np.int64) @ _BIT_WEIGHTS
+
+
+def tokens_to_hits(tokens) -> np.ndarray:
+    '''
+    Unpacks tokens into hit vectors. Tokens outside the drum range (the reserved
+    tokens above NUM_TOKENS - 1) decode to a step without hits.
+
+    Inputs:
+        (1) tokens: int array of shape (..., steps)
+
+    Output:
+        (1) float32 hits of shape (..., steps, NUM_VOICES)
+    '''
+    tokens = np.asarray(tokens, dtype=np.int64)
+    tokens = np.where((tokens >= 0) & (tokens < NUM_TOKENS), tokens, 0)
+    return ((tokens[..., np.newaxis] >> np.arange(NUM_VOICES)) & 1).astype(np.float32)
+
+
+def taps_to_tokens(taps, voice: int = TAP_VOICE) -> np.ndarray:
+    '''
+    Converts a tap pattern (one 0/1 flag per step) into tokens with every tap on a
+    single drum voice
+
+    Inputs:
+        (1) taps: array of shape (..., steps)
+        (2) voice (opt): index of the voice in DRUM_VOICES the taps are written to
+
+    Output:
+        (1) int64 tokens of shape (..., steps)
+    '''
+    return (np.asarray(taps) > 0.5).astype(np.int64) * (1 << voice)
+
+
+#######################################################################################
+#######################################################################################
+##################### HIT VECTORS -> MIDI BYTES #######################################
+#######################################################################################
+#######################################################################################
+
+TICKS_PER_BEAT = 480
+_TICKS_PER_STEP = TICKS_PER_BEAT // 4
+_NOTE_TICKS = _TICKS_PER_STEP // 2
+_DRUM_CHANNEL = 9
+
+
+def _var_len(value: int) -> bytes:
+    # MIDI variable-length quantity
+    out = [value & 0x7F]
+    value >>= 7
+    while value:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(reversed(out))
+
+
+def hits_to_midi_bytes(hits, velocities=None, offsets=None, bpm: float = 120.0) -> bytes:
+    '''
+    Writes one groove as a type 0 standard MIDI file on the drum channel,
+    without going through NoteSequence or a temporary file
+
+    Inputs:
+        (1) hits: array of shape (steps, NUM_VOICES)
+        (2) velocities (opt): same shape, in [0, 1]. Defaults to 0.8 for every hit
+        (3) offsets (opt): same shape, timing offset of each hit as a fraction of
+                a step in [-0.5, 0.5]
+        (4) bpm (opt): tempo, one step is a 16th note
+
+    Output:
+        (1) bytes of the .mid file
+    '''
+    hits = np.asarray(hits)[:, :NUM_VOICES] > 0.5
+    velocities = np.full(hits.shape, 0.8) if velocities is None else np.asarray(velocities)[:, :NUM_VOICES]
+    offsets = np.zeros(hits.shape) if offsets is None else np.asarray(offsets)[:, :NUM_VOICES]
+
+    events = []
+    for step, voice in zip(*np.nonzero(hits)):
+        start = max(0, int(round((step + offsets[step, voice]) * _TICKS_PER_STEP)))
+        velocity = int(np.clip(round(velocities[step, voice] * 127), 1, 127))
+        pitch = DRUM_PITCHES[voice]
+        events.append((start, 1, bytes([0x90 | _DRUM_CHANNEL, pitch, velocity])))
+        events.append((start + _NOTE_TICKS, 0, bytes([0x80 | _DRUM_CHANNEL, pitch, 0])))
+    # Note-offs sort before note-ons on the same tick
+    events.sort(key=lambda event: (event[0], event[1]))
+
+    tempo = int(round(60_000_000 / bpm))
+    track = bytearray(b"\x00\xFF\x51\x03" + tempo.to_bytes(3, "big"))
+    now = 0
+    for tick, _, message in events:
+        track += _var_len(tick - now) + message
+        now = tick
+    track += b"\x00\xFF\x2F\x00"
+
+    header = b"MThd" + struct.pack(">IHHH", 6, 0, 1, TICKS_PER_BEAT)
+    return header + b"MTrk" + struct.pack(">I", len(track)) + bytes(track)
+
+
+#######################################################################################
+#######################################################################################
+##################### COMPACT VOCABULARY ##############################################
+#######################################################################################
+#######################################################################################
+
+# The two ids after the drum tokens are reserved, as in Code.py's "512 + 2" vocab
+NUM_RESERVED = 2
+
+
+class CompactVocabulary:
+    '''
+    Remapping of the NUM_TOKENS drum tokens onto the ones that actually occur in
+    the corpus. Rare tokens are mapped to the kept token with the nearest hit vector
+    (Hamming distance, ties go to the more frequent token).
+
+    Compact id 0 is always token 0 (a step without hits), since the model also uses 0
+    as padding. The NUM_RESERVED reserved tokens follow the kept drum tokens.
+
+    Attributes:
+        to_compact: (NUM_TOKENS + NUM_RESERVED,) int64, token -> compact id
+        to_token: (size + NUM_RESERVED,) int64, compact id -> token
+        counts: (NUM_TOKENS,) corpus count of every drum token
+        size: number of kept drum tokens
+    '''
+    def __init__(self, to_compact: np.ndarray, to_token: np.ndarray, counts: np.ndarray):
+        self.to_compact = np.asarray(to_compact, dtype=np.int64)
+        self.to_token = np.asarray(to_token, dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.size = len(self.to_token) - NUM_RESERVED
+
+    @classmethod
+    def from_counts(cls, counts, min_count: int = 1, max_size: Optional[int] = None):
+        '''
+        Inputs:
+            (1) counts: (NUM_TOKENS,) occurrences of each token in the corpus
+            (2) min_count (opt): tokens seen fewer times are remapped
+            (3) max_size (opt): keep at most this many drum tokens
+        '''
+        counts = np.asarray(counts, dtype=np.int64)
+        by_frequency = [t for t in np.argsort(-counts, kind="stable") if t != 0 and counts[t] >= min_count]
+        kept = np.array([0] + by_frequency[:None if max_size is None else max_size - 1], dtype=np.int64)
+
+        kept_hits = tokens_to_hits(kept)
+        distances = (tokens_to_hits(np.arange(NUM_TOKENS))[:, np.newaxis, :] != kept_hits[np.newaxis]).sum(-1)
+        # argmin picks the first, i.e. most frequent, of equally near kept tokens
+        to_compact = np.argmin(distances, axis=1)
+        reserved = np.arange(len(kept), len(kept) + NUM_RESERVED)
+        to_compact = np.concatenate([to_compact, reserved])
+        to_token = np.concatenate([kept, NUM_TOKENS + np.arange(NUM_RESERVED)])
+        return cls(to_compact, to_token, counts)
+
+    def coverage(self) -> float:
+        '''
+        Fraction of corpus token occurrences that keep their exact token
+        '''
+        exact = self.to_token[self.to_compact[:NUM_TOKENS]] == np.arange(NUM_TOKENS)
+        return float(self.counts[exact].sum() / max(1, self.counts.sum()))
+
+    def encode(self, tokens) -> np.ndarray:
+        return self.to_compact[np.asarray(tokens, dtype=np.int64)]
+
+    def decode(self, ids) -> np.ndarray:
+        return self.to_token[np.asarray(ids, dtype=np.int64)]
+
+    def save(self, path: str):
+        np.savez(path, to_compact=self.to_compact, to_token=self.to_token, counts=self.counts)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as f:
+            return cls(f["to_compact"], f["to_token"], f["counts"])
@@ -1,7 +1,12 @@
 import os
+import shutil
+import tempfile
+import threading
+import contextlib
+from collections import OrderedDict
 import tensorflow as tf
 from six.moves import urllib
-from typing import List
+from typing import List, Optional
 
 from magenta.models.music_vae import TrainedModel, configs
 import midi_utils as mu
@@ -15,7 +20,13 @@ from magenta.protobuf.music_pb2 import NoteSequence
 #######################################################################################
 # Codes in this section come from chapter 4 (page 113-)
 
-def download_checkpoint(model_name: str, checkpoint_name: str, target_dir: str):
+# Optional local directory laid out like the magentadata bucket
+# (<mirror>/<model_name>/checkpoints/<checkpoint_name>), checked before downloading
+CHECKPOINT_MIRROR_DIR = os.environ.get("MAGENTA_CHECKPOINT_MIRROR")
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+def download_checkpoint(model_name: str, checkpoint_name: str, target_dir: str,
+                        mirror_dir: Optional[str] = None):
     '''
     Code Written by Alexandre DuBreuil
     Comments by BH
@@ -35,19 +46,141 @@ def download_checkpoint(model_name: str, checkpoint_name: str, target_dir: str):
                 examples: "tap2drum_2bar", "groovae_4bar", "groovae_2bar_humanize"
             
         (3) target_dir: directory to save model
+        (4) mirror_dir (opt): local mirror to copy from instead of downloading,
+                defaults to $MAGENTA_CHECKPOINT_MIRROR
+    
+    The checkpoint is streamed in DOWNLOAD_CHUNK_SIZE chunks to a ".part" file
+    that is renamed once complete, so an interrupted download is never mistaken
+    for a checkpoint. Every call writes its own ".part" file, so concurrent
+    downloads of the same checkpoint (e.g. ModelRegistry loading one config at
+    two batch sizes) each rename a complete copy.
     '''
     tf.gfile.MakeDirs(target_dir)
     checkpoint_target = os.path.join(target_dir, checkpoint_name)
-    if not os.path.exists(checkpoint_target):
-        response = urllib.request.urlopen(f"https://storage.googleapis.com/magentadata/models/" f"{model_name}/checkpoints/{checkpoint_name}")
-        data = response.read()
-        local_file = open(checkpoint_target, 'wb')
-        local_file.write(data)
-        local_file.close()
-        
+    if os.path.exists(checkpoint_target):
+        return
+
+    mirror_dir = mirror_dir or CHECKPOINT_MIRROR_DIR
+    mirrored = os.path.join(mirror_dir, model_name, "checkpoints", checkpoint_name) if mirror_dir else None
+    if mirrored and os.path.exists(mirrored):
+        source = open(mirrored, 'rb')
+    else:
+        source = urllib.request.urlopen(f"https://storage.googleapis.com/magentadata/models/" f"{model_name}/checkpoints/{checkpoint_name}")
+
+    fd, partial_target = tempfile.mkstemp(dir=target_dir, prefix=checkpoint_name + ".", suffix=".part")
+    try:
+        with source, os.fdopen(fd, 'wb') as local_file:
+            shutil.copyfileobj(source, local_file, DOWNLOAD_CHUNK_SIZE)
+        os.replace(partial_target, checkpoint_target)
+    except BaseException:
+        os.remove(partial_target)
+        raise
+
+
+class ModelRegistry:
+    '''
+    Process-wide cache of warm TrainedModel instances keyed by (config name, batch size)
+    
+    Building a TrainedModel means a graph build and a session restore, so models are
+    kept around and evicted least-recently-used first once the summed checkpoint
+    sizes exceed max_bytes. Different models load concurrently; concurrent requests
+    for the same model wait for the single load in progress. A model that is leased
+    while it gets evicted is only closed when its last lease is released.
+    
+    Inputs:
+        (1) max_bytes: memory cap, estimated from the checkpoint file sizes
+    '''
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._models = OrderedDict()  # key -> [model, nbytes, leases, evicted]
+        self._loading = {}  # key -> threading.Lock held while the model loads
+
+    def _load(self, name: str, batch_size: int):
+        checkpoint = name + ".tar"
+        download_checkpoint("music_vae", checkpoint, "bundles")
+        checkpoint_path = os.path.join("bundles", checkpoint)
+        model = TrainedModel(
+            # Removes the .lohl in some training checkpoints
+            # which shares the same config
+            configs.CONFIG_MAP[name.split(".")[0] if "." in name else name],
+            # The batch size changes the number of sequences
+            # to be run together
+            batch_size=batch_size,
+            checkpoint_dir_or_path=checkpoint_path)
+        return model, os.path.getsize(checkpoint_path)
 
+    def _acquire(self, key):
+        while True:
+            with self._lock:
+                if key in self._models:
+                    entry = self._models[key]
+                    self._models.move_to_end(key)
+                    entry[2] += 1
+                    return entry
+                load_lock = self._loading.setdefault(key, threading.Lock())
 
-def get_model(name: str):
+            with load_lock:
+                with self._lock:
+                    if key in self._models:
+                        continue
+                model, nbytes = self._load(*key)
+                with self._lock:
+                    entry = [model, nbytes, 1, False]
+                    self._models[key] = entry
+                    self._loading.pop(key, None)
+                    self._evict()
+                return entry
+
+    def _release(self, entry):
+        with self._lock:
+            entry[2] -= 1
+            close = entry[3] and entry[2] == 0
+        if close:
+            entry[0]._sess.close()
+
+    def _evict(self):
+        # Caller holds self._lock. The most recently used model always stays.
+        while len(self._models) > 1 and sum(e[1] for e in self._models.values()) > self.max_bytes:
+            _, entry = self._models.popitem(last=False)
+            entry[3] = True
+            if entry[2] == 0:
+                entry[0]._sess.close()
+
+    @contextlib.contextmanager
+    def lease(self, name: str, batch_size: int = 8):
+        '''
+        Context manager yielding the warm model for (name, batch_size), loading it
+        on first use. The model is not closed by eviction while leased.
+        '''
+        entry = self._acquire((name, batch_size))
+        try:
+            yield entry[0]
+        finally:
+            self._release(entry)
+
+    def get(self, name: str, batch_size: int = 8):
+        '''
+        Returns the warm model for callers that keep it without a lease. Its lease
+        is never released, so the model stays valid: eviction may drop it from the
+        registry but never closes its session.
+        '''
+        return self._acquire((name, batch_size))[0]
+
+    def clear(self):
+        with self._lock:
+            while self._models:
+                _, entry = self._models.popitem(last=False)
+                entry[3] = True
+                if entry[2] == 0:
+                    entry[0]._sess.close()
+
+
+MODEL_REGISTRY = ModelRegistry(
+    max_bytes=int(os.environ.get("MAGENTA_MODEL_CACHE_MB", "2048")) * (1 << 20))
+
+
+def get_model(name: str, batch_size: int = 8):
     '''
     Code Written by Alexandre DuBreuil
     Comments by BH
@@ -70,18 +203,13 @@ def get_model(name: str):
     
     Inputs:
         (1) name: model name
-        
+        (2) batch_size (opt): number of sequences run together
+    
+    Models are served from MODEL_REGISTRY, so repeated calls reuse the loaded model.
+    The returned model stays usable for as long as the caller keeps it; use
+    MODEL_REGISTRY.lease for models that eviction may close once released.
     '''                             
-    checkpoint = name + ".tar"
-    download_checkpoint("music_vae", checkpoint, "bundles")
-    return TrainedModel(
-        # Removes the .lohl in some training checkpoints
-        # which shares the same config
-        configs.CONFIG_MAP[name.split(".")[0] if "." in name else name],
-        # The batch size changes the number of sequences
-        # to be run together
-        batch_size=8,
-        checkpoint_dir_or_path=os.path.join("bundles", checkpoint))
+    return MODEL_REGISTRY.get(name, batch_size)
                                           
 
 def sample(model_name: str,num_steps_per_sample: int) -> List[NoteSequence]:
@@ -108,11 +236,13 @@ def sample(model_name: str,num_steps_per_sample: int) -> List[NoteSequence]:
         
     Output:
         (1) sample_sequences: List of generated (sampled) note sequences
-        
+    
+    The model is leased from MODEL_REGISTRY so concurrent calls share one warm
+    model and it can't be closed by eviction halfway through sampling.
     '''                                           
-    model = get_model(model_name)
-    # Uses the model to sample 2 sequences
-    sample_sequences = model.sample(n=2, length=num_steps_per_sample)
+    with MODEL_REGISTRY.lease(model_name) as model:
+        # Uses the model to sample 2 sequences
+        sample_sequences = model.sample(n=2, length=num_steps_per_sample)
     # Saves the midi and the plot in the sample folder
     mu.save_midi(sample_sequences, "sample", model_name)
     mu.save_plot(sample_sequences, "sample", model_name)
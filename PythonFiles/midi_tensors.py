@@ -0,0 +1,66 @@
+import numpy as np
+import tensorflow as tf
+import magenta.music as mm
+
+
+#######################################################################################
+#######################################################################################
+##################### FUSED MIDI -> CONVERTER TENSORS #################################
+#######################################################################################
+#######################################################################################
+# The input pipelines used to parse MIDI into a NoteSequence, serialize it to a
+# tf.string (SerializeToString) and hand it to convert_to_tensors_op, which parsed the
+# string straight back into a NoteSequence before running the data_converter. Here
+# both steps are one Python call on the MIDI bytes: the NoteSequence never leaves
+# Python and is never serialized.
+
+
+def pad_sequences(seqs, depth: int, dtype) -> np.ndarray:
+    '''
+    Stacks variable-length (length, depth) sequences into a zero-padded
+    (num_seqs, max_length, depth) array of dtype
+    '''
+    max_len = max([len(seq) for seq in seqs], default=0)
+    stacked = np.zeros((len(seqs), max_len, depth), dtype=dtype)
+    for i, seq in enumerate(seqs):
+        stacked[i, :len(seq)] = np.reshape(seq, (len(seq), depth))
+    return stacked
+
+
+def note_sequence_to_tensors(note_sequence, converter):
+    '''
+    Output:
+        (1) inputs, outputs, controls, lengths of converter.to_tensors as padded
+                NumPy arrays of the converter's dtypes (like convert_to_tensors_op)
+    '''
+    tensors = converter.to_tensors(note_sequence)
+    return (pad_sequences(tensors.inputs, converter.input_depth, converter.input_dtype),
+            pad_sequences(tensors.outputs, converter.output_depth, converter.output_dtype),
+            pad_sequences(tensors.controls, converter.control_depth, converter.control_dtype),
+            np.asarray(tensors.lengths, dtype=np.int32))
+
+
+def midi_to_tensors(midi: bytes, converter):
+    '''
+    MIDI file bytes -> converter tensors, without serializing the NoteSequence
+    '''
+    return note_sequence_to_tensors(mm.midi_to_note_sequence(midi), converter)
+
+
+def midi_to_tensors_op(midi: tf.Tensor, converter):
+    '''
+    tf.data stage replacing _tf_midi_to_notesequence + convert_to_tensors_op: one
+    py_function from the scalar tf.string of MIDI bytes to the converter tensors,
+    shaped like convert_to_tensors_op's outputs
+    '''
+    inputs, outputs, controls, lengths = tf.py_function(
+        lambda x: midi_to_tensors(x.numpy(), converter),
+        inp=[midi],
+        Tout=[tf.as_dtype(converter.input_dtype), tf.as_dtype(converter.output_dtype),
+              tf.as_dtype(converter.control_dtype), tf.int32],
+        name='midi_to_tensors')
+    inputs.set_shape([None, None, converter.input_depth])
+    outputs.set_shape([None, None, converter.output_depth])
+    controls.set_shape([None, None, converter.control_depth])
+    lengths.set_shape([None])
+    return inputs, outputs, controls, lengths
@@ -1,9 +1,17 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import os
+import io
 import time
+import base64
+import hashlib
+import functools
+from html import escape
+from collections import OrderedDict
 from typing import Union, List, Optional
 
+import numpy as np
+
 import tensorflow as tf
 # tfds works in both Eager and Graph modes
 tf.enable_eager_execution() #not needed in TF V2, as it is already the default
@@ -12,8 +20,17 @@ import magenta.music as mm
 
 from magenta.protobuf.music_pb2 import NoteSequence
 
+from magenta.models.music_vae.data import ROLAND_DRUM_PITCH_CLASSES
+
 from visual_midi import Plotter
 from pretty_midi import PrettyMIDI
+from PIL import Image, ImageDraw
+
+try:
+    from PythonFiles import groove_tokens as gt
+except ImportError:
+    # PythonFiles itself is on the path (import midi_utils)
+    import groove_tokens as gt
 
 from IPython.core.display import display, HTML
 from IPython.display import IFrame
@@ -101,13 +118,20 @@ def plot_midi_file(midi_filepath, width=1000, height=300,
         (1) IFrame object containing the interactive midi plot
     '''
      
+    # load the midi file into a PrettyMIDI object
+    pm = PrettyMIDI(midi_filepath)
+
+    return _plot_pretty_midi(pm, width=width, height=height,
+                             temp_folder=temp_folder, temp_filename=temp_filename)
+
+
+def _plot_pretty_midi(pm, width=1000, height=300,
+                      temp_folder="misc/pretty midi images/",
+                      temp_filename="temp"):
     # Create path if doesnt exist
     if not os.path.exists(temp_folder):
         os.makedirs(temp_folder)
-    
-    # load the midi file into a PrettyMIDI object (& remove midi if necessary)
-    pm = PrettyMIDI(midi_filepath)
-        
+
     # Create an interactive html midi Plotter 
     plotter = Plotter()
     html_path = temp_folder+temp_filename+".html"
@@ -162,7 +186,7 @@ def plot_note_seq(note_seq, width=1000, height=300,
     Written by BH
     
     This Function Plots a note sequence in a Jupyter Notebook. 
-    To do so, a temporary midi file of the the note_seq is generated. 
+    To do so, the note_seq is converted to a PrettyMIDI object in memory.
     Then using visual_midi and pretty_midi libraries and interactive 
     html plot (html_filename) of the midi file is generated in html_folder 
     and an IFrame object is returned
@@ -173,30 +197,182 @@ def plot_note_seq(note_seq, width=1000, height=300,
         (2) width, height (opt): width and height of IFrame
         (3) temp_folder (opt): folder to store the interactive html and (possibly) the midi
         (4) temp_filename (opt): filename of the interactive html and (possibly) the midi
-        (5) keep_midi (opt): Deletes temp midi if set to False
+        (5) keep_midi (opt): Also writes the note_seq to the temp midi if set to True
     
     Output:
         (1) IFrame object containing the interactive midi plot
     '''
-    # Create path if doesnt exist
-    if not os.path.exists(temp_folder):
-        os.makedirs(temp_folder)
-
-    # Convert note sequence to midi file
-    midi_path = temp_folder+temp_filename+".mid"
-    mm.sequence_proto_to_midi_file(note_seq, midi_path)  #export as a temporary midi file
-    
-    # load the midi file into a PrettyMIDI object 
-    pm = PrettyMIDI(midi_path)
+    # Convert note sequence to a PrettyMIDI object in memory
+    pm = mm.midi_io.note_sequence_to_pretty_midi(note_seq)
 
+    ifm = _plot_pretty_midi(pm, width=width, height=height, 
+                            temp_folder = temp_folder, 
+                            temp_filename = temp_filename)
     
-    ifm = plot_midi_file(midi_path, width=width, height=height, 
-                         temp_folder = temp_folder, 
-                         temp_filename = temp_filename)
-    
-    if not keep_midi:
-        os.remove(midi_path)
+    # The midi file is only written when it is kept
+    if keep_midi:
+        pm.write(temp_folder+temp_filename+".mid")
         
     return ifm
-    
-    
\ No newline at end of file
+
+
+#######################################################################################
+#######################################################################################
+##################### BATCHED PIANO-ROLL REPORTS ######################################
+#######################################################################################
+#######################################################################################
+# Drum piano rolls for many grooves at once, drawn with NumPy straight from
+# NoteSequences, token arrays or hit arrays (no midi or html file per groove), and
+# collected into one HTML report and/or one PNG.
+#
+#   piano_roll_report(grooves, html_path="report.html", png_path="report.png")
+
+_PITCH_TO_VOICE = {pitch: voice for voice, pitches in enumerate(ROLAND_DRUM_PITCH_CLASSES) for pitch in pitches}
+_VOICE_COLORS = np.array([[31, 119, 180], [214, 39, 40], [44, 160, 44], [23, 190, 207], [148, 103, 189],
+                          [140, 86, 75], [227, 119, 194], [255, 127, 14], [188, 189, 34]], dtype=np.float32)
+_CELL_WIDTH, _CELL_HEIGHT, _LABEL_WIDTH = 12, 12, 70
+
+# Rendered (image, PNG) pairs by content hash of the roll
+_ROLL_CACHE = OrderedDict()
+ROLL_CACHE_SIZE = 4096
+
+
+def note_seq_to_roll(note_seq: NoteSequence, steps: Optional[int] = None) -> np.ndarray:
+    '''
+    Quantizes the drum notes of a NoteSequence onto the 16th-note grid
+
+    Output:
+        (1) (steps, NUM_VOICES) float32 velocities in [0, 1]; pitches outside the
+                GrooVAE drum classes are dropped
+    '''
+    qpm = note_seq.tempos[0].qpm if note_seq.tempos else 120.
+    step_secs = 60. / qpm / 4
+    notes = [(note.start_time, _PITCH_TO_VOICE[note.pitch], note.velocity)
+             for note in note_seq.notes if note.pitch in _PITCH_TO_VOICE]
+    if steps is None:
+        steps = max(1, int(np.ceil(note_seq.total_time / step_secs - 0.5)))
+
+    roll = np.zeros((steps, gt.NUM_VOICES), dtype=np.float32)
+    if notes:
+        start, voice, velocity = (np.array(x) for x in zip(*notes))
+        step = np.round(start / step_secs).astype(np.int64)
+        keep = step < steps
+        np.maximum.at(roll, (step[keep], voice[keep]), velocity[keep] / 127.)
+    return roll
+
+
+def groove_to_roll(groove) -> np.ndarray:
+    '''
+    (steps, NUM_VOICES) velocities of a NoteSequence, (steps,) token array or
+    (steps, >= NUM_VOICES) hit array
+    '''
+    if isinstance(groove, NoteSequence):
+        return note_seq_to_roll(groove)
+    groove = np.asarray(groove)
+    hits = gt.tokens_to_hits(groove) if groove.ndim == 1 else groove[:, :gt.NUM_VOICES] > 0.5
+    return hits.astype(np.float32)
+
+
+@functools.lru_cache(maxsize=None)
+def _voice_labels() -> np.ndarray:
+    image = Image.new("RGB", (_LABEL_WIDTH, gt.NUM_VOICES * _CELL_HEIGHT), "white")
+    draw = ImageDraw.Draw(image)
+    for voice, name in enumerate(gt.DRUM_VOICES):
+        # Kick at the bottom, like a piano roll
+        draw.text((2, (gt.NUM_VOICES - 1 - voice) * _CELL_HEIGHT), name, fill=(60, 60, 60))
+    return np.asarray(image)
+
+
+def rasterize_roll(roll: np.ndarray) -> np.ndarray:
+    '''
+    Draws a (steps, NUM_VOICES) roll as an RGB uint8 image: voice labels on the left,
+    one cell per step and voice shaded by velocity, beat and bar lines
+    '''
+    steps = len(roll)
+    # (NUM_VOICES, steps, 3), kick in the last row
+    velocity = roll.T[::-1, :, np.newaxis]
+    background = np.where((np.arange(steps) // 4) % 2, 245., 255.)[np.newaxis, :, np.newaxis]
+    cells = background - velocity * (background - _VOICE_COLORS[::-1, np.newaxis, :])
+    image = np.repeat(np.repeat(cells, _CELL_HEIGHT, axis=0), _CELL_WIDTH, axis=1)
+
+    image[::_CELL_HEIGHT, :] = 225.
+    image[:, ::_CELL_WIDTH] = 225.
+    image[:, ::_CELL_WIDTH * 4] = 190.
+    image[:, ::_CELL_WIDTH * gt.STEPS_PER_BAR] = 90.
+    return np.concatenate([_voice_labels(), image.astype(np.uint8)], axis=1)
+
+
+def _png_bytes(image: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _render_roll(roll: np.ndarray):
+    '''
+    (rasterize_roll image, its PNG), cached by the content hash of the roll
+    '''
+    roll = np.ascontiguousarray(roll, dtype=np.float32)
+    key = hashlib.sha1(roll.tobytes() + str(roll.shape).encode()).hexdigest()
+    if key in _ROLL_CACHE:
+        _ROLL_CACHE.move_to_end(key)
+        return _ROLL_CACHE[key]
+    image = rasterize_roll(roll)
+    rendered = _ROLL_CACHE[key] = (image, _png_bytes(image))
+    if len(_ROLL_CACHE) > ROLL_CACHE_SIZE:
+        _ROLL_CACHE.popitem(last=False)
+    return rendered
+
+
+def roll_png(roll: np.ndarray) -> bytes:
+    '''
+    PNG of rasterize_roll, cached by the content hash of the roll
+    '''
+    return _render_roll(roll)[1]
+
+
+def piano_roll_report(grooves, names: Optional[List[str]] = None,
+                      html_path: Optional[str] = None, png_path: Optional[str] = None,
+                      columns: int = 4):
+    '''
+    One report for a batch of grooves
+
+    Inputs:
+        (1) grooves: list of NoteSequences, token arrays or hit arrays (see groove_to_roll),
+                or one (batch_size, steps) token / (batch_size, steps, NUM_VOICES) hit array
+        (2) names (opt): caption of every groove, defaults to its index
+        (3) html_path (opt): writes a single self-contained HTML page with every plot inlined
+        (4) png_path (opt): writes every plot into one PNG, columns plots per row
+        (5) columns (opt): plots per row of the HTML page and the PNG
+
+    Output:
+        (1) HTML object with the report, for display in a notebook
+    '''
+    rolls = [groove_to_roll(groove) for groove in grooves]
+    names = names or [str(i) for i in range(len(rolls))]
+
+    # Every roll is rasterized once (or not at all when cached), for both outputs
+    rendered = [_render_roll(roll) for roll in rolls]
+
+    figures = []
+    for name, roll, (_, png) in zip(names, rolls, rendered):
+        data = base64.b64encode(png).decode("ascii")
+        figures.append(f'<figure style="margin:4px"><img src="data:image/png;base64,{data}"/>'
+                       f'<figcaption>{escape(str(name))} ({int((roll > 0).sum())} hits)</figcaption></figure>')
+    html = (f'<div style="display:grid;grid-template-columns:repeat({columns},max-content);'
+            f'font-family:sans-serif;font-size:12px">{"".join(figures)}</div>')
+
+    if html_path:
+        with open(html_path, "w") as f:
+            f.write(f"<!DOCTYPE html><html><body>{html}</body></html>")
+    if png_path and rolls:
+        images = [image for image, _ in rendered]
+        height, width = images[0].shape[0] + 4, max(image.shape[1] for image in images) + 4
+        rows = -(-len(images) // columns)
+        sheet = np.full((rows * height, columns * width, 3), 255, dtype=np.uint8)
+        for i, image in enumerate(images):
+            top, left = (i // columns) * height, (i % columns) * width
+            sheet[top:top + image.shape[0], left:left + image.shape[1]] = image
+        with open(png_path, "wb") as f:
+            f.write(_png_bytes(sheet))
+    return HTML(html)
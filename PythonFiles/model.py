@@ -1,4 +1,5 @@
 import math
+import time
 import numpy as np
 import tensorflow as tf
 
@@ -193,22 +194,32 @@ def generate_data(batch_size: int, seq_len: int, vocab_size: int):
 
     inputs = np.random.randint(0, vocab_size, size=(batch_size, seq_len))
 
+    # Every second occurrence of a word within a row is replaced by the repeat token
+    same = inputs[:, :, np.newaxis] == inputs[:, np.newaxis, :]
+    earlier = np.tril(np.ones((seq_len, seq_len), dtype=bool), k=-1)
+    repeated = (same & earlier).sum(-1) % 2 == 1
+
     outputs = np.zeros((batch_size, seq_len + 1), dtype=int)
-    outputs[:, 1:] = np.flip(inputs, 1)
+    outputs[:, 1:] = np.flip(np.where(repeated, repeat_token, inputs), 1)
     outputs[:, 0] = start_token
 
-    for i in range(batch_size):
-        v = np.zeros(vocab_size, dtype=bool)
-        for j in range(seq_len):
-            word = inputs[i, j]
+    return inputs, outputs
 
-            if v[word]:
-                v[word] = False
-                outputs[i][seq_len - j] = repeat_token
-            else:
-                v[word] = True
 
-    return inputs, outputs
+def data_producer(batch_size: int, seq_len: int, vocab_size: int, prefetch: int = 16):
+    """
+    Infinite tf.data pipeline of generate_data batches; batches are produced in a
+    background thread while the previous steps run
+    """
+    def batches():
+        while True:
+            inputs, outputs = generate_data(batch_size, seq_len, vocab_size)
+            yield inputs.astype(np.int32), outputs.astype(np.int32)
+
+    dataset = tf.data.Dataset.from_generator(batches,
+                                             output_types=(tf.int32, tf.int32),
+                                             output_shapes=((batch_size, seq_len), (batch_size, seq_len + 1)))
+    return dataset.prefetch(prefetch)
 
 
 def noam_learning_rate(step: int, warm_up: float, d_model: int):
@@ -216,15 +227,18 @@ def noam_learning_rate(step: int, warm_up: float, d_model: int):
 
 
 def output_subsequent_mask(seq_len: int):
-    mask = np.zeros((seq_len, seq_len), dtype=float)
-    for i in range(seq_len):
-        for j in range(i + 1):
-            mask[i, j] = 1.
+    return np.tril(np.ones((seq_len, seq_len), dtype=float))
 
-    return mask
 
+def train(steps: int = 100_000, use_dataset: bool = True, data_fn=generate_data, log_every: int = 100):
+    """
+    Trains on the copy task and returns the steps per second
 
-def train():
+    With use_dataset, batches come from data_producer and the masks and learning
+    rate are graph constants/ops, so a step is a single session.run without
+    feed_dict. Otherwise every step feeds a data_fn batch and the masks through
+    placeholders.
+    """
     seq_length = 10
     vocab_size = 10 + 1 + 1
     vocab_str = [f"{i}" for i in range(10)]
@@ -237,20 +251,33 @@ def train():
     d_ff = 256  # 2048
     positional_encodings = generate_positional_encodings(d_model)
 
-    inputs = tf.placeholder(dtype=tf.int32,
-                            shape=(batch_size, seq_length), name="input")
-    outputs = tf.placeholder(dtype=tf.int32,
-                             shape=(batch_size, seq_length), name="output")
-    expected = tf.placeholder(dtype=tf.int32,
-                              shape=(batch_size, seq_length), name="expected")
-    inputs_mask = tf.placeholder(dtype=tf.float32,
-                                 shape=(1, 1, seq_length),
-                                 name="input_mask")
-    output_mask = tf.placeholder(dtype=tf.float32,
-                                 shape=(1, seq_length, seq_length),
-                                 name="output_mask")
-
-    learning_rate = tf.placeholder(dtype=tf.float32, name="learning_rate")
+    if use_dataset:
+        batch_in, batch_out = data_producer(batch_size, seq_length, vocab_size).make_one_shot_iterator().get_next()
+        inputs = batch_in
+        outputs = batch_out[:, :-1]
+        expected = batch_out[:, 1:]
+        inputs_mask = tf.ones((1, 1, seq_length), dtype=tf.float32, name="input_mask")
+        output_mask = tf.linalg.band_part(tf.ones((1, seq_length, seq_length), dtype=tf.float32), -1, 0,
+                                          name="output_mask")
+    else:
+        inputs = tf.placeholder(dtype=tf.int32,
+                                shape=(batch_size, seq_length), name="input")
+        outputs = tf.placeholder(dtype=tf.int32,
+                                 shape=(batch_size, seq_length), name="output")
+        expected = tf.placeholder(dtype=tf.int32,
+                                  shape=(batch_size, seq_length), name="expected")
+        inputs_mask = tf.placeholder(dtype=tf.float32,
+                                     shape=(1, 1, seq_length),
+                                     name="input_mask")
+        output_mask = tf.placeholder(dtype=tf.float32,
+                                     shape=(1, seq_length, seq_length),
+                                     name="output_mask")
+
+    # noam_learning_rate of global_step + 1, computed in the graph
+    warm_up = 400
+    global_step = tf.train.get_or_create_global_step()
+    step = tf.cast(global_step + 1, tf.float32)
+    learning_rate = (d_model ** -.5) * tf.minimum(step ** -.5, step * warm_up ** -1.5)
 
     w_embed, input_embeddings, output_embeddings = get_embeddings(inputs, outputs, vocab_size,
                                                                   d_model)
@@ -277,9 +304,8 @@ def train():
     params = tf.trainable_variables()
     grads, _ = tf.clip_by_global_norm(tf.gradients(loss, params), 5.)
     grads_and_vars = list(zip(grads, params))
-    train_op = adam.apply_gradients(grads_and_vars, name="apply_gradients")
+    train_op = adam.apply_gradients(grads_and_vars, global_step=global_step, name="apply_gradients")
 
-    warm_up = 400
     batch_in_mask = np.ones((1, 1, seq_length), dtype=float)
     batch_out_mask = output_subsequent_mask(seq_length)
     batch_out_mask = batch_out_mask.reshape(1, seq_length, seq_length)
@@ -290,24 +316,32 @@ def train():
     with tf.Session() as session:
         session.run(tf.global_variables_initializer())
 
-        for i in range(100_000):
-            lr = noam_learning_rate(i + 1, warm_up, d_model)
-            batch_in, batch_out = generate_data(batch_size, seq_length, vocab_size)
-            _, batch_loss, batch_res = session.run([train_op, loss, results],
-                                                   feed_dict={
-                                                       learning_rate: lr,
-                                                       inputs: batch_in,
-                                                       outputs: batch_out[:, :-1],
-                                                       expected: batch_out[:, 1:],
-                                                       inputs_mask: batch_in_mask,
-                                                       output_mask: batch_out_mask
-                                                   })
-
-            if i % 100 == 0:
+        start = time.time()
+        for i in range(steps):
+            log = log_every and i % log_every == 0
+            # The sample batch is only fetched back to the host on logging steps
+            fetches = [train_op, loss] + ([results, inputs, outputs, expected] if log else [])
+            if use_dataset:
+                feed_dict = None
+            else:
+                batch_in, batch_out = data_fn(batch_size, seq_length, vocab_size)
+                feed_dict = {
+                    inputs: batch_in,
+                    outputs: batch_out[:, :-1],
+                    expected: batch_out[:, 1:],
+                    inputs_mask: batch_in_mask,
+                    output_mask: batch_out_mask
+                }
+            fetched = session.run(fetches, feed_dict=feed_dict)
+
+            if log:
+                _, batch_loss, batch_res, sample_in, sample_out, sample_exp = fetched
                 print(f"step={i}\tloss={batch_loss: .6f}")
-                print(f"inp=  {__print_seq(batch_in[0])}")
-                print(f"exp={__print_seq(batch_out[0])}")
+                print(f"inp=  {__print_seq(sample_in[0])}")
+                print(f"exp={__print_seq(np.concatenate([sample_out[0, :1], sample_exp[0]]))}")
                 print(f"res=  {__print_seq(np.argmax(batch_res[0], -1))}")
 
+        return steps / (time.time() - start)
+
 if __name__ == '__main__':
     train()
\ No newline at end of file
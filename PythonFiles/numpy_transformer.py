@@ -0,0 +1,183 @@
+import json
+from typing import Dict, Optional
+
+import numpy as np
+
+
+#######################################################################################
+#######################################################################################
+##################### NUMPY TRANSFORMER RUNTIME #######################################
+#######################################################################################
+#######################################################################################
+# Inference-only re-implementation of Code.Transformer (full attention) on the
+# weights exported by export_numpy.py, for machines that should not import
+# TensorFlow, magenta or tensorflow_datasets. It follows Code.py operation for
+# operation: the same padding/look-ahead masks (token 0 is padding), the same
+# post-norm residual blocks and the same cached greedy decoding.
+#
+#   model = NumpyTransformer.load("transformer.npz")
+#   tokens = model.decode_tokens(model.greedy_decode(model.encode_tokens(inp)))
+
+LAYER_NORM_EPSILON = 1e-6
+
+
+def _softmax(x: np.ndarray) -> np.ndarray:
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def _layer_norm(x: np.ndarray, gamma: np.ndarray, beta: np.ndarray) -> np.ndarray:
+    mean = x.mean(axis=-1, keepdims=True)
+    variance = ((x - mean) ** 2).mean(axis=-1, keepdims=True)
+    return (x - mean) / np.sqrt(variance + LAYER_NORM_EPSILON) * gamma + beta
+
+
+def padding_mask(seq: np.ndarray) -> np.ndarray:
+    '''
+    (batch_size, seq_len) -> (batch_size, 1, 1, seq_len), 1. for padding (token 0)
+    '''
+    return (seq == 0).astype(np.float32)[:, np.newaxis, np.newaxis, :]
+
+
+def look_ahead_mask(size: int) -> np.ndarray:
+    return 1. - np.tril(np.ones((size, size), dtype=np.float32))
+
+
+class NumpyTransformer(object):
+    '''
+    Inputs:
+        (1) weights: arrays by name, as written by export_numpy.py
+        (2) config: num_layers, d_model, num_heads, dff, ... (the "config" entry)
+    '''
+    def __init__(self, weights: Dict[str, np.ndarray], config: dict):
+        self.w = weights
+        self.num_layers = config["num_layers"]
+        self.d_model = config["d_model"]
+        # Pruned models (prune.py, exported with export_numpy.py --pruned-dir) have
+        # fewer heads of the same depth, which the head count of every attention
+        # block is derived from
+        self.depth = self.d_model // config["num_heads"]
+        self.to_token = weights.get("vocab/to_token")
+        self.to_compact = weights.get("vocab/to_compact")
+
+    @classmethod
+    def load(cls, path: str) -> "NumpyTransformer":
+        with np.load(path, allow_pickle=False) as f:
+            weights = {name: f[name] for name in f.files if name != "config"}
+            config = json.loads(str(f["config"]))
+        return cls(weights, config)
+
+    ##### Building blocks
+
+    def _dense(self, x: np.ndarray, name: str) -> np.ndarray:
+        return x @ self.w[name + "/kernel"] + self.w[name + "/bias"]
+
+    def _split_heads(self, x: np.ndarray) -> np.ndarray:
+        batch_size, seq_len, heads_dim = x.shape
+        return x.reshape(batch_size, seq_len, heads_dim // self.depth, self.depth).transpose(0, 2, 1, 3)
+
+    def _project_kv(self, x: np.ndarray, name: str):
+        return self._split_heads(self._dense(x, name + "/wv")), self._split_heads(self._dense(x, name + "/wk"))
+
+    def _attend(self, q: np.ndarray, v_heads: np.ndarray, k_heads: np.ndarray, mask, name: str) -> np.ndarray:
+        q = self._split_heads(self._dense(q, name + "/wq"))
+        logits = q @ k_heads.transpose(0, 1, 3, 2) / np.sqrt(np.float32(self.depth))
+        if mask is not None:
+            logits = logits + mask * -1e9
+        out = _softmax(logits) @ v_heads  # (batch_size, num_heads, seq_len_q, depth)
+        batch_size, _, seq_len, _ = out.shape
+        out = out.transpose(0, 2, 1, 3).reshape(batch_size, seq_len, -1)
+        return self._dense(out, name + "/dense")
+
+    def _ffn(self, x: np.ndarray, name: str) -> np.ndarray:
+        return self._dense(np.maximum(self._dense(x, name + "/ffn/0"), 0.), name + "/ffn/1")
+
+    def _embed(self, ids: np.ndarray, stack: str, offset: int = 0) -> np.ndarray:
+        x = self.w[stack + "/embedding"][ids] * np.sqrt(np.float32(self.d_model))
+        return x + self.w[stack + "/pos_encoding"][offset:offset + ids.shape[1]]
+
+    ##### Encoder / decoder
+
+    def encode(self, inp: np.ndarray) -> np.ndarray:
+        '''
+        (batch_size, inp_seq_len) ids -> (batch_size, inp_seq_len, d_model)
+        '''
+        mask = padding_mask(inp)
+        x = self._embed(inp, "encoder")
+        for i in range(self.num_layers):
+            name = "encoder/layer{}".format(i)
+            v, k = self._project_kv(x, name + "/mha")
+            out1 = _layer_norm(x + self._attend(x, v, k, mask, name + "/mha"),
+                               self.w[name + "/layernorm1/gamma"], self.w[name + "/layernorm1/beta"])
+            x = _layer_norm(out1 + self._ffn(out1, name),
+                            self.w[name + "/layernorm2/gamma"], self.w[name + "/layernorm2/beta"])
+        return x
+
+    def _decoder_layer(self, x, cache: dict, self_mask, enc_mask, i: int):
+        name = "decoder/layer{}".format(i)
+        v, k = self._project_kv(x, name + "/mha1")
+        cache["v"] = np.concatenate([cache["v"], v], axis=2) if "v" in cache else v
+        cache["k"] = np.concatenate([cache["k"], k], axis=2) if "k" in cache else k
+
+        out1 = _layer_norm(x + self._attend(x, cache["v"], cache["k"], self_mask, name + "/mha1"),
+                           self.w[name + "/layernorm1/gamma"], self.w[name + "/layernorm1/beta"])
+        out2 = _layer_norm(out1 + self._attend(out1, cache["enc_v"], cache["enc_k"], enc_mask, name + "/mha2"),
+                           self.w[name + "/layernorm2/gamma"], self.w[name + "/layernorm2/beta"])
+        return _layer_norm(out2 + self._ffn(out2, name),
+                           self.w[name + "/layernorm3/gamma"], self.w[name + "/layernorm3/beta"])
+
+    def init_cache(self, enc_output: np.ndarray) -> dict:
+        layers = []
+        for i in range(self.num_layers):
+            enc_v, enc_k = self._project_kv(enc_output, "decoder/layer{}/mha2".format(i))
+            layers.append({"enc_v": enc_v, "enc_k": enc_k})
+        return {"tokens": np.zeros((len(enc_output), 0), dtype=np.int64), "layers": layers}
+
+    def decode(self, tar: np.ndarray, cache: dict, enc_mask: np.ndarray) -> np.ndarray:
+        '''
+        Runs the decoder on the new ids tar (batch_size, new_len) after the ones in
+        cache, extending cache in place, and returns their logits
+        (batch_size, new_len, target_vocab_size)
+        '''
+        past = cache["tokens"].shape[1]
+        cache["tokens"] = np.concatenate([cache["tokens"], tar], axis=1)
+        total = cache["tokens"].shape[1]
+        self_mask = np.maximum(padding_mask(cache["tokens"]), look_ahead_mask(total)[past:, :])
+
+        x = self._embed(tar, "decoder", offset=past)
+        for i, layer_cache in enumerate(cache["layers"]):
+            x = self._decoder_layer(x, layer_cache, self_mask, enc_mask, i)
+        return self._dense(x, "final_layer")
+
+    def __call__(self, inp: np.ndarray, tar: np.ndarray) -> np.ndarray:
+        '''
+        Logits of Code.transformer(inp, tar, False, *Code.create_masks(inp, tar))
+        '''
+        inp, tar = np.asarray(inp, dtype=np.int64), np.asarray(tar, dtype=np.int64)
+        return self.decode(tar, self.init_cache(self.encode(inp)), padding_mask(inp))
+
+    def greedy_decode(self, inp: np.ndarray, max_len: Optional[int] = None,
+                      start: Optional[np.ndarray] = None) -> np.ndarray:
+        '''
+        Batched greedy decoding with cached keys/values, as Code.greedy_decode
+
+        Output:
+            (1) (batch_size, max_len) int64 ids
+        '''
+        inp = np.asarray(inp, dtype=np.int64)
+        max_len = max_len or inp.shape[1]
+        next_token = (inp[:, :1] if start is None else np.asarray(start, dtype=np.int64)[:, np.newaxis])
+        enc_mask = padding_mask(inp)
+        cache = self.init_cache(self.encode(inp))
+        for _ in range(max_len - 1):
+            logits = self.decode(next_token, cache, enc_mask)
+            next_token = np.argmax(logits[:, -1:], axis=-1)
+        return np.concatenate([cache["tokens"], next_token], axis=1)
+
+    ##### Compact vocabulary (see groove_tokens.CompactVocabulary)
+
+    def encode_tokens(self, tokens: np.ndarray) -> np.ndarray:
+        return tokens if self.to_compact is None else self.to_compact[np.asarray(tokens, dtype=np.int64)]
+
+    def decode_tokens(self, ids: np.ndarray) -> np.ndarray:
+        return ids if self.to_token is None else self.to_token[np.asarray(ids, dtype=np.int64)]
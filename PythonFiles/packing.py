@@ -0,0 +1,104 @@
+import functools
+
+import numpy as np
+import tensorflow as tf
+
+
+#######################################################################################
+#######################################################################################
+##################### SEQUENCE PACKING ################################################
+#######################################################################################
+#######################################################################################
+# Instead of padding every groove to the longest one of its batch, several grooves
+# are concatenated into each fixed-length row. Every token carries the id of the
+# groove (segment) it belongs to, 1, 2, ... within its row, 0 for the padding at the
+# end of the row, and its position within that groove, so that positional
+# encodings restart at 0 for every segment. Code.create_masks turns the segment ids
+# into attention masks that keep the segments of a row apart, and Code.target_mask
+# into the loss mask; padding no longer relies on token 0, which is also the
+# "no hits" step.
+#
+# Targets are packed into rows of length + 1 because the step functions shift them
+# by one (tar[:, :-1] / tar[:, 1:]); the prediction of a segment's last step from
+# the next segment's first one is masked out by target_mask.
+#
+#   dataset = pack_dataset(dataset, length=128)
+#   for inp, tar, inp_segments, tar_segments, inp_positions, tar_positions in dataset.batch(64): ...
+
+
+def pack_sequences(inputs, targets, input_lengths, target_lengths, length: int):
+    '''
+    Greedy first-fit packing of (input, target) pairs into rows
+
+    Inputs:
+        (1) inputs: (n, max_input_len) tokens, the first input_lengths[i] of row i are real
+        (2) targets: (n, max_target_len) tokens, the first target_lengths[i] of row i are real
+        (3) input_lengths, target_lengths: (n,) ints
+        (4) length: input row length (target rows are length + 1); longer
+                sequences are truncated
+
+    Output:
+        (1) inp (rows, length), tar (rows, length + 1) with the dtypes of inputs/targets
+        (2) inp_segments, tar_segments: int32 segment ids, 0 for padding
+        (3) inp_positions, tar_positions: int32 positions within the segment
+    '''
+    input_lengths = np.minimum(input_lengths, length)
+    target_lengths = np.minimum(target_lengths, length + 1)
+
+    # Fill of every open row: [input fill, target fill, segments]
+    rows = []
+    placement = []
+    for n_inp, n_tar in zip(input_lengths, target_lengths):
+        for row, fill in enumerate(rows):
+            if fill[0] + n_inp <= length and fill[1] + n_tar <= length + 1:
+                break
+        else:
+            row, fill = len(rows), [0, 0, 0]
+            rows.append(fill)
+        fill[2] += 1
+        placement.append((row, fill[0], fill[1], fill[2]))
+        fill[0] += n_inp
+        fill[1] += n_tar
+
+    n_rows = len(rows)
+    inp = np.zeros((n_rows, length), dtype=inputs.dtype)
+    tar = np.zeros((n_rows, length + 1), dtype=targets.dtype)
+    inp_segments = np.zeros(inp.shape, dtype=np.int32)
+    tar_segments = np.zeros(tar.shape, dtype=np.int32)
+    inp_positions = np.zeros(inp.shape, dtype=np.int32)
+    tar_positions = np.zeros(tar.shape, dtype=np.int32)
+    for i, (row, inp_start, tar_start, segment) in enumerate(placement):
+        n_inp, n_tar = input_lengths[i], target_lengths[i]
+        inp[row, inp_start:inp_start + n_inp] = inputs[i, :n_inp]
+        tar[row, tar_start:tar_start + n_tar] = targets[i, :n_tar]
+        inp_segments[row, inp_start:inp_start + n_inp] = segment
+        tar_segments[row, tar_start:tar_start + n_tar] = segment
+        inp_positions[row, inp_start:inp_start + n_inp] = np.arange(n_inp)
+        tar_positions[row, tar_start:tar_start + n_tar] = np.arange(n_tar)
+    return inp, tar, inp_segments, tar_segments, inp_positions, tar_positions
+
+
+def pack_dataset(dataset: tf.data.Dataset, length: int, window: int = 256) -> tf.data.Dataset:
+    '''
+    (inp, tar) elements of variable length -> packed rows
+    (inp, tar, inp_segments, tar_segments, inp_positions, tar_positions).
+    Every `window` consecutive elements are packed together, so a larger window
+    packs tighter at the cost of a longer delay before the first row.
+    '''
+    inp_spec, tar_spec = dataset.element_spec
+    dataset = dataset.map(lambda inp, tar: (inp, tar, tf.shape(inp)[0], tf.shape(tar)[0]),
+                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.padded_batch(window)
+
+    def _pack(inputs, targets, input_lengths, target_lengths):
+        packed = tf.numpy_function(
+            functools.partial(pack_sequences, length=length),
+            [inputs, targets, input_lengths, target_lengths],
+            [inp_spec.dtype, tar_spec.dtype] + [tf.int32] * 4,
+            name='pack_sequences')
+        for tensor, row_length in zip(packed, [length, length + 1] * 3):
+            tensor.set_shape([None, row_length])
+        return tuple(packed)
+
+    dataset = dataset.map(_pack, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dataset.unbatch()
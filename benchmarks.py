@@ -0,0 +1,371 @@
+"""
+Micro-benchmarks for the Transformer in Code.py.
+
+Every benchmark that measures peak memory runs each variant in a fresh
+subprocess, because the process high-water mark (ru_maxrss) never goes down.
+
+Usage:
+    python benchmarks.py attention-memory [--batch-size 64] [--seq-len 32]
+    python benchmarks.py xla-buckets [--batch-size 64] [--steps 20]
+    python benchmarks.py local-attention [--batch-size 16] [--steps 10]
+    python benchmarks.py model-input-pipeline [--steps 2000]
+    python benchmarks.py midi-to-tensors [--steps 500]
+    python benchmarks.py recompute [--seq-len 32] [--steps 10]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+
+def _peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _run_variant(benchmark: str, variant: str, args: argparse.Namespace, env: dict = None):
+    '''
+    Runs one variant of a benchmark in a child process and returns the JSON
+    line it prints. env is added to the child's environment.
+    '''
+    cmd = [sys.executable, __file__, benchmark, "--variant", variant,
+           "--batch-size", str(args.batch_size), "--seq-len", str(args.seq_len),
+           "--steps", str(args.steps)]
+    out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, universal_newlines=True,
+                         env=dict(os.environ, **(env or {}))).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def _print_table(rows):
+    keys = list(rows[0].keys())
+    print("\t".join(keys))
+    for row in rows:
+        print("\t".join(f"{row[k]:.2f}" if isinstance(row[k], float) else str(row[k]) for k in keys))
+
+
+#######################################################################################
+##################### DECODER ATTENTION WEIGHTS #######################################
+#######################################################################################
+
+def attention_memory_variant(variant: str, batch_size: int, seq_len: int, steps: int):
+    '''
+    Forward passes through Code.transformer in inference mode, either returning the
+    per-layer attention weights (the old behaviour) or not.
+
+    Output:
+        (1) dict with the peak RSS and mean step time of this variant
+    '''
+    import tensorflow as tf
+    import Code
+
+    return_attention_weights = variant == "with-attention"
+    inp = tf.random.uniform((batch_size, seq_len), 1, Code.input_vocab_size, dtype=tf.int64)
+    tar = tf.random.uniform((batch_size, seq_len), 1, Code.target_vocab_size, dtype=tf.int64)
+    enc_padding_mask, combined_mask, dec_padding_mask = Code.create_masks(inp, tar)
+
+    outputs = []
+    start = time.time()
+    for _ in range(steps):
+        # Keep the outputs alive like a caller collecting a batch of results would
+        outputs.append(Code.transformer(inp, tar, False, enc_padding_mask, combined_mask,
+                                        dec_padding_mask, return_attention_weights))
+    elapsed = time.time() - start
+
+    return {"variant": variant, "peak_rss_mb": _peak_rss_mb(), "step_ms": 1000. * elapsed / steps}
+
+
+def attention_memory(args: argparse.Namespace):
+    rows = [_run_variant("attention-memory", variant, args)
+            for variant in ("with-attention", "without-attention")]
+    _print_table(rows)
+
+
+#######################################################################################
+##################### XLA SEQUENCE-LENGTH BUCKETS #####################################
+#######################################################################################
+
+def xla_buckets_variant(variant: str, batch_size: int, seq_len: int, steps: int):
+    '''
+    Times Code.bucket_train_step on every bucket of Code.SEQ_LEN_BUCKETS. Whether the step
+    is XLA-compiled is decided by GROOVE_JIT_COMPILE, set by the parent process.
+
+    Output:
+        (1) list with compile (first call) and steady-state seconds per bucket
+    '''
+    import tensorflow as tf
+    import Code
+
+    timer = Code.BucketTimer(variant)
+    for bucket in Code.SEQ_LEN_BUCKETS:
+        inp = tf.random.uniform((batch_size, bucket), 1, Code.input_vocab_size, dtype=tf.int64)
+        tar = tf.random.uniform((batch_size, bucket), 1, Code.target_vocab_size, dtype=tf.int64)
+        tar_lengths = tf.fill([batch_size], bucket)
+        for _ in range(steps + 1):
+            timer(Code.bucket_train_step, inp, tar, tar_lengths)
+
+    return [{"bucket": bucket,
+             "compile_secs": timer.compile_secs[bucket],
+             "steady_secs": sum(timer.step_secs[bucket]) / len(timer.step_secs[bucket])}
+            for bucket in sorted(timer.compile_secs)]
+
+
+def xla_buckets(args: argparse.Namespace):
+    graph = _run_variant("xla-buckets", "graph", args, env={"GROOVE_JIT_COMPILE": "0"})
+    xla = _run_variant("xla-buckets", "xla", args, env={"GROOVE_JIT_COMPILE": "1"})
+    # Second XLA run starts with the persistent cache filled by the first one
+    # (TensorFlow 2.9 and later, see Code.XLA_PERSISTENT_CACHE)
+    xla_cached = _run_variant("xla-buckets", "xla", args, env={"GROOVE_JIT_COMPILE": "1"})
+
+    rows = []
+    for g, x, c in zip(graph, xla, xla_cached):
+        rows.append({"bucket": g["bucket"],
+                     "graph_ms": 1000 * g["steady_secs"],
+                     "xla_ms": 1000 * x["steady_secs"],
+                     "speedup": g["steady_secs"] / x["steady_secs"],
+                     "xla_compile_secs": x["compile_secs"],
+                     "cached_compile_secs": c["compile_secs"]})
+    _print_table(rows)
+
+
+#######################################################################################
+##################### LOCAL VS FULL ATTENTION #########################################
+#######################################################################################
+
+LOCAL_ATTENTION_SEQ_LENS = (32, 64, 128, 256, 512)
+
+
+def local_attention_variant(variant: str, batch_size: int, seq_len: int, steps: int):
+    '''
+    Peak RSS and train_step time at one sequence length. The attention variant
+    ('full' or 'local') is selected by GROOVE_ATTENTION, set by the parent process.
+    '''
+    import tensorflow as tf
+    import Code
+
+    inp = tf.random.uniform((batch_size, seq_len), 1, Code.input_vocab_size, dtype=tf.int64)
+    tar = tf.random.uniform((batch_size, seq_len + 1), 1, Code.target_vocab_size, dtype=tf.int64)
+    Code.train_step(inp, tar)
+    start = time.time()
+    for _ in range(steps):
+        Code.train_step(inp, tar)
+    elapsed = time.time() - start
+
+    return {"variant": variant, "seq_len": seq_len,
+            "peak_rss_mb": _peak_rss_mb(), "step_ms": 1000. * elapsed / steps}
+
+
+def local_attention(args: argparse.Namespace):
+    rows = []
+    for seq_len in LOCAL_ATTENTION_SEQ_LENS:
+        args.seq_len = seq_len
+        for variant in ("full", "local"):
+            rows.append(_run_variant("local-attention", variant, args, env={"GROOVE_ATTENTION": variant}))
+    _print_table(rows)
+
+
+#######################################################################################
+##################### MODEL.PY INPUT PIPELINE #########################################
+#######################################################################################
+
+def _generate_data_loops(batch_size: int, seq_len: int, vocab_size: int):
+    # The original per-element generate_data of PythonFiles/model.py, kept as the baseline
+    import numpy as np
+
+    start_token = vocab_size - 1
+    repeat_token = vocab_size - 2
+    vocab_size -= 2
+
+    inputs = np.random.randint(0, vocab_size, size=(batch_size, seq_len))
+    outputs = np.zeros((batch_size, seq_len + 1), dtype=int)
+    outputs[:, 1:] = np.flip(inputs, 1)
+    outputs[:, 0] = start_token
+    for i in range(batch_size):
+        v = np.zeros(vocab_size, dtype=bool)
+        for j in range(seq_len):
+            word = inputs[i, j]
+            if v[word]:
+                v[word] = False
+                outputs[i][seq_len - j] = repeat_token
+            else:
+                v[word] = True
+    return inputs, outputs
+
+
+def model_input_pipeline_variant(variant: str, batch_size: int, seq_len: int, steps: int):
+    '''
+    Steps per second of PythonFiles/model.py:train, with the looped generator and
+    feed_dict ("loops-feed-dict", the old loop), the vectorized generator and
+    feed_dict ("vectorized-feed-dict") or the tf.data producer ("dataset").
+    model.train uses its own batch size and sequence length.
+    '''
+    from PythonFiles import model
+
+    data_fn = _generate_data_loops if variant == "loops-feed-dict" else model.generate_data
+    steps_per_sec = model.train(steps=steps, use_dataset=variant == "dataset", data_fn=data_fn, log_every=0)
+    return {"variant": variant, "steps_per_sec": steps_per_sec}
+
+
+def model_input_pipeline(args: argparse.Namespace):
+    import numpy as np
+    from PythonFiles import model
+
+    for seed in range(10):
+        np.random.seed(seed)
+        expected = _generate_data_loops(32, 10, 12)
+        np.random.seed(seed)
+        actual = model.generate_data(32, 10, 12)
+        assert all(np.array_equal(e, a) for e, a in zip(expected, actual)), "generate_data changed its output"
+
+    rows = [_run_variant("model-input-pipeline", variant, args)
+            for variant in ("loops-feed-dict", "vectorized-feed-dict", "dataset")]
+    for row in rows:
+        row["speedup"] = row["steps_per_sec"] / rows[0]["steps_per_sec"]
+    _print_table(rows)
+
+
+#######################################################################################
+##################### MIDI TO CONVERTER TENSORS #######################################
+#######################################################################################
+
+def _midi_examples(count: int):
+    import tensorflow_datasets as tfds
+    from magenta.models.music_vae import configs
+
+    config = configs.CONFIG_MAP['groovae_2bar_humanize']
+    dataset = tfds.load(config.tfds_name, split=tfds.Split.VALIDATION, try_gcs=False).take(count)
+    return config.data_converter, [ex['midi'] for ex in tfds.as_numpy(dataset)]
+
+
+def midi_to_tensors_variant(variant: str, batch_size: int, seq_len: int, steps: int):
+    '''
+    Per-example CPU time and Python allocations of the MIDI -> converter tensors
+    stage over the first `steps` validation MIDIs, either with the NoteSequence
+    serialized and parsed back between two stages ("serialize-parse", the old
+    pipeline) or converted directly ("fused", midi_tensors.midi_to_tensors).
+    Allocations are traced with tracemalloc in a second pass so they do not slow
+    down the timed pass; protobuf's C++ allocations are not visible to it.
+    '''
+    import tracemalloc
+    import magenta.music as mm
+    from PythonFiles.midi_tensors import midi_to_tensors, note_sequence_to_tensors
+
+    converter, midis = _midi_examples(steps)
+    converter.set_mode('eval')
+    serialized_bytes = 0
+
+    def serialize_parse(midi):
+        nonlocal serialized_bytes
+        serialized = mm.midi_to_note_sequence(midi).SerializeToString()
+        serialized_bytes += len(serialized)
+        return note_sequence_to_tensors(converter.str_to_item_fn(serialized), converter)
+
+    convert = serialize_parse if variant == "serialize-parse" else lambda midi: midi_to_tensors(midi, converter)
+    for midi in midis[:10]:
+        convert(midi)
+
+    start = time.process_time()
+    for midi in midis:
+        convert(midi)
+    cpu_ms = (time.process_time() - start) * 1000. / len(midis)
+
+    tracemalloc.start()
+    peak = serialized_bytes = 0
+    for midi in midis:
+        tracemalloc.clear_traces()
+        convert(midi)
+        peak += tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"variant": variant, "examples": len(midis), "cpu_ms_per_example": cpu_ms,
+            "peak_kb_per_example": peak / 1024. / len(midis),
+            "serialized_kb_per_example": serialized_bytes / 1024. / len(midis)}
+
+
+def midi_to_tensors(args: argparse.Namespace):
+    import numpy as np
+    import magenta.music as mm
+    from PythonFiles.midi_tensors import midi_to_tensors, note_sequence_to_tensors
+
+    converter, midis = _midi_examples(20)
+    converter.set_mode('eval')
+    for midi in midis:
+        serialized = mm.midi_to_note_sequence(midi).SerializeToString()
+        expected = note_sequence_to_tensors(converter.str_to_item_fn(serialized), converter)
+        actual = midi_to_tensors(midi, converter)
+        assert all(e.dtype == a.dtype and np.array_equal(e, a) for e, a in zip(expected, actual)), \
+            "fused conversion changed its output"
+
+    rows = [_run_variant("midi-to-tensors", variant, args) for variant in ("serialize-parse", "fused")]
+    for row in rows:
+        row["cpu_saved_pct"] = 100. * (1. - row["cpu_ms_per_example"] / rows[0]["cpu_ms_per_example"])
+        row["peak_saved_pct"] = 100. * (1. - row["peak_kb_per_example"] / rows[0]["peak_kb_per_example"])
+    _print_table(rows)
+
+
+#######################################################################################
+##################### ACTIVATION REMATERIALIZATION ####################################
+#######################################################################################
+
+RECOMPUTE_BATCH_SIZES = (32, 64, 128, 256, 512)
+
+
+def recompute_variant(variant: str, batch_size: int, seq_len: int, steps: int):
+    '''
+    Peak RSS, train_step time and examples per second at one batch size. Which
+    layers recompute their activations is set by GROOVE_RECOMPUTE in the parent.
+    '''
+    import tensorflow as tf
+    import Code
+
+    inp = tf.random.uniform((batch_size, seq_len), 1, Code.input_vocab_size, dtype=tf.int64)
+    tar = tf.random.uniform((batch_size, seq_len + 1), 1, Code.target_vocab_size, dtype=tf.int64)
+    Code.train_step(inp, tar)
+    start = time.time()
+    for _ in range(steps):
+        Code.train_step(inp, tar)
+    elapsed = time.time() - start
+
+    return {"variant": variant, "batch_size": batch_size, "peak_rss_mb": _peak_rss_mb(),
+            "step_ms": 1000. * elapsed / steps, "examples_per_sec": batch_size * steps / elapsed}
+
+
+def recompute(args: argparse.Namespace):
+    rows = []
+    for batch_size in RECOMPUTE_BATCH_SIZES:
+        args.batch_size = batch_size
+        for variant, layers in (("stored", ""), ("recompute", "all")):
+            try:
+                rows.append(_run_variant("recompute", variant, args, env={"GROOVE_RECOMPUTE": layers}))
+            except subprocess.CalledProcessError:
+                # Most likely killed for running out of memory
+                rows.append({"variant": variant, "batch_size": batch_size, "peak_rss_mb": float("nan"),
+                             "step_ms": float("nan"), "examples_per_sec": float("nan")})
+    _print_table(rows)
+
+
+BENCHMARKS = {
+    "attention-memory": (attention_memory, attention_memory_variant),
+    "xla-buckets": (xla_buckets, xla_buckets_variant),
+    "local-attention": (local_attention, local_attention_variant),
+    "model-input-pipeline": (model_input_pipeline, model_input_pipeline_variant),
+    "midi-to-tensors": (midi_to_tensors, midi_to_tensors_variant),
+    "recompute": (recompute, recompute_variant),
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--variant", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--seq-len", type=int, default=32)
+    parser.add_argument("--steps", type=int, default=20)
+    args = parser.parse_args()
+
+    run_all, run_variant = BENCHMARKS[args.benchmark]
+    if args.variant is None:
+        run_all(args)
+    else:
+        print(json.dumps(run_variant(args.variant, args.batch_size, args.seq_len, args.steps)))
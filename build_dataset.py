@@ -0,0 +1,331 @@
+"""
+Resumable, incremental MIDI -> NoteSequence dataset builder.
+
+Replaces re-running `convert_dir_to_note_sequences --recursive` over the whole corpus.
+The output directory holds TFRecord shards of serialized NoteSequences and a
+manifest (manifest.sqlite) that maps every source file, by path, size, mtime and
+SHA-1, to the shard and byte offset of its record.
+
+* Only added or modified files are converted: files whose size and mtime match the
+  manifest are skipped, and files that were only touched (same hash) just get their
+  stat updated. Deleted files are dropped from the manifest.
+* Records are flushed and committed to the manifest every --commit-every files, so a
+  run that dies keeps all committed work and the next run carries on from there.
+  Bytes written after the last commit are never referenced and get reclaimed.
+* Replaced and deleted records leave dead bytes in their shards; a background thread
+  rewrites shards that are mostly dead (live records are copied byte for byte, no
+  re-conversion) and deletes the old ones.
+
+iterate_records / live_dataset read only the records the manifest points to.
+
+Usage:
+    python build_dataset.py build --input e-gmd-v1.0.0 --output data/notesequences [--processes 8]
+    python build_dataset.py compact --output data/notesequences
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+MANIFEST = "manifest.sqlite"
+SHARD_SUFFIX = ".tfrecord"
+# uint64 length + uint32 crc before the data, uint32 crc after it
+RECORD_OVERHEAD = 16
+MIDI_EXTENSIONS = (".mid", ".midi")
+
+
+def _connect(output_dir: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(os.path.join(output_dir, MANIFEST), timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                 "sha1 TEXT, shard TEXT, offset INTEGER, length INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS shards (name TEXT PRIMARY KEY, bytes INTEGER)")
+    conn.execute("CREATE INDEX IF NOT EXISTS files_shard ON files (shard)")
+    return conn
+
+
+def _sha1(path: str) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _convert(path: str, relative_path: str):
+    '''
+    Worker: one MIDI file -> serialized NoteSequence, None if it can't be parsed
+    '''
+    import magenta.music as mm
+    try:
+        sequence = mm.midi_file_to_note_sequence(path)
+    except Exception:
+        return None
+    sequence.filename = relative_path
+    sequence.id = hashlib.sha1(relative_path.encode()).hexdigest()
+    return sequence.SerializeToString()
+
+
+class ShardWriter:
+    '''
+    Appends records to shards of at most shard_bytes and reports where each one went.
+    Shards being written are listed in `active`, which the compactor leaves alone.
+    '''
+    def __init__(self, output_dir: str, shard_bytes: int, active: set, lock: threading.Lock):
+        import tensorflow as tf
+        self._tf = tf
+        self.output_dir = output_dir
+        self.shard_bytes = shard_bytes
+        self.active = active
+        self.lock = lock
+        self.prefix = "shard-{}-{}".format(time.strftime("%Y%m%d%H%M%S"), uuid.uuid4().hex[:8])
+        self.count = 0
+        self.writer = None
+        self.name = None
+        self.offset = 0
+        # Bytes written to every shard of this run, committed with the manifest rows
+        self.sizes = {}
+
+    def _open(self):
+        self.name = f"{self.prefix}-{self.count:05d}{SHARD_SUFFIX}"
+        self.count += 1
+        self.offset = 0
+        with self.lock:
+            self.active.add(self.name)
+        self.writer = self._tf.io.TFRecordWriter(os.path.join(self.output_dir, self.name))
+
+    def write(self, data: bytes):
+        if self.writer is None or self.offset >= self.shard_bytes:
+            self.close()
+            self._open()
+        self.writer.write(data)
+        location = (self.name, self.offset, len(data) + RECORD_OVERHEAD)
+        self.offset += len(data) + RECORD_OVERHEAD
+        self.sizes[self.name] = self.offset
+        return location
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            with self.lock:
+                self.active.discard(self.name)
+            self.writer = None
+
+
+def remove_unreferenced_shards(output_dir: str, conn: sqlite3.Connection, active: set = frozenset()):
+    '''
+    Deletes shard files the manifest doesn't know, left by runs that died before their first commit
+    '''
+    known = {name for (name,) in conn.execute("SELECT name FROM shards")}
+    for name in os.listdir(output_dir):
+        if name.endswith(SHARD_SUFFIX) and name not in known and name not in active:
+            os.remove(os.path.join(output_dir, name))
+
+
+def build(input_dir: str, output_dir: str, processes: int = None, commit_every: int = 64,
+          shard_bytes: int = 64 << 20, compact_every: float = 30., min_live_ratio: float = 0.5):
+    os.makedirs(output_dir, exist_ok=True)
+    conn = _connect(output_dir)
+    remove_unreferenced_shards(output_dir, conn)
+    known = {path: (size, mtime_ns, sha1) for path, size, mtime_ns, sha1
+             in conn.execute("SELECT path, size, mtime_ns, sha1 FROM files")}
+
+    # Classify the corpus against the manifest
+    seen, to_convert, touched = set(), [], []
+    for root, _, names in os.walk(input_dir):
+        for name in sorted(names):
+            if not name.lower().endswith(MIDI_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            relative_path = os.path.relpath(path, input_dir)
+            seen.add(relative_path)
+            stat = os.stat(path)
+            entry = known.get(relative_path)
+            if entry and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+                continue
+            sha1 = _sha1(path)
+            if entry and entry[2] == sha1:
+                touched.append((stat.st_size, stat.st_mtime_ns, relative_path))
+            else:
+                to_convert.append((path, relative_path, stat.st_size, stat.st_mtime_ns, sha1))
+    deleted = [(path,) for path in known if path not in seen]
+    with conn:
+        conn.executemany("UPDATE files SET size = ?, mtime_ns = ? WHERE path = ?", touched)
+        conn.executemany("DELETE FROM files WHERE path = ?", deleted)
+    print(f"{len(seen)} files: {len(to_convert)} to convert, {len(touched)} touched, {len(deleted)} deleted")
+
+    active, lock = set(), threading.Lock()
+    compactor = Compactor(output_dir, active, lock, compact_every, min_live_ratio)
+    compactor.start()
+    writer = ShardWriter(output_dir, shard_bytes, active, lock)
+
+    start, failed = time.time(), 0
+    try:
+        with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+            for begin in range(0, len(to_convert), commit_every):
+                chunk = to_convert[begin:begin + commit_every]
+                results = pool.map(_convert, [c[0] for c in chunk], [c[1] for c in chunk])
+                rows = []
+                for (_, relative_path, size, mtime_ns, sha1), data in zip(chunk, results):
+                    # Files that fail to parse are recorded without a shard, so they
+                    # are only retried once they change
+                    location = (None, None, None) if data is None else writer.write(data)
+                    failed += data is None
+                    rows.append((relative_path, size, mtime_ns, sha1) + location)
+
+                # Records reach the file before the manifest points at them
+                writer.flush()
+                with conn:
+                    conn.executemany("INSERT OR REPLACE INTO shards (name, bytes) VALUES (?, ?)",
+                                     list(writer.sizes.items()))
+                    conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                done = begin + len(chunk)
+                print(f"{done}/{len(to_convert)} converted ({done / (time.time() - start):.1f} files/s)")
+    finally:
+        writer.close()
+        compactor.stop()
+    if failed:
+        print(f"{failed} files could not be parsed")
+    compact(output_dir, min_live_ratio)
+
+
+#######################################################################################
+##################### COMPACTION ######################################################
+#######################################################################################
+
+def compact(output_dir: str, min_live_ratio: float = 0.5, active: set = frozenset(),
+            lock: threading.Lock = None) -> int:
+    '''
+    Rewrites every shard whose live records take less than min_live_ratio of it into
+    one new shard and deletes the old ones. Returns the number of bytes reclaimed.
+    '''
+    conn = _connect(output_dir)
+    rows = conn.execute("SELECT s.name, s.bytes, COALESCE(SUM(f.length), 0) FROM shards s "
+                        "LEFT JOIN files f ON f.shard = s.name GROUP BY s.name").fetchall()
+    if lock is not None:
+        with lock:
+            active = set(active)
+    candidates = [(name, total, live) for name, total, live in rows
+                  if name not in active and live < min_live_ratio * total]
+    if not candidates:
+        conn.close()
+        return 0
+
+    new_name = f"compact-{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}{SHARD_SUFFIX}"
+    moved, offset = [], 0
+    with open(os.path.join(output_dir, new_name), "wb") as out:
+        for name, _, _ in candidates:
+            records = conn.execute("SELECT path, offset, length FROM files WHERE shard = ? ORDER BY offset",
+                                   (name,)).fetchall()
+            with open(os.path.join(output_dir, name), "rb") as f:
+                for path, old_offset, length in records:
+                    # Framing and CRCs don't depend on the position, so records are copied as is
+                    f.seek(old_offset)
+                    out.write(f.read(length))
+                    moved.append((new_name, offset, path, name, old_offset))
+                    offset += length
+        out.flush()
+        os.fsync(out.fileno())
+
+    with conn:
+        conn.execute("INSERT INTO shards (name, bytes) VALUES (?, ?)", (new_name, offset))
+        # Records replaced by a concurrent build since they were read are left alone
+        conn.executemany("UPDATE files SET shard = ?, offset = ? WHERE path = ? AND shard = ? AND offset = ?", moved)
+        conn.executemany("DELETE FROM shards WHERE name = ? AND NOT EXISTS "
+                         "(SELECT 1 FROM files WHERE shard = ?)", [(name, name) for name, _, _ in candidates])
+    remaining = {name for (name,) in conn.execute("SELECT name FROM shards")}
+    conn.close()
+
+    reclaimed = 0
+    for name, total, live in candidates:
+        if name not in remaining:
+            os.remove(os.path.join(output_dir, name))
+            reclaimed += total - live
+    return reclaimed
+
+
+class Compactor(threading.Thread):
+    '''
+    Runs compact every `interval` seconds in the background of a build
+    '''
+    def __init__(self, output_dir: str, active: set, lock: threading.Lock, interval: float,
+                 min_live_ratio: float):
+        super(Compactor, self).__init__(daemon=True)
+        self.output_dir = output_dir
+        self.active = active
+        self.lock = lock
+        self.interval = interval
+        self.min_live_ratio = min_live_ratio
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            reclaimed = compact(self.output_dir, self.min_live_ratio, self.active, self.lock)
+            if reclaimed:
+                print(f"compaction reclaimed {reclaimed / 2 ** 20:.1f} MB")
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+#######################################################################################
+##################### READING #########################################################
+#######################################################################################
+
+def iterate_records(output_dir: str):
+    '''
+    Yields the serialized NoteSequence of every live manifest entry, shard by shard
+    '''
+    conn = _connect(output_dir)
+    rows = conn.execute("SELECT shard, offset, length FROM files WHERE shard IS NOT NULL "
+                        "ORDER BY shard, offset").fetchall()
+    conn.close()
+    f, current = None, None
+    try:
+        for shard, offset, length in rows:
+            if shard != current:
+                if f is not None:
+                    f.close()
+                f, current = open(os.path.join(output_dir, shard), "rb"), shard
+            f.seek(offset + RECORD_OVERHEAD - 4)
+            yield f.read(length - RECORD_OVERHEAD)
+    finally:
+        if f is not None:
+            f.close()
+
+
+def live_dataset(output_dir: str):
+    '''
+    tf.data.Dataset of serialized NoteSequences, e.g. for data_converter.tf_to_tensors
+    '''
+    import tensorflow as tf
+    return tf.data.Dataset.from_generator(lambda: iterate_records(output_dir), output_types=tf.string,
+                                          output_shapes=())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["build", "compact"])
+    parser.add_argument("--input", default="e-gmd-v1.0.0")
+    parser.add_argument("--output", default="data/notesequences")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--commit-every", type=int, default=64)
+    parser.add_argument("--shard-mb", type=int, default=64)
+    parser.add_argument("--compact-every", type=float, default=30., help="seconds between background compactions")
+    parser.add_argument("--min-live-ratio", type=float, default=0.5)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build(args.input, args.output, args.processes, args.commit_every, args.shard_mb << 20,
+              args.compact_every, args.min_live_ratio)
+    else:
+        print(f"reclaimed {compact(args.output, args.min_live_ratio) / 2 ** 20:.1f} MB")
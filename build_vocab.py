@@ -0,0 +1,84 @@
+"""
+Builds a compact drum-token vocabulary from corpus token frequencies.
+
+Counts every input and target token of the converted training split, keeps the
+tokens that occur at least --min-count times (at most --max-size of them) and maps
+the rest to the nearest kept hit vector. Train or serve with the result through
+GROOVE_VOCAB=<output>.
+
+Usage:
+    python build_vocab.py [--output vocab.npz] [--min-count 5] [--max-size 256]
+"""
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import Code
+from PythonFiles import groove_tokens as gt
+
+
+def count_tokens(config, batch_size: int = 64) -> np.ndarray:
+    '''
+    Occurrences of every drum token over the inputs and targets of the training split
+    '''
+    counts = np.zeros(gt.NUM_TOKENS, dtype=np.int64)
+    dataset = Code.initialize_dataset_as_iterator(config, batch_size, is_training=True)
+    for inp, tar in dataset:
+        for tokens in (inp.numpy(), tar.numpy()):
+            counts += np.bincount(tokens.ravel(), minlength=gt.NUM_TOKENS)[:gt.NUM_TOKENS]
+    return counts
+
+
+def vocab_dependent_params(vocab_size: int) -> int:
+    '''
+    Parameters that scale with the vocabulary: both Embedding tables and final_layer
+    '''
+    d_model = Code.d_model
+    return 2 * vocab_size * d_model + (d_model * vocab_size + vocab_size)
+
+
+def time_softmax(vocab_size: int, batch_size: int = 64, seq_len: int = 32, steps: int = 50) -> float:
+    '''
+    Mean milliseconds of the output projection plus softmax for one batch
+    '''
+    final_layer = tf.keras.layers.Dense(vocab_size)
+    x = tf.random.normal((batch_size, seq_len, Code.d_model))
+
+    @tf.function
+    def step(x):
+        return tf.nn.softmax(final_layer(x), axis=-1)
+
+    step(x)
+    start = time.time()
+    for _ in range(steps):
+        step(x).numpy()
+    return 1000. * (time.time() - start) / steps
+
+
+def report(vocab: gt.CompactVocabulary):
+    full_size, compact_size = gt.NUM_TOKENS + gt.NUM_RESERVED, vocab.size + gt.NUM_RESERVED
+    print(f"kept {vocab.size} of {gt.NUM_TOKENS} drum tokens, "
+          f"{100 * vocab.coverage():.2f}% of corpus steps keep their exact token")
+
+    full_params, compact_params = vocab_dependent_params(full_size), vocab_dependent_params(compact_size)
+    print(f"embedding + final_layer parameters: {full_params} -> {compact_params} "
+          f"({100 * (1 - compact_params / full_params):.1f}% fewer)")
+
+    full_ms, compact_ms = time_softmax(full_size), time_softmax(compact_size)
+    print(f"final_layer + softmax per batch: {full_ms:.2f} ms -> {compact_ms:.2f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default="vocab.npz")
+    parser.add_argument("--min-count", type=int, default=5)
+    parser.add_argument("--max-size", type=int, default=None)
+    args = parser.parse_args()
+
+    counts = count_tokens(Code.configs_add_closed_hh)
+    vocab = gt.CompactVocabulary.from_counts(counts, min_count=args.min_count, max_size=args.max_size)
+    vocab.save(args.output)
+    print(f"Saved vocabulary to {args.output}")
+    report(vocab)
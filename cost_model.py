@@ -0,0 +1,282 @@
+"""
+Analytic cost model of the Transformer in Code.py.
+
+For one configuration (num_layers, d_model, num_heads, dff, vocab size, attention
+variant), batch size and sequence lengths, walks the same structure as Code.py
+(embeddings, every EncoderLayer / DecoderLayer with its MultiHeadAttention blocks,
+point_wise_feed_forward_network and layer norms, final_layer and the loss) and
+reports per layer:
+
+    params        trainable parameters
+    fwd/bwd flops forward and backward floating point operations of one train step
+                  (a multiply-add counts as 2, the backward pass of a matmul as 2
+                  matmuls)
+    act_mb        activations kept for the backward pass, in MB (float32)
+
+and totals: peak training memory (weights, gradients, both Adam slots and all kept
+activations) and peak inference activations. Estimates only need Python, so
+configurations can be checked before they are run on a memory-limited node.
+
+`validate` trains a few sample configurations for a couple of steps, each in a fresh
+process, and compares the estimates with the measured step time (calibrated on the
+first configuration) and the growth of the process RSS.
+
+Usage:
+    python cost_model.py estimate [--num-layers 2] [--d-model 128] [--num-heads 8] [--dff 512]
+                                  [--batch-size 64] [--seq-len 32] [--attention full]
+    python cost_model.py validate [--steps 10]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+FLOAT_BYTES = 4
+# Code.py: 9-bit drum tokens plus 2 reserved ids
+DEFAULT_VOCAB_SIZE = 512 + 2
+# RelativeLocalAttention defaults of MultiHeadAttention
+LOCAL_WINDOW, LOCAL_GLOBAL = 16, 4
+
+VALIDATION_CONFIGS = [
+    # num_layers, d_model, num_heads, dff, batch_size, seq_len
+    (2, 128, 8, 512, 64, 32),
+    (4, 256, 8, 1024, 64, 32),
+    (2, 128, 8, 512, 64, 128),
+    (6, 512, 8, 2048, 32, 32),
+]
+
+
+class LayerCost:
+    def __init__(self, name: str, params: int = 0, fwd_flops: float = 0., bwd_flops: float = 0.,
+                 activations: float = 0., transient: float = 0.):
+        '''
+        activations: elements kept for the backward pass
+        transient: largest number of elements alive at once in inference
+        '''
+        self.name = name
+        self.params = params
+        self.fwd_flops = fwd_flops
+        self.bwd_flops = bwd_flops
+        self.activations = activations
+        self.transient = transient
+
+    def __iadd__(self, other):
+        self.params += other.params
+        self.fwd_flops += other.fwd_flops
+        self.bwd_flops += other.bwd_flops
+        self.activations += other.activations
+        self.transient = max(self.transient, other.transient)
+        return self
+
+
+def _dense(name, tokens, d_in, d_out):
+    flops = 2. * tokens * d_in * d_out
+    return LayerCost(name, d_in * d_out + d_out, flops, 2. * flops, tokens * d_out, tokens * (d_in + d_out))
+
+
+def _elementwise(name, elements, params=0, flops_per_element=5., kept=1.):
+    # layer norm, softmax, dropout, residual adds
+    flops = flops_per_element * elements
+    return LayerCost(name, params, flops, 2. * flops, kept * elements, 2. * elements)
+
+
+def attention_cost(name, batch_size, len_q, len_k, d_model, num_heads, keys_per_query=None):
+    '''
+    MultiHeadAttention: wq/wk/wv projections, scaled dot-product attention over
+    keys_per_query keys per query (len_k for full attention) and the output dense
+    '''
+    keys = len_k if keys_per_query is None else min(len_k, keys_per_query)
+    cost = LayerCost(name)
+    cost += _dense(name + ".wq", batch_size * len_q, d_model, d_model)
+    cost += _dense(name + ".wk", batch_size * len_k, d_model, d_model)
+    cost += _dense(name + ".wv", batch_size * len_k, d_model, d_model)
+
+    scores = batch_size * num_heads * len_q * keys
+    matmuls = 2. * 2. * scores * (d_model // num_heads)  # q.k and weights.v
+    # logits and softmax weights are both kept for the backward pass
+    cost += LayerCost(name + ".attention", 0, matmuls + 5. * scores, 2. * matmuls + 10. * scores,
+                      2. * scores + batch_size * len_q * d_model, 2. * scores)
+    cost += _dense(name + ".dense", batch_size * len_q, d_model, d_model)
+    return cost
+
+
+def ffn_cost(name, tokens, d_model, dff):
+    cost = LayerCost(name)
+    cost += _dense(name + ".0", tokens, d_model, dff)
+    cost += _dense(name + ".1", tokens, dff, d_model)
+    return cost
+
+
+def _residual_block(name, tokens, d_model):
+    # dropout (mask + output), residual add and LayerNormalization
+    return _elementwise(name, tokens * d_model, params=2 * d_model, flops_per_element=10., kept=3.)
+
+
+def estimate(num_layers: int, d_model: int, num_heads: int, dff: int, batch_size: int,
+             inp_len: int, tar_len: int, vocab_size: int = DEFAULT_VOCAB_SIZE, attention: str = 'full'):
+    '''
+    Output:
+        (1) list of LayerCost, one per embedding, encoder/decoder layer, final_layer and loss
+    '''
+    local = attention == 'local'
+    enc_keys = 3 * LOCAL_WINDOW + LOCAL_GLOBAL if local else None
+    dec_keys = 2 * LOCAL_WINDOW + LOCAL_GLOBAL if local else None
+    enc_tokens, dec_tokens = batch_size * inp_len, batch_size * tar_len
+
+    layers = [
+        _elementwise("encoder.embedding", enc_tokens * d_model, params=vocab_size * d_model, kept=3.),
+        _elementwise("decoder.embedding", dec_tokens * d_model, params=vocab_size * d_model, kept=3.),
+    ]
+    for i in range(num_layers):
+        layer = LayerCost(f"encoder.enc_layers[{i}]")
+        layer += attention_cost("mha", batch_size, inp_len, inp_len, d_model, num_heads, enc_keys)
+        layer += _residual_block("layernorm1", enc_tokens, d_model)
+        layer += ffn_cost("ffn", enc_tokens, d_model, dff)
+        layer += _residual_block("layernorm2", enc_tokens, d_model)
+        layers.append(layer)
+    for i in range(num_layers):
+        layer = LayerCost(f"decoder.dec_layers[{i}]")
+        layer += attention_cost("mha1", batch_size, tar_len, tar_len, d_model, num_heads, dec_keys)
+        layer += _residual_block("layernorm1", dec_tokens, d_model)
+        layer += attention_cost("mha2", batch_size, tar_len, inp_len, d_model, num_heads)
+        layer += _residual_block("layernorm2", dec_tokens, d_model)
+        layer += ffn_cost("ffn", dec_tokens, d_model, dff)
+        layer += _residual_block("layernorm3", dec_tokens, d_model)
+        layers.append(layer)
+
+    final = _dense("final_layer", dec_tokens, d_model, vocab_size)
+    final.name = "final_layer"
+    layers.append(final)
+    # Softmax cross-entropy keeps the softmax of every logit
+    layers.append(_elementwise("loss", dec_tokens * vocab_size, flops_per_element=5., kept=1.))
+    return layers
+
+
+def summarize(layers):
+    params = sum(layer.params for layer in layers)
+    activations = sum(layer.activations for layer in layers)
+    return {
+        "params": params,
+        "fwd_gflops": sum(layer.fwd_flops for layer in layers) / 1e9,
+        "bwd_gflops": sum(layer.bwd_flops for layer in layers) / 1e9,
+        # weights, gradients and the two Adam slots
+        "train_peak_mb": (4 * params + activations) * FLOAT_BYTES / 2 ** 20,
+        "inference_peak_mb": (params + max(layer.transient for layer in layers)) * FLOAT_BYTES / 2 ** 20,
+    }
+
+
+def _print_table(rows):
+    keys = list(rows[0].keys())
+    print("\t".join(keys))
+    for row in rows:
+        print("\t".join(f"{row[k]:.3f}" if isinstance(row[k], float) else str(row[k]) for k in keys))
+
+
+def report(args: argparse.Namespace):
+    layers = estimate(args.num_layers, args.d_model, args.num_heads, args.dff, args.batch_size,
+                      args.seq_len, args.seq_len, args.vocab_size, args.attention)
+    _print_table([{"layer": layer.name, "params": layer.params,
+                   "fwd_gflops": layer.fwd_flops / 1e9, "bwd_gflops": layer.bwd_flops / 1e9,
+                   "act_mb": layer.activations * FLOAT_BYTES / 2 ** 20} for layer in layers])
+    print()
+    for key, value in summarize(layers).items():
+        print(f"{key}: {value:.3f}" if isinstance(value, float) else f"{key}: {value}")
+
+
+#######################################################################################
+##################### VALIDATION ######################################################
+#######################################################################################
+
+def _rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def measure(args: argparse.Namespace):
+    '''
+    Child process: a few Code.py-style train steps of one configuration. Prints the
+    mean step time and how far the peak RSS rose above the RSS before the first step.
+    '''
+    import tensorflow as tf
+    import Code
+
+    transformer = Code.Transformer(args.num_layers, args.d_model, args.num_heads, args.dff,
+                                   args.vocab_size, args.vocab_size,
+                                   pe_input=Code.max_position_encoding, pe_target=Code.max_position_encoding,
+                                   rate=Code.dropout_rate, attention=args.attention)
+    optimizer = tf.keras.optimizers.Adam(Code.CustomSchedule(args.d_model), beta_1=0.9, beta_2=0.98, epsilon=1e-9)
+
+    @tf.function(input_signature=Code.train_step_signature)
+    def train_step(inp, tar):
+        tar_inp, tar_real = tar[:, :-1], tar[:, 1:]
+        enc_padding_mask, combined_mask, dec_padding_mask = Code.create_masks(inp, tar_inp)
+        with tf.GradientTape() as tape:
+            predictions, _ = transformer(inp, tar_inp, True, enc_padding_mask, combined_mask, dec_padding_mask)
+            loss = Code.loss_function(tar_real, predictions)
+        gradients = tape.gradient(loss, transformer.trainable_variables)
+        optimizer.apply_gradients(zip(gradients, transformer.trainable_variables))
+
+    inp = tf.random.uniform((args.batch_size, args.seq_len), 1, args.vocab_size, dtype=tf.int64)
+    tar = tf.random.uniform((args.batch_size, args.seq_len + 1), 1, args.vocab_size, dtype=tf.int64)
+    rss_before = _rss_mb()
+    train_step(inp, tar)
+    start = time.time()
+    for _ in range(args.steps):
+        train_step(inp, tar)
+    step_secs = (time.time() - start) / args.steps
+    # ru_maxrss is reported in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    print(json.dumps({"step_secs": step_secs, "rss_growth_mb": peak_rss - rss_before}))
+
+
+def validate(args: argparse.Namespace):
+    rows, flops_per_sec = [], None
+    for num_layers, d_model, num_heads, dff, batch_size, seq_len in VALIDATION_CONFIGS:
+        cmd = [sys.executable, __file__, "measure", "--num-layers", str(num_layers), "--d-model", str(d_model),
+               "--num-heads", str(num_heads), "--dff", str(dff), "--batch-size", str(batch_size),
+               "--seq-len", str(seq_len), "--vocab-size", str(args.vocab_size),
+               "--attention", args.attention, "--steps", str(args.steps)]
+        out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        measured = json.loads(out.strip().splitlines()[-1])
+
+        # The decoder input is tar[:, :-1], so both sides are seq_len long
+        summary = summarize(estimate(num_layers, d_model, num_heads, dff, batch_size, seq_len, seq_len,
+                                     args.vocab_size, args.attention))
+        train_flops = (summary["fwd_gflops"] + summary["bwd_gflops"]) * 1e9
+        # Throughput is calibrated on the first configuration
+        flops_per_sec = flops_per_sec or train_flops / measured["step_secs"]
+        predicted_secs = train_flops / flops_per_sec
+        rows.append({"config": f"{num_layers}x{d_model}x{num_heads}x{dff} b{batch_size} l{seq_len}",
+                     "step_ms": 1000 * measured["step_secs"],
+                     "predicted_ms": 1000 * predicted_secs,
+                     "time_ratio": measured["step_secs"] / predicted_secs,
+                     "rss_growth_mb": measured["rss_growth_mb"],
+                     "predicted_mb": summary["train_peak_mb"],
+                     "memory_ratio": measured["rss_growth_mb"] / summary["train_peak_mb"]})
+    print(f"calibrated throughput: {flops_per_sec / 1e9:.1f} GFLOP/s")
+    _print_table(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["estimate", "validate", "measure"])
+    parser.add_argument("--num-layers", type=int, default=2)
+    parser.add_argument("--d-model", type=int, default=128)
+    parser.add_argument("--num-heads", type=int, default=8)
+    parser.add_argument("--dff", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--seq-len", type=int, default=32)
+    parser.add_argument("--vocab-size", type=int, default=DEFAULT_VOCAB_SIZE)
+    parser.add_argument("--attention", choices=["full", "local"], default="full")
+    parser.add_argument("--steps", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == "estimate":
+        report(args)
+    elif args.command == "validate":
+        validate(args)
+    else:
+        measure(args)
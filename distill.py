@@ -0,0 +1,250 @@
+"""
+Knowledge distillation of a large teacher Transformer into small CPU-serving students.
+
+1. The frozen teacher (restored from --teacher-checkpoint) runs once over the training
+   split; per batch, the inputs and the teacher's top-k logits are cached under
+   --cache-dir, in a directory of their own per teacher spec, checkpoint,
+   vocabulary and attention. Later epochs and further students only read the cache.
+2. Each student is trained on
+       alpha * T^2 * CE(teacher softmax at T, student softmax at T)
+       + (1 - alpha) * Code.loss_function
+   over the cached batches.
+3. Teacher and students are evaluated on the validation split (accuracy) and timed
+   with Code.greedy_decode on CPU, so the student size can be picked against a latency SLO.
+
+Model specs are LAYERSxD_MODELxHEADSxDFF, e.g. 2x128x8x512 (the Code.py defaults).
+
+Usage:
+    python distill.py --teacher 6x512x8x2048 --teacher-checkpoint ./checkpoints/teacher \\
+        --student 2x128x4x256 --student 1x128x4x256 [--epochs 10] [--latency-slo-ms 50]
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import Code
+
+
+def parse_spec(spec: str):
+    num_layers, d_model, num_heads, dff = (int(x) for x in spec.lower().split("x"))
+    return num_layers, d_model, num_heads, dff
+
+
+def build_transformer(spec: str):
+    num_layers, d_model, num_heads, dff = parse_spec(spec)
+    return Code.Transformer(num_layers, d_model, num_heads, dff,
+                            Code.input_vocab_size, Code.target_vocab_size,
+                            pe_input=Code.max_position_encoding,
+                            pe_target=Code.max_position_encoding,
+                            rate=Code.dropout_rate,
+                            attention=Code.attention)
+
+
+def load_teacher(spec: str, checkpoint_dir: str):
+    teacher = build_transformer(spec)
+    checkpoint = tf.train.latest_checkpoint(checkpoint_dir)
+    assert checkpoint, f"no checkpoint in {checkpoint_dir}"
+    # The optimizer slots in Code.py's checkpoints are not needed here
+    tf.train.Checkpoint(transformer=teacher).restore(checkpoint).expect_partial()
+    print(f"Restored teacher from {checkpoint}")
+    return teacher
+
+
+def _forward(model, inp, tar_inp, training):
+    enc_padding_mask, combined_mask, dec_padding_mask = Code.create_masks(inp, tar_inp)
+    predictions, _ = model(inp, tar_inp, training, enc_padding_mask, combined_mask, dec_padding_mask)
+    return predictions
+
+
+#######################################################################################
+##################### SOFT TARGET CACHE ###############################################
+#######################################################################################
+
+def soft_target_dir(cache_dir: str, spec: str, checkpoint: str, top_k: int, batch_size: int) -> str:
+    '''
+    Directory under cache_dir for the soft targets of one teacher. It is named by a
+    hash of everything the cached logits depend on, which is also written to its
+    manifest.json, so a different teacher, checkpoint or GROOVE_VOCAB never reads
+    another teacher's logits.
+    '''
+    manifest = {"teacher": spec, "checkpoint": os.path.abspath(checkpoint), "attention": Code.attention,
+                "vocab": None if Code.vocab is None else hashlib.sha256(Code.vocab.to_token.tobytes()).hexdigest(),
+                "top_k": top_k, "batch_size": batch_size}
+    digest = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+    path = os.path.join(cache_dir, digest[:16])
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return path
+
+
+def cache_soft_targets(teacher, cache_dir: str, top_k: int, batch_size: int):
+    '''
+    Writes one .npz per training batch with the inputs/targets and the teacher's
+    top_k logits to cache_dir (see soft_target_dir). The training split is read in
+    a fixed order, so an interrupted run resumes by skipping the batches that are
+    already cached.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+
+    @tf.function(input_signature=Code.train_step_signature)
+    def teacher_top_k(inp, tar):
+        logits = _forward(teacher, inp, tar[:, :-1], False)
+        return tf.math.top_k(logits, k=top_k)
+
+    def batch_path(batch):
+        return os.path.join(cache_dir, f"batch_{batch:06d}.npz")
+
+    # Batches are written in order, so the cached ones are a prefix
+    done = 0
+    while os.path.exists(batch_path(done)):
+        done += 1
+
+    dataset = Code.initialize_dataset_as_iterator(Code.configs_add_closed_hh, batch_size,
+                                                  is_training=True, vocab=Code.vocab, deterministic=True)
+    start = time.time()
+    for batch, (inp, tar) in enumerate(dataset.skip(done), start=done):
+        path = batch_path(batch)
+        top = teacher_top_k(inp, tar)
+        np.savez(path + ".tmp.npz", inp=inp.numpy(), tar=tar.numpy(),
+                 top_logits=top.values.numpy().astype(np.float16), top_idx=top.indices.numpy().astype(np.int32))
+        os.replace(path + ".tmp.npz", path)
+    print(f"Soft targets cached in {cache_dir} ({time.time() - start:.1f} secs)")
+
+
+def cached_batches(cache_dir: str, shuffle: bool = True):
+    paths = sorted(glob.glob(os.path.join(cache_dir, "batch_*.npz")))
+    if shuffle:
+        np.random.shuffle(paths)
+    for path in paths:
+        with np.load(path) as f:
+            yield f["inp"], f["tar"], f["top_logits"].astype(np.float32), f["top_idx"]
+
+
+#######################################################################################
+##################### STUDENT TRAINING ################################################
+#######################################################################################
+
+def distillation_loss(tar_real, student_logits, top_logits, top_idx, alpha: float, temperature: float,
+                      mask=None):
+    '''
+    Blend of the soft-target cross-entropy against the teacher's top-k distribution
+    and Code.loss_function against the real targets. Both terms average over the
+    valid steps of mask, Code.target_mask(tar_real) by default (every step, token 0
+    included, for the unpadded cached batches).
+    '''
+    teacher_probs = tf.nn.softmax(top_logits / temperature, axis=-1)
+    student_log_probs = tf.nn.log_softmax(student_logits / temperature, axis=-1)
+    student_log_probs = tf.gather(student_log_probs, top_idx, batch_dims=2)
+    soft = -tf.reduce_sum(teacher_probs * student_log_probs, axis=-1)  # (batch_size, seq_len)
+
+    if mask is None:
+        mask = Code.target_mask(tar_real)
+    mask = tf.cast(mask, soft.dtype)
+    soft = tf.reduce_sum(soft * mask) / tf.reduce_sum(mask)
+    hard = Code.loss_function(tar_real, student_logits, mask)
+    return alpha * temperature ** 2 * soft + (1. - alpha) * hard
+
+
+def train_student(student, spec: str, cache_dir: str, epochs: int, alpha: float, temperature: float):
+    _, d_model, _, _ = parse_spec(spec)
+    optimizer = tf.keras.optimizers.Adam(Code.CustomSchedule(d_model), beta_1=0.9, beta_2=0.98, epsilon=1e-9)
+    train_loss = tf.keras.metrics.Mean(name='distill_loss')
+
+    @tf.function(input_signature=Code.train_step_signature + [
+        tf.TensorSpec(shape=(None, None, None), dtype=tf.float32),
+        tf.TensorSpec(shape=(None, None, None), dtype=tf.int32)])
+    def distill_step(inp, tar, top_logits, top_idx):
+        tar_inp = tar[:, :-1]
+        tar_real = tar[:, 1:]
+        with tf.GradientTape() as tape:
+            predictions = _forward(student, inp, tar_inp, True)
+            loss = distillation_loss(tar_real, predictions, top_logits, top_idx, alpha, temperature)
+        gradients = tape.gradient(loss, student.trainable_variables)
+        optimizer.apply_gradients(zip(gradients, student.trainable_variables))
+        train_loss(loss)
+
+    for epoch in range(epochs):
+        start = time.time()
+        train_loss.reset_states()
+        for inp, tar, top_logits, top_idx in cached_batches(cache_dir):
+            distill_step(inp, tar, top_logits, top_idx)
+        print('Student {} Epoch {} Loss {:.4f} ({:.1f} secs)'.format(
+            spec, epoch + 1, train_loss.result(), time.time() - start))
+
+
+#######################################################################################
+##################### EVALUATION ######################################################
+#######################################################################################
+
+def evaluate_accuracy(model, batch_size: int) -> float:
+    accuracy = tf.keras.metrics.SparseCategoricalAccuracy(name='accuracy')
+
+    @tf.function(input_signature=Code.val_step_signature)
+    def eval_step(inp, tar):
+        accuracy(tar[:, 1:], _forward(model, inp, tar[:, :-1], False))
+
+    for inp, tar in Code.initialize_dataset_as_iterator(Code.configs_add_closed_hh, batch_size, vocab=Code.vocab):
+        eval_step(inp, tar)
+    return float(accuracy.result())
+
+
+def measure_latency(model, batch_size: int = 1, seq_len: int = 32, runs: int = 20) -> float:
+    '''
+    Mean milliseconds of one Code.greedy_decode of a seq_len groove on CPU
+    '''
+    inp = np.random.randint(1, Code.input_vocab_size - 2, size=(batch_size, seq_len))
+    with tf.device('/CPU:0'):
+        Code.greedy_decode(model, inp)
+        start = time.time()
+        for _ in range(runs):
+            Code.greedy_decode(model, inp).numpy()
+    return 1000. * (time.time() - start) / runs
+
+
+def report_row(name: str, model, batch_size: int, slo_ms: float):
+    accuracy = evaluate_accuracy(model, batch_size)
+    latency = measure_latency(model)
+    params = int(sum(np.prod(v.shape) for v in model.trainable_variables))
+    verdict = "" if slo_ms is None else ("meets SLO" if latency <= slo_ms else "misses SLO")
+    print(f"{name}\t{params}\t{accuracy:.4f}\t{latency:.2f}\t{verdict}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--teacher", required=True)
+    parser.add_argument("--teacher-checkpoint", required=True)
+    parser.add_argument("--student", action="append", required=True)
+    parser.add_argument("--cache-dir", default="./distill_cache")
+    parser.add_argument("--top-k", type=int, default=16)
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--alpha", type=float, default=0.7)
+    parser.add_argument("--temperature", type=float, default=2.0)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--latency-slo-ms", type=float, default=None)
+    parser.add_argument("--output-dir", default="./checkpoints/students")
+    args = parser.parse_args()
+
+    teacher = load_teacher(args.teacher, args.teacher_checkpoint)
+    cache_dir = soft_target_dir(args.cache_dir, args.teacher, tf.train.latest_checkpoint(args.teacher_checkpoint),
+                                args.top_k, args.batch_size)
+    cache_soft_targets(teacher, cache_dir, args.top_k, args.batch_size)
+
+    students = {}
+    for spec in args.student:
+        student = build_transformer(spec)
+        train_student(student, spec, cache_dir, args.epochs, args.alpha, args.temperature)
+        path = tf.train.Checkpoint(transformer=student).save(os.path.join(args.output_dir, spec, "ckpt"))
+        print(f"Saved student {spec} to {path}")
+        students[spec] = student
+
+    print("model\tparams\tval_accuracy\tcpu_latency_ms\t")
+    report_row(f"teacher {args.teacher}", teacher, args.batch_size, args.latency_slo_ms)
+    for spec, student in students.items():
+        report_row(f"student {spec}", student, args.batch_size, args.latency_slo_ms)
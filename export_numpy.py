@@ -0,0 +1,182 @@
+"""
+Exports the Transformer of Code.py to a single .npz for the NumPy-only runtime in
+PythonFiles/numpy_transformer.py, and checks that the runtime reproduces it.
+
+The checkpoint (latest in ./checkpoints/train by default) is restored into
+Code.transformer, so the hyperparameters and vocabulary come from the same
+environment as training (GROOVE_HPARAMS, GROOVE_VOCAB). Only full attention is
+supported. The optimizer state is left out.
+
+With --pruned-dir, the pruned model saved there by prune.py (architecture.json
+and its checkpoint) is exported instead; it needs the same GROOVE_HPARAMS as the
+model that was pruned. The runtime reads the smaller head counts and FFN widths
+from the exported kernels.
+
+Usage:
+    python export_numpy.py [--checkpoint-dir ./checkpoints/train] [--output transformer.npz]
+    python export_numpy.py --pruned-dir ./checkpoints/pruned/heads0.25_ffn0.5 --output pruned.npz
+    python export_numpy.py --verify-only --output transformer.npz
+
+On the target machine only NumPy is needed:
+    from PythonFiles.numpy_transformer import NumpyTransformer
+    model = NumpyTransformer.load("transformer.npz")
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+
+#######################################################################################
+##################### EXPORT ##########################################################
+#######################################################################################
+
+def _dense(weights: dict, name: str, layer):
+    weights[name + "/kernel"] = layer.kernel.numpy()
+    weights[name + "/bias"] = layer.bias.numpy()
+
+
+def _layer_norm(weights: dict, name: str, layer):
+    weights[name + "/gamma"] = layer.gamma.numpy()
+    weights[name + "/beta"] = layer.beta.numpy()
+
+
+def _attention(weights: dict, name: str, mha):
+    for projection in ("wq", "wk", "wv", "dense"):
+        _dense(weights, f"{name}/{projection}", getattr(mha, projection))
+
+
+def _ffn(weights: dict, name: str, ffn):
+    for i, layer in enumerate(ffn.layers):
+        _dense(weights, f"{name}/ffn/{i}", layer)
+
+
+def collect_weights(code, transformer=None) -> dict:
+    '''
+    Arrays of transformer (code.transformer by default) by the names
+    NumpyTransformer reads
+    '''
+    transformer = transformer or code.transformer
+    weights = {}
+    for stack, layers in (("encoder", transformer.encoder.enc_layers), ("decoder", transformer.decoder.dec_layers)):
+        module = getattr(transformer, stack)
+        weights[f"{stack}/embedding"] = module.embedding.embeddings.numpy()
+        weights[f"{stack}/pos_encoding"] = module.pos_encoding.numpy()[0]
+        for i, layer in enumerate(layers):
+            name = f"{stack}/layer{i}"
+            if stack == "encoder":
+                _attention(weights, name + "/mha", layer.mha)
+                norms = (layer.layernorm1, layer.layernorm2)
+            else:
+                _attention(weights, name + "/mha1", layer.mha1)
+                _attention(weights, name + "/mha2", layer.mha2)
+                norms = (layer.layernorm1, layer.layernorm2, layer.layernorm3)
+            _ffn(weights, name, layer.ffn)
+            for j, norm in enumerate(norms):
+                _layer_norm(weights, f"{name}/layernorm{j + 1}", norm)
+    _dense(weights, "final_layer", transformer.final_layer)
+
+    if code.vocab is not None:
+        weights["vocab/to_compact"] = code.vocab.to_compact
+        weights["vocab/to_token"] = code.vocab.to_token
+    return weights
+
+
+def load_reference(checkpoint: str, pruned_dir: str = None):
+    '''
+    The Transformer of Code.py restored from checkpoint, or the pruned model of
+    pruned_dir (see prune.load_pruned)
+    '''
+    import tensorflow as tf
+    import Code
+
+    if pruned_dir:
+        import prune
+        return prune.load_pruned(pruned_dir)
+    status = tf.train.Checkpoint(transformer=Code.transformer).restore(checkpoint).expect_partial()
+    # Variables are created (and restored) on the first call
+    Code.greedy_decode(Code.transformer, np.ones((1, 2), dtype=np.int64))
+    status.assert_existing_objects_matched()
+    return Code.transformer
+
+
+def export(checkpoint_dir: str, output: str, pruned_dir: str = None) -> str:
+    import tensorflow as tf
+    import Code
+
+    if Code.attention != "full":
+        raise ValueError(f"the NumPy runtime only implements full attention, not {Code.attention!r}")
+    checkpoint = tf.train.latest_checkpoint(pruned_dir or checkpoint_dir)
+    if checkpoint is None:
+        raise ValueError(f"no checkpoint in {pruned_dir or checkpoint_dir}")
+
+    weights = collect_weights(Code, load_reference(checkpoint, pruned_dir))
+    config = {"num_layers": Code.num_layers, "d_model": Code.d_model, "num_heads": Code.num_heads,
+              "dff": Code.dff, "input_vocab_size": Code.input_vocab_size,
+              "target_vocab_size": Code.target_vocab_size, "checkpoint": checkpoint, "pruned_dir": pruned_dir}
+    np.savez(output, config=np.array(json.dumps(config)), **weights)
+    size = sum(w.nbytes for w in weights.values())
+    print(f"Exported {checkpoint} to {output} ({len(weights)} arrays, {size / 2 ** 20:.1f} MB)")
+    return checkpoint
+
+
+#######################################################################################
+##################### VERIFICATION ####################################################
+#######################################################################################
+
+def verify(output: str, batch_size: int = 8, seq_len: int = 32, atol: float = 1e-3):
+    '''
+    Compares encoder outputs, teacher-forced logits and greedy decodes of the
+    NumPy runtime against the exported model (Code.transformer or the pruned one)
+    on random inputs (with some padding)
+    '''
+    from PythonFiles.numpy_transformer import NumpyTransformer
+
+    start = time.time()
+    model = NumpyTransformer.load(output)
+    load_ms = 1000. * (time.time() - start)
+
+    import Code
+    with np.load(output) as f:
+        config = json.loads(str(f["config"]))
+    reference = load_reference(config["checkpoint"], config.get("pruned_dir"))
+
+    rng = np.random.default_rng(0)
+    inp = rng.integers(1, Code.input_vocab_size - 2, size=(batch_size, seq_len))
+    tar = rng.integers(1, Code.target_vocab_size - 2, size=(batch_size, seq_len))
+    inp[:, -4:] = 0
+    tar[:, -4:] = 0
+
+    enc_padding_mask, combined_mask, dec_padding_mask = Code.create_masks(inp, tar)
+    expected_logits, _ = reference(inp, tar, False, enc_padding_mask, combined_mask, dec_padding_mask)
+    expected_enc = reference.encoder(inp, False, enc_padding_mask)
+    expected_greedy = Code.greedy_decode(reference, inp).numpy()
+
+    start = time.time()
+    greedy = model.greedy_decode(inp)
+    greedy_ms = 1000. * (time.time() - start)
+
+    enc_error = float(np.abs(model.encode(inp) - expected_enc.numpy()).max())
+    logits_error = float(np.abs(model(inp, tar) - expected_logits.numpy()).max())
+    greedy_match = float((greedy == expected_greedy).mean())
+    print(f"load {load_ms:.1f} ms, greedy decode of {batch_size}x{seq_len} {greedy_ms:.1f} ms")
+    print(f"max abs error: encoder {enc_error:.2e}, logits {logits_error:.2e} (tolerance {atol:.0e})")
+    print(f"greedy decode agreement {greedy_match:.4f}")
+    assert enc_error < atol and logits_error < atol, "NumPy runtime does not match the exported model"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkpoint-dir", default="./checkpoints/train")
+    parser.add_argument("--pruned-dir", default=None, help="export the pruned model prune.py saved here")
+    parser.add_argument("--output", default="transformer.npz")
+    parser.add_argument("--verify-only", action="store_true")
+    parser.add_argument("--atol", type=float, default=1e-3)
+    args = parser.parse_args()
+
+    if not args.verify_only:
+        export(args.checkpoint_dir, args.output, args.pruned_dir)
+    if os.path.exists(args.output):
+        verify(args.output, atol=args.atol)
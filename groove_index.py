@@ -0,0 +1,283 @@
+"""
+Groove similarity search over Transformer encoder embeddings.
+
+`build` runs Code.transformer's Encoder over every 2-bar window of a converted
+TFDS split, mean-pools each window into one L2-normalised vector and writes an
+IVF-PQ (inverted file + product quantization) index to a directory, together
+with the drummer/style/bpm of the source performance. `query` encodes one tap
+pattern or groove and returns its nearest neighbours from that index.
+
+Usage:
+    python groove_index.py build [--output groove_index] [--config groovae_2bar_tap_fixed_velocity]
+    python groove_index.py query --taps 1,0,0,0,1,0,0,0,... [--index groove_index] [-k 20]
+"""
+import argparse
+import json
+import os
+import time
+from typing import List, Optional
+
+import numpy as np
+
+from PythonFiles import groove_tokens as gt
+
+
+#######################################################################################
+##################### IVF-PQ INDEX ####################################################
+#######################################################################################
+
+def kmeans(x: np.ndarray, k: int, iterations: int = 20, seed: int = 0) -> np.ndarray:
+    '''
+    Plain Lloyd's k-means, returns (k, dim) float32 centroids
+    '''
+    rng = np.random.RandomState(seed)
+    centroids = x[rng.choice(len(x), k, replace=len(x) < k)].astype(np.float32)
+    for _ in range(iterations):
+        assignment = _nearest(x, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, x)
+        counts = np.bincount(assignment, minlength=k)
+        # Empty clusters are re-seeded from random points
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, np.newaxis]
+        centroids[empty] = x[rng.randint(len(x), size=empty.sum())]
+    return centroids
+
+
+def _nearest(x: np.ndarray, centroids: np.ndarray, batch_size: int = 65536) -> np.ndarray:
+    out = np.empty(len(x), dtype=np.int64)
+    c_norms = (centroids ** 2).sum(1)
+    for start in range(0, len(x), batch_size):
+        chunk = x[start:start + batch_size]
+        out[start:start + batch_size] = np.argmin(c_norms[np.newaxis] - 2 * chunk @ centroids.T, axis=1)
+    return out
+
+
+class IVFPQIndex:
+    '''
+    Approximate nearest-neighbour index in NumPy
+
+    Vectors are assigned to the nearest of n_lists coarse centroids; the residual to
+    that centroid is product-quantized into n_subvectors one-byte codes. A query scans
+    the n_probe nearest lists with asymmetric distance lookups and reranks the best
+    candidates with the exact vectors, which are kept as a float16 memory map.
+
+    Inputs:
+        (1) coarse: (n_lists, dim) coarse centroids
+        (2) codebooks: (n_subvectors, 256, dim // n_subvectors) PQ centroids
+        (3) list_offsets: (n_lists + 1,) start of every inverted list in codes/ids
+        (4) codes: (n, n_subvectors) uint8 PQ codes, ordered by list
+        (5) ids: (n,) row of every code in the metadata
+        (6) vectors: (n, dim) float16 exact vectors, ordered like codes
+    '''
+    def __init__(self, coarse, codebooks, list_offsets, codes, ids, vectors):
+        self.coarse = coarse
+        self.codebooks = codebooks
+        self.list_offsets = list_offsets
+        self.codes = codes
+        self.ids = ids
+        self.vectors = vectors
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, n_lists: Optional[int] = None, n_subvectors: int = 16,
+              train_size: int = 50000, seed: int = 0):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        n, dim = vectors.shape
+        assert dim % n_subvectors == 0
+        n_lists = n_lists or max(1, int(np.sqrt(n)))
+        rng = np.random.RandomState(seed)
+        sample = vectors[rng.choice(n, min(n, train_size), replace=False)]
+
+        coarse = kmeans(sample, n_lists, seed=seed)
+        sample_residuals = sample - coarse[_nearest(sample, coarse)]
+        sub_dim = dim // n_subvectors
+        codebooks = np.stack([kmeans(sample_residuals[:, m * sub_dim:(m + 1) * sub_dim], 256, seed=seed)
+                              for m in range(n_subvectors)])
+
+        assignment = _nearest(vectors, coarse)
+        residuals = vectors - coarse[assignment]
+        codes = np.stack([_nearest(residuals[:, m * sub_dim:(m + 1) * sub_dim], codebooks[m])
+                          for m in range(n_subvectors)], axis=1).astype(np.uint8)
+
+        order = np.argsort(assignment, kind="stable")
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))])
+        return cls(coarse, codebooks, list_offsets, codes[order], order, vectors[order].astype(np.float16))
+
+    def search(self, query: np.ndarray, k: int = 20, n_probe: int = 8, rerank: int = 4):
+        '''
+        Output:
+            (1) ids of the k nearest vectors (rows of the metadata)
+            (2) their squared L2 distances
+        '''
+        query = np.asarray(query, dtype=np.float32)
+        n_subvectors, _, sub_dim = self.codebooks.shape
+        lists = np.argsort(((self.coarse - query) ** 2).sum(1))[:n_probe]
+
+        candidates, approx = [], []
+        for l in lists:
+            start, end = self.list_offsets[l], self.list_offsets[l + 1]
+            if start == end:
+                continue
+            residual = (query - self.coarse[l]).reshape(n_subvectors, 1, sub_dim)
+            table = ((self.codebooks - residual) ** 2).sum(-1)  # (n_subvectors, 256)
+            codes = self.codes[start:end]
+            approx.append(table[np.arange(n_subvectors), codes].sum(1))
+            candidates.append(np.arange(start, end))
+        if not candidates:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        candidates, approx = np.concatenate(candidates), np.concatenate(approx)
+
+        n_rerank = min(len(candidates), k * rerank)
+        best = candidates[np.argpartition(approx, n_rerank - 1)[:n_rerank]]
+        exact = ((self.vectors[best].astype(np.float32) - query) ** 2).sum(1)
+        top = np.argsort(exact)[:k]
+        return np.asarray(self.ids[best[top]]), exact[top]
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        np.savez(os.path.join(directory, "quantizers.npz"),
+                 coarse=self.coarse, codebooks=self.codebooks, list_offsets=self.list_offsets)
+        for name in ("codes", "ids", "vectors"):
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory: str):
+        with np.load(os.path.join(directory, "quantizers.npz")) as f:
+            coarse, codebooks, list_offsets = f["coarse"], f["codebooks"], f["list_offsets"]
+        arrays = [np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+                  for name in ("codes", "ids", "vectors")]
+        return cls(coarse, codebooks, list_offsets, *arrays)
+
+
+#######################################################################################
+##################### ENCODER EMBEDDINGS ##############################################
+#######################################################################################
+
+class GrooveEmbedder:
+    '''
+    Mean-pooled, L2-normalised encoder output of Code.transformer, restored from
+    the latest checkpoint. Pooling skips token-0 steps, which the encoder masks.
+    '''
+    def __init__(self):
+        import tensorflow as tf
+        import Code
+        self._code = Code
+        Code.restore_latest_checkpoint()
+
+        @tf.function(input_signature=[tf.TensorSpec(shape=(None, None), dtype=tf.int64)])
+        def embed(inp):
+            enc_output = Code.transformer.encoder(inp, False, Code.create_padding_mask(inp))
+            weights = tf.cast(tf.not_equal(inp, 0), tf.float32)[..., tf.newaxis]
+            # Windows without any hit fall back to a plain mean
+            weights = tf.where(tf.reduce_sum(weights, axis=1, keepdims=True) > 0, weights, tf.ones_like(weights))
+            pooled = tf.reduce_sum(enc_output * weights, axis=1) / tf.reduce_sum(weights, axis=1)
+            return tf.math.l2_normalize(pooled, axis=-1)
+        self._embed = embed
+
+    def __call__(self, tokens: np.ndarray) -> np.ndarray:
+        return self._embed(self._code.encode_tokens(np.asarray(tokens, dtype=np.int64))).numpy()
+
+
+def iterate_corpus(config_name: str, split: str):
+    '''
+    Yields (input tokens, metadata) for every window GrooveConverter makes out of
+    the performances of a TFDS split; the metadata of a window is that of its source
+    '''
+    import tensorflow_datasets as tfds
+    import magenta.music as mm
+    from magenta.models.music_vae import configs
+
+    config = configs.CONFIG_MAP[config_name]
+    converter = config.data_converter
+    converter.set_mode('eval')
+    dataset, info = tfds.load(config.tfds_name, split=split, try_gcs=False, with_info=True)
+    drummers = info.features['drummer']
+    styles = info.features['style']['primary']
+
+    for ex in tfds.as_numpy(dataset):
+        tensors = converter.to_tensors(mm.midi_to_note_sequence(ex['midi']))
+        metadata = {"id": ex['id'].decode(),
+                    "drummer": drummers.int2str(int(ex['drummer'])),
+                    "style": styles.int2str(int(ex['style']['primary'])),
+                    "bpm": int(ex['bpm'])}
+        for window, inputs in enumerate(tensors.inputs):
+            yield gt.hits_to_tokens(inputs), dict(metadata, window=window)
+
+
+def build(args: argparse.Namespace):
+    embedder = GrooveEmbedder()
+    vectors, metadata, batch, batch_meta = [], [], [], []
+
+    def flush():
+        if batch:
+            vectors.append(embedder(np.stack(batch)))
+            metadata.extend(batch_meta)
+            batch.clear()
+            batch_meta.clear()
+
+    start = time.time()
+    for tokens, meta in iterate_corpus(args.config, args.split):
+        batch.append(tokens)
+        batch_meta.append(meta)
+        if len(batch) == args.batch_size:
+            flush()
+    flush()
+    vectors = np.concatenate(vectors)
+    print(f"Embedded {len(vectors)} grooves in {time.time() - start:.1f} secs")
+
+    index = IVFPQIndex.build(vectors, n_subvectors=args.subvectors)
+    index.save(args.output)
+    with open(os.path.join(args.output, "metadata.jsonl"), "w") as f:
+        for meta in metadata:
+            f.write(json.dumps(meta) + "\n")
+    print(f"Saved index to {args.output}")
+
+
+class GrooveSearch:
+    '''
+    Query API: encodes one groove and returns its nearest neighbours with metadata
+    '''
+    def __init__(self, directory: str, embedder: Optional[GrooveEmbedder] = None):
+        self.index = IVFPQIndex.load(directory)
+        with open(os.path.join(directory, "metadata.jsonl")) as f:
+            self.metadata = [json.loads(line) for line in f]
+        self.embedder = embedder or GrooveEmbedder()
+
+    def search(self, tokens: np.ndarray, k: int = 20, n_probe: int = 8) -> List[dict]:
+        vector = self.embedder(np.asarray(tokens)[np.newaxis])[0]
+        ids, distances = self.index.search(vector, k=k, n_probe=n_probe)
+        return [dict(self.metadata[i], distance=float(d)) for i, d in zip(ids, distances)]
+
+
+def query(args: argparse.Namespace):
+    search = GrooveSearch(args.index)
+    taps = np.array([int(t) for t in args.taps.split(",")])
+    tokens = gt.taps_to_tokens(taps)
+    search.search(tokens, k=args.k)  # warm up the traced encoder
+
+    start = time.perf_counter()
+    neighbours = search.search(tokens, k=args.k, n_probe=args.n_probe)
+    elapsed = time.perf_counter() - start
+    for neighbour in neighbours:
+        print(json.dumps(neighbour))
+    print(f"query took {1000 * elapsed:.2f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["build", "query"])
+    parser.add_argument("--output", "--index", dest="index", default="groove_index")
+    parser.add_argument("--config", default="groovae_2bar_tap_fixed_velocity")
+    parser.add_argument("--split", default="train")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--subvectors", type=int, default=16)
+    parser.add_argument("--taps", default=",".join(["1", "0", "0", "0"] * 8))
+    parser.add_argument("-k", type=int, default=20)
+    parser.add_argument("--n-probe", type=int, default=8)
+    args = parser.parse_args()
+    args.output = args.index
+
+    if args.command == "build":
+        build(args)
+    else:
+        query(args)
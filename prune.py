@@ -0,0 +1,279 @@
+"""
+Structured pruning of attention heads and FFN units of the Transformer in Code.py.
+
+1. Every head of every MultiHeadAttention block and every hidden unit of every
+   point_wise_feed_forward_network is scored on the validation split by the
+   first-order estimate of how much the loss changes when it is switched off:
+   |dL/dgate|, where the gate scales the head's (unit's) output. That gradient is
+   the sum of W * dL/dW over the head's (unit's) rows of the following Dense
+   kernel, so no gates need to be added to the model.
+2. For each --level HEADS:FFN the lowest-scoring fraction of heads / units of every
+   block is removed and a smaller Transformer is built (Code.Transformer with
+   layer_sizes) with the surviving slices of the Dense kernels copied over.
+3. The pruned model is fine-tuned for --finetune-steps, saved to
+   <output-dir>/heads<H>_ffn<F> together with architecture.json, and evaluated
+   (validation accuracy and CPU latency of Code.greedy_decode, as in distill.py).
+
+Usage:
+    python prune.py [--checkpoint-dir ./checkpoints/train] --level 0.25:0.5 --level 0.5:0.75 \\
+        [--finetune-steps 500] [--output-dir ./checkpoints/pruned]
+
+A pruned checkpoint is loaded back with load_pruned(<output-dir>/heads<H>_ffn<F>).
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import Code
+from distill import _forward, evaluate_accuracy, measure_latency
+
+
+#######################################################################################
+##################### MODEL STRUCTURE #################################################
+#######################################################################################
+
+def attention_blocks(model) -> dict:
+    blocks = {}
+    for i, layer in enumerate(model.encoder.enc_layers):
+        blocks[f"encoder{i}/mha"] = layer.mha
+    for i, layer in enumerate(model.decoder.dec_layers):
+        blocks[f"decoder{i}/mha1"] = layer.mha1
+        blocks[f"decoder{i}/mha2"] = layer.mha2
+    return blocks
+
+
+def ffn_blocks(model) -> dict:
+    layers = [(f"encoder{i}", layer) for i, layer in enumerate(model.encoder.enc_layers)]
+    layers += [(f"decoder{i}", layer) for i, layer in enumerate(model.decoder.dec_layers)]
+    return {name: layer.ffn for name, layer in layers}
+
+
+def build_model(layer_sizes: dict = None):
+    '''
+    A Transformer with Code.py's hyperparameters, optionally with per-layer sizes,
+    with its variables created
+    '''
+    model = Code.Transformer(Code.num_layers, Code.d_model, Code.num_heads, Code.dff,
+                             Code.input_vocab_size, Code.target_vocab_size,
+                             pe_input=Code.max_position_encoding,
+                             pe_target=Code.max_position_encoding,
+                             rate=Code.dropout_rate,
+                             attention=Code.attention,
+                             layer_sizes=layer_sizes)
+    dummy = tf.ones((1, 2), dtype=tf.int64)
+    _forward(model, dummy, dummy, False)
+    return model
+
+
+def count_params(model) -> int:
+    return int(sum(np.prod(v.shape) for v in model.trainable_variables))
+
+
+#######################################################################################
+##################### IMPORTANCE SCORES ###############################################
+#######################################################################################
+
+def importance_scores(model, batches: int, batch_size: int):
+    '''
+    Output:
+        (1) {attention block: (num_heads,) scores}
+        (2) {ffn block: (dff,) scores}
+    '''
+    attention, ffns = attention_blocks(model), ffn_blocks(model)
+    kernels = [mha.dense.kernel for mha in attention.values()] + [ffn.layers[1].kernel for ffn in ffns.values()]
+
+    @tf.function(input_signature=Code.val_step_signature)
+    def row_contributions(inp, tar):
+        with tf.GradientTape() as tape:
+            loss = Code.loss_function(tar[:, 1:], _forward(model, inp, tar[:, :-1], False))
+        grads = tape.gradient(loss, kernels)
+        return [tf.reduce_sum(w * g, axis=1) for w, g in zip(kernels, grads)]
+
+    head_scores = {name: np.zeros(mha.num_heads) for name, mha in attention.items()}
+    unit_scores = {name: np.zeros(ffn.layers[1].kernel.shape[0]) for name, ffn in ffns.items()}
+    dataset = Code.initialize_dataset_as_iterator(Code.configs_add_closed_hh, batch_size, vocab=Code.vocab)
+    for inp, tar in dataset.take(batches):
+        rows = [r.numpy() for r in row_contributions(inp, tar)]
+        for (name, mha), r in zip(attention.items(), rows):
+            head_scores[name] += np.abs(r.reshape(mha.num_heads, mha.depth).sum(axis=1))
+        for name, r in zip(ffns, rows[len(attention):]):
+            unit_scores[name] += np.abs(r)
+    return head_scores, unit_scores
+
+
+def keep_top(scores: np.ndarray, fraction: float) -> np.ndarray:
+    '''
+    Sorted indices of the highest scores after removing `fraction` of them (at least one is kept)
+    '''
+    keep = max(1, len(scores) - int(fraction * len(scores)))
+    return np.sort(np.argsort(-scores, kind="stable")[:keep])
+
+
+#######################################################################################
+##################### PRUNING #########################################################
+#######################################################################################
+
+def _copy_dense(src, dst, rows=None, cols=None):
+    kernel, bias = src.kernel.numpy(), src.bias.numpy()
+    if rows is not None:
+        kernel = kernel[rows]
+    if cols is not None:
+        kernel, bias = kernel[:, cols], bias[cols]
+    dst.kernel.assign(kernel)
+    dst.bias.assign(bias)
+
+
+def _copy_attention(src, dst, heads: np.ndarray):
+    columns = (heads[:, np.newaxis] * src.depth + np.arange(src.depth)).ravel()
+    for projection in ("wq", "wk", "wv"):
+        _copy_dense(getattr(src, projection), getattr(dst, projection), cols=columns)
+    _copy_dense(src.dense, dst.dense, rows=columns)
+    if src.local_attention is not None:
+        dst.local_attention.relative_bias.assign(tf.gather(src.local_attention.relative_bias, heads))
+        dst.local_attention.global_bias.assign(tf.gather(src.local_attention.global_bias, heads))
+
+
+def _copy_ffn(src, dst, units: np.ndarray):
+    _copy_dense(src.layers[0], dst.layers[0], cols=units)
+    _copy_dense(src.layers[1], dst.layers[1], rows=units)
+
+
+def _copy_weights(src, dst):
+    for s, d in zip(src.weights, dst.weights):
+        d.assign(s)
+
+
+def prune(model, head_scores: dict, unit_scores: dict, head_fraction: float, ffn_fraction: float):
+    '''
+    Output:
+        (1) the pruned Transformer, with the kept slices of model's weights
+        (2) its layer_sizes
+    '''
+    heads = {name: keep_top(scores, head_fraction) for name, scores in head_scores.items()}
+    units = {name: keep_top(scores, ffn_fraction) for name, scores in unit_scores.items()}
+    layer_sizes = {
+        "encoder": [{"num_heads": len(heads[f"encoder{i}/mha"]), "dff": len(units[f"encoder{i}"])}
+                    for i in range(Code.num_layers)],
+        "decoder": [{"num_heads": len(heads[f"decoder{i}/mha1"]), "cross_num_heads": len(heads[f"decoder{i}/mha2"]),
+                     "dff": len(units[f"decoder{i}"])}
+                    for i in range(Code.num_layers)],
+    }
+    pruned = build_model(layer_sizes)
+
+    pruned_attention, pruned_ffns = attention_blocks(pruned), ffn_blocks(pruned)
+    for name, mha in attention_blocks(model).items():
+        _copy_attention(mha, pruned_attention[name], heads[name])
+    for name, ffn in ffn_blocks(model).items():
+        _copy_ffn(ffn, pruned_ffns[name], units[name])
+
+    for stack in ("encoder", "decoder"):
+        _copy_weights(getattr(model, stack).embedding, getattr(pruned, stack).embedding)
+    for src, dst in zip(model.encoder.enc_layers + model.decoder.dec_layers,
+                        pruned.encoder.enc_layers + pruned.decoder.dec_layers):
+        for norm in ("layernorm1", "layernorm2", "layernorm3"):
+            if hasattr(src, norm):
+                _copy_weights(getattr(src, norm), getattr(dst, norm))
+    _copy_weights(model.final_layer, pruned.final_layer)
+    return pruned, layer_sizes
+
+
+def fine_tune(model, steps: int, learning_rate: float, batch_size: int):
+    optimizer = tf.keras.optimizers.Adam(learning_rate, beta_1=0.9, beta_2=0.98, epsilon=1e-9)
+    loss_metric = tf.keras.metrics.Mean(name='loss')
+
+    @tf.function(input_signature=Code.train_step_signature)
+    def train_step(inp, tar):
+        with tf.GradientTape() as tape:
+            loss = Code.loss_function(tar[:, 1:], _forward(model, inp, tar[:, :-1], True))
+        gradients = tape.gradient(loss, model.trainable_variables)
+        optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+        loss_metric(loss)
+
+    dataset = Code.initialize_dataset_as_iterator(Code.configs_add_closed_hh, batch_size,
+                                                  is_training=True, vocab=Code.vocab).repeat()
+    start = time.time()
+    for step, (inp, tar) in enumerate(dataset.take(steps)):
+        train_step(inp, tar)
+        if (step + 1) % 100 == 0:
+            print(f"  fine-tune step {step + 1} loss {loss_metric.result():.4f}")
+            loss_metric.reset_states()
+    print(f"  fine-tuned {steps} steps in {time.time() - start:.1f} secs")
+
+
+def save_pruned(model, layer_sizes: dict, directory: str, source: str) -> str:
+    os.makedirs(directory, exist_ok=True)
+    architecture = {"num_layers": Code.num_layers, "d_model": Code.d_model, "num_heads": Code.num_heads,
+                    "dff": Code.dff, "layer_sizes": layer_sizes, "source_checkpoint": source}
+    with open(os.path.join(directory, "architecture.json"), "w") as f:
+        json.dump(architecture, f, indent=2)
+    return tf.train.Checkpoint(transformer=model).save(os.path.join(directory, "ckpt"))
+
+
+def load_pruned(directory: str):
+    '''
+    Rebuilds a pruned Transformer from <directory>/architecture.json and restores
+    its latest checkpoint. Code.py must run with the same hyperparameters
+    (GROOVE_HPARAMS) as the model that was pruned.
+    '''
+    with open(os.path.join(directory, "architecture.json")) as f:
+        architecture = json.load(f)
+    for key in ("num_layers", "d_model", "num_heads"):
+        assert architecture[key] == getattr(Code, key), f"{key} differs from Code.py's"
+    model = build_model(architecture["layer_sizes"])
+    tf.train.Checkpoint(transformer=model).restore(tf.train.latest_checkpoint(directory)).expect_partial()
+    return model
+
+
+#######################################################################################
+##################### REPORT ##########################################################
+#######################################################################################
+
+def report_row(name: str, model, batch_size: int, base_latency: float = None):
+    accuracy = evaluate_accuracy(model, batch_size)
+    latency = measure_latency(model)
+    speedup = "" if base_latency is None else f"{base_latency / latency:.2f}x"
+    print(f"{name}\t{count_params(model)}\t{accuracy:.4f}\t{latency:.2f}\t{speedup}")
+    return latency
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkpoint-dir", default=Code.checkpoint_path)
+    parser.add_argument("--level", action="append", default=None,
+                        help="HEADS:FFN fractions to remove from every block, e.g. 0.25:0.5")
+    parser.add_argument("--score-batches", type=int, default=50)
+    parser.add_argument("--finetune-steps", type=int, default=500)
+    parser.add_argument("--learning-rate", type=float, default=1e-4)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--output-dir", default="./checkpoints/pruned")
+    args = parser.parse_args()
+    levels = [tuple(float(x) for x in level.split(":")) for level in (args.level or ["0.25:0.5"])]
+
+    checkpoint = tf.train.latest_checkpoint(args.checkpoint_dir)
+    assert checkpoint, f"no checkpoint in {args.checkpoint_dir}"
+    base = build_model()
+    tf.train.Checkpoint(transformer=base).restore(checkpoint).expect_partial()
+    print(f"Restored {checkpoint}")
+
+    head_scores, unit_scores = importance_scores(base, args.score_batches, args.batch_size)
+
+    rows = []
+    for head_fraction, ffn_fraction in levels:
+        name = f"heads{head_fraction:g}_ffn{ffn_fraction:g}"
+        print(f"Pruning {name}")
+        pruned, layer_sizes = prune(base, head_scores, unit_scores, head_fraction, ffn_fraction)
+        rows.append((f"{name} (no fine-tune)", build_model(layer_sizes)))
+        _copy_weights(pruned, rows[-1][1])
+        fine_tune(pruned, args.finetune_steps, args.learning_rate, args.batch_size)
+        path = save_pruned(pruned, layer_sizes, os.path.join(args.output_dir, name), checkpoint)
+        print(f"Saved {path}")
+        rows.append((name, pruned))
+
+    print("model\tparams\tval_accuracy\tcpu_latency_ms\tspeedup")
+    base_latency = report_row("base", base, args.batch_size)
+    for name, model in rows:
+        report_row(name, model, args.batch_size, base_latency)
@@ -0,0 +1,257 @@
+"""
+Real-time tap-to-drums engine: taps come in as timestamped events, drums go out bar by bar.
+
+Taps (one stream per session, e.g. one per performer) are quantized to the 16th-note
+grid as they arrive. At every bar boundary the bar that just ended is turned into
+tap tokens for all sessions at once and one batched model step
+(streaming.generate_stream) generates the drums, which are emitted as timed events
+for the bar that is starting. Each step has a deadline, measured from the bar
+boundary. If the engine is already past the deadline of a bar when it gets to it
+(e.g. after a slow step), that bar is skipped: its previous drums are repeated
+instead of generating late output, and the engine catches up with the next boundary.
+
+The engine is tested by replaying the note onsets of a local MIDI file as taps at
+real-time speed, at the file's tempo unless --bpm is given. It reports the latency
+of every bar against the deadline, deadline misses and skipped bars.
+
+Usage:
+    python realtime.py --replay taps.mid [--sessions 4] [--deadline-ms 60] [--bars 32] \\
+        [--output realtime_groove.mid]
+"""
+import argparse
+import collections
+import threading
+import time
+from typing import Callable, Optional
+
+import numpy as np
+
+import Code
+from PythonFiles import groove_tokens as gt
+from streaming import generate_stream
+
+
+#######################################################################################
+##################### TAP QUANTIZATION ################################################
+#######################################################################################
+
+class TapQuantizer(object):
+    '''
+    Collects taps of several sessions on the 16th-note grid, per bar. Taps may come
+    from any thread. A tap is rounded to the nearest step, so a tap just before a bar
+    boundary counts as the first step of the next bar.
+    '''
+    def __init__(self, sessions: int, bpm: float):
+        self.sessions = sessions
+        self.step_secs = 60. / bpm / 4
+        self._bars = {}
+        self._lock = threading.Lock()
+        self.late_taps = 0
+
+    def add(self, session: int, t: float, oldest_bar: int = 0):
+        '''
+        t: seconds on the engine clock. Taps for bars before oldest_bar (already
+        generated) are counted as late and dropped.
+        '''
+        if t < 0:
+            return
+        bar, step = divmod(int(round(t / self.step_secs)), gt.STEPS_PER_BAR)
+        with self._lock:
+            if bar < oldest_bar:
+                self.late_taps += 1
+                return
+            if bar not in self._bars:
+                self._bars[bar] = np.zeros((self.sessions, gt.STEPS_PER_BAR), dtype=bool)
+            self._bars[bar][session, step] = True
+
+    def pop_bar(self, bar: int) -> np.ndarray:
+        '''
+        Output:
+            (1) (sessions, STEPS_PER_BAR) taps of bar; older bars are dropped
+        '''
+        with self._lock:
+            for old in [b for b in self._bars if b < bar]:
+                del self._bars[old]
+            return self._bars.pop(bar, np.zeros((self.sessions, gt.STEPS_PER_BAR), dtype=bool))
+
+
+#######################################################################################
+##################### ENGINE ##########################################################
+#######################################################################################
+
+BarRecord = collections.namedtuple("BarRecord", ["bar", "latency_ms", "missed", "skipped"])
+
+
+class StreamingEngine(object):
+    '''
+    Inputs:
+        (1) transformer: Code.Transformer with restored weights
+        (2) sessions: number of tap streams, decoded as one batch
+        (3) bpm: tempo of the grid
+        (4) deadline_ms: time after a bar boundary by which the drums of the new
+                bar must be ready
+        (5) context_bars (opt): see streaming.generate_stream
+        (6) on_bar (opt): callable(bar, tokens, events) for every bar played;
+                tokens is (sessions, STEPS_PER_BAR) and events lists
+                (session, time in secs, midi pitch) on the engine clock
+
+    tap() may be called from other threads once start() has set the clock.
+    '''
+    def __init__(self, transformer, sessions: int, bpm: float, deadline_ms: float, context_bars: int = 1,
+                 on_bar: Optional[Callable] = None):
+        self.transformer = transformer
+        self.sessions = sessions
+        self.bar_secs = 60. / bpm * 4
+        self.deadline = deadline_ms / 1000.
+        self.context_bars = context_bars
+        self.on_bar = on_bar
+        self.quantizer = TapQuantizer(sessions, bpm)
+        self.records = []
+        self._clock0 = None
+        self._next_bar = 1
+
+    def now(self) -> float:
+        return time.perf_counter() - self._clock0
+
+    def tap(self, session: int, t: Optional[float] = None):
+        self.quantizer.add(session, self.now() if t is None else t, oldest_bar=self._next_bar - 1)
+
+    def warm_up(self):
+        '''
+        Traces the model on a throwaway stream so the first bar is not slow
+        '''
+        bars = iter([np.zeros((self.sessions, gt.STEPS_PER_BAR), dtype=np.int64)] * 2)
+        for _ in generate_stream(self.transformer, bars, self.context_bars):
+            pass
+
+    def start(self):
+        self._clock0 = time.perf_counter()
+
+    def _emit(self, bar: int, tokens: np.ndarray):
+        if self.on_bar is None:
+            return
+        hits = gt.tokens_to_hits(tokens)
+        session, step, voice = np.nonzero(hits)
+        times = bar * self.bar_secs + step * self.quantizer.step_secs
+        events = [(int(s), float(t), gt.DRUM_PITCHES[v]) for s, t, v in zip(session, times, voice)]
+        self.on_bar(bar, tokens, events)
+
+    def run(self, n_bars: int):
+        '''
+        Plays bars 1..n_bars: at the start of bar b the taps of bar b - 1 are
+        turned into the drums of bar b
+        '''
+        if self._clock0 is None:
+            self.start()
+        pending = collections.deque()
+        stream = generate_stream(self.transformer, iter(pending.popleft, None), self.context_bars)
+        last = np.zeros((self.sessions, gt.STEPS_PER_BAR), dtype=np.int64)
+
+        while self._next_bar <= n_bars:
+            bar = self._next_bar
+            boundary = bar * self.bar_secs
+            wait = boundary - self.now()
+            if wait > 0:
+                time.sleep(wait)
+
+            late = self.now() - boundary
+            if late > self.deadline:
+                # Stale: the drums could not be on time any more
+                self._next_bar += 1
+                self.quantizer.pop_bar(bar - 1)
+                self.records.append(BarRecord(bar, 1000. * late, True, True))
+                self._emit(bar, last)
+                continue
+
+            # Taps of bar - 1 that arrive from now on are late
+            self._next_bar += 1
+            taps = self.quantizer.pop_bar(bar - 1)
+            pending.append(gt.taps_to_tokens(taps))
+            last = next(stream)
+            latency = self.now() - boundary
+            self.records.append(BarRecord(bar, 1000. * latency, latency > self.deadline, False))
+            self._emit(bar, last)
+
+    def report(self) -> str:
+        latencies = np.array([r.latency_ms for r in self.records if not r.skipped] or [np.nan])
+        misses = sum(r.missed for r in self.records)
+        skipped = sum(r.skipped for r in self.records)
+        lines = ["bar\tlatency_ms\tmissed\tskipped"]
+        lines += [f"{r.bar}\t{r.latency_ms:.1f}\t{int(r.missed)}\t{int(r.skipped)}" for r in self.records]
+        lines.append(f"{len(self.records)} bars, {self.sessions} sessions, deadline {1000. * self.deadline:.0f} ms: "
+                     f"{misses} missed ({skipped} skipped), latency p50 {np.nanpercentile(latencies, 50):.1f} ms "
+                     f"p99 {np.nanpercentile(latencies, 99):.1f} ms max {np.nanmax(latencies):.1f} ms, "
+                     f"{self.quantizer.late_taps} late taps")
+        return "\n".join(lines)
+
+
+#######################################################################################
+##################### MIDI REPLAY #####################################################
+#######################################################################################
+
+def midi_onsets(path: str):
+    '''
+    Output:
+        (1) sorted unique note onset times in seconds
+        (2) tempo of the file in bpm (120 when it has none)
+    '''
+    import magenta.music as mm
+
+    note_sequence = mm.midi_file_to_note_sequence(path)
+    onsets = np.unique(np.round([note.start_time for note in note_sequence.notes], 4))
+    bpm = note_sequence.tempos[0].qpm if note_sequence.tempos else 120.
+    return onsets, bpm
+
+
+def replay(engine: StreamingEngine, onsets: np.ndarray, session: int, jitter_ms: float = 0.):
+    '''
+    Taps every onset into engine at real-time speed (from another thread); taps are
+    timestamped on arrival like live input
+    '''
+    rng = np.random.default_rng(session)
+    for onset in onsets:
+        wait = onset + rng.normal(0., jitter_ms / 1000.) - engine.now()
+        if wait > 0:
+            time.sleep(wait)
+        engine.tap(session)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replay", required=True, help="MIDI file whose note onsets are replayed as taps")
+    parser.add_argument("--sessions", type=int, default=1)
+    parser.add_argument("--jitter-ms", type=float, default=5., help="timing jitter of the replayed taps per session")
+    parser.add_argument("--bpm", type=float, default=None)
+    parser.add_argument("--deadline-ms", type=float, default=60.)
+    parser.add_argument("--bars", type=int, default=None, help="bars to play, the length of the file by default")
+    parser.add_argument("--context-bars", type=int, default=1)
+    parser.add_argument("--output", default="realtime_groove.mid", help="drums played for session 0")
+    args = parser.parse_args()
+
+    onsets, file_bpm = midi_onsets(args.replay)
+    bpm = args.bpm or file_bpm
+    if args.bpm:
+        # Replay the file at the requested tempo
+        onsets = onsets * file_bpm / bpm
+    bar_secs = 60. / bpm * 4
+    n_bars = args.bars or (int(np.ceil(onsets[-1] / bar_secs)) + 1 if len(onsets) else 1)
+
+    Code.restore_latest_checkpoint()
+    played = []
+    engine = StreamingEngine(Code.transformer, args.sessions, bpm, args.deadline_ms, args.context_bars,
+                             on_bar=lambda bar, tokens, events: played.append(tokens[0]))
+    engine.warm_up()
+    print(f"Replaying {len(onsets)} onsets of {args.replay} to {args.sessions} sessions at {bpm:.1f} bpm, "
+          f"{n_bars} bars")
+
+    engine.start()
+    threads = [threading.Thread(target=replay, args=(engine, onsets, session, args.jitter_ms), daemon=True)
+               for session in range(args.sessions)]
+    for thread in threads:
+        thread.start()
+    engine.run(n_bars)
+    print(engine.report())
+
+    with open(args.output, "wb") as f:
+        f.write(gt.hits_to_midi_bytes(gt.tokens_to_hits(np.concatenate(played)), bpm=bpm))
+    print(f"Generated midi file: {args.output}")
@@ -0,0 +1,399 @@
+"""
+Local asyncio inference server for groove generation with dynamic batching.
+
+Concurrent requests are collected into micro-batches (up to --max-batch-size
+requests, or whatever arrived within --max-wait-ms of the first one) and run
+through Code.transformer with one batched greedy decode.
+
+Usage:
+    python serve.py serve [--host 127.0.0.1] [--port 8080] [--unix /tmp/groove.sock]
+                          [--cache-dir ./generation_cache]
+    python serve.py load-test [--concurrency 32] [--requests 2000] [--unix ...]
+
+Endpoints:
+    POST /generate   JSON body with one of
+                         "tokens": [int, ...]        drum tokens, one per step
+                         "hits":   [[0/1 x 9], ...]  hit vectors, one per step
+                         "taps":   [0/1, ...]        tap pattern, one per step
+                     and optionally "format": "tokens" (default) or "midi", "bpm"
+                     (0 < bpm <= 400, default 120).
+                     Returns {"tokens": [...]} or the bytes of a .mid file.
+    GET  /metrics    queue depth, batch-size histogram and p50/p99 latency, and the
+                     hit/miss counters of the generation cache
+
+With --cache-dir, responses are cached per input groove, model (checkpoint and
+configuration) and output format (PythonFiles/generation_cache.py), so repeated
+grooves skip the model.
+"""
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import random
+import time
+
+import numpy as np
+
+from PythonFiles import groove_tokens as gt
+from PythonFiles.generation_cache import GenerationCache, cache_key
+
+MAX_INPUT_STEPS = 256
+MAX_BPM = 400.
+OUTPUT_FORMATS = ("tokens", "midi")
+
+
+class ServerMetrics:
+    '''
+    Counters exported on /metrics. Latencies are kept for the last `window` requests.
+    '''
+    def __init__(self, window: int = 10000):
+        self.requests = 0
+        self.errors = 0
+        self.batch_sizes = collections.Counter()
+        self.latencies = collections.deque(maxlen=window)
+
+    def snapshot(self, queue_depth: int):
+        latencies = np.array(self.latencies) * 1000. if self.latencies else np.zeros(1)
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "queue_depth": queue_depth,
+            "batch_size_histogram": {str(k): v for k, v in sorted(self.batch_sizes.items())},
+            "latency_ms": {"p50": float(np.percentile(latencies, 50)),
+                           "p99": float(np.percentile(latencies, 99))},
+        }
+
+
+class DynamicBatcher:
+    '''
+    Collects single requests into micro-batches and runs them through run_batch in a
+    worker thread, so the event loop keeps accepting requests while the model runs.
+
+    Inputs:
+        (1) run_batch: callable taking a (batch_size, steps) int64 array and returning
+                a (batch_size, steps) array of generated tokens
+        (2) max_batch_size: largest batch handed to run_batch
+        (3) max_wait_ms: how long the first request of a batch waits for company
+    '''
+    def __init__(self, run_batch, max_batch_size: int = 32, max_wait_ms: float = 5.0):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.metrics = ServerMetrics()
+        self.queue = asyncio.Queue()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, tokens: np.ndarray) -> np.ndarray:
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((tokens, future))
+        return await future
+
+    async def _next_batch(self):
+        loop = asyncio.get_event_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self._next_batch()
+            self.metrics.batch_sizes[len(batch)] += 1
+
+            # Right-pad with token 0, which the model masks as padding
+            lengths = [len(tokens) for tokens, _ in batch]
+            inputs = np.zeros((len(batch), max(lengths)), dtype=np.int64)
+            for i, (tokens, _) in enumerate(batch):
+                inputs[i, :lengths[i]] = tokens
+
+            try:
+                outputs = await loop.run_in_executor(self._executor, self.run_batch, inputs)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for i, (_, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result(np.asarray(outputs[i, :lengths[i]]))
+
+
+class TransformerRunner:
+    '''
+    Batched greedy generation with the Transformer in Code.py, restored from the
+    latest checkpoint in Code.checkpoint_path.
+    '''
+    def __init__(self):
+        # Imported here so the load-test client doesn't pay for TensorFlow
+        import Code
+        self._code = Code
+        self.checkpoint = Code.restore_latest_checkpoint()
+        self.model_id = self._model_id()
+
+    def _model_id(self) -> str:
+        '''
+        Id of the served model for the generation cache: the resolved checkpoint
+        path, the modification time of its index (a run that retrains into the same
+        directory can write a checkpoint of the same name) and a hash of the model
+        configuration (GROOVE_HPARAMS, GROOVE_VOCAB, GROOVE_ATTENTION)
+        '''
+        code = self._code
+        config = {"num_layers": code.num_layers, "d_model": code.d_model, "num_heads": code.num_heads,
+                  "dff": code.dff, "input_vocab_size": code.input_vocab_size,
+                  "target_vocab_size": code.target_vocab_size, "attention": code.attention,
+                  "hparams": code.HPARAMS,
+                  "vocab": None if code.vocab is None else hashlib.sha256(code.vocab.to_token.tobytes()).hexdigest()}
+        checkpoint = None
+        if self.checkpoint:
+            checkpoint = os.path.abspath(self.checkpoint)
+            checkpoint += "@{:.0f}".format(os.path.getmtime(checkpoint + ".index"))
+        digest = hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+        return "{}#{}".format(checkpoint, digest[:16])
+
+    def __call__(self, inputs: np.ndarray) -> np.ndarray:
+        code = self._code
+        ids = code.greedy_decode(code.transformer, code.encode_tokens(inputs)).numpy()
+        return code.decode_tokens(ids)
+
+
+def parse_groove(request: dict) -> np.ndarray:
+    '''
+    Reads the input groove of a /generate request as drum tokens.
+    Raises ValueError on malformed input (TypeError for values of the wrong type).
+    '''
+    if not isinstance(request, dict):
+        raise ValueError("expected a JSON object")
+    if "tokens" in request:
+        tokens = np.asarray(request["tokens"], dtype=np.int64)
+    elif "hits" in request:
+        tokens = gt.hits_to_tokens(np.asarray(request["hits"], dtype=np.float32))
+    elif "taps" in request:
+        tokens = gt.taps_to_tokens(np.asarray(request["taps"], dtype=np.float32))
+    else:
+        raise ValueError('expected one of "tokens", "hits" or "taps"')
+
+    if tokens.ndim != 1 or not 0 < len(tokens) <= MAX_INPUT_STEPS:
+        raise ValueError(f"expected between 1 and {MAX_INPUT_STEPS} steps")
+    if tokens.min() < 0 or tokens.max() >= gt.NUM_TOKENS:
+        raise ValueError(f"tokens must be in [0, {gt.NUM_TOKENS})")
+    return tokens
+
+
+def parse_output(request: dict):
+    '''
+    Reads the output format of a /generate request, and the tempo of MIDI output
+    (None for tokens). Raises ValueError on unknown formats and invalid tempos.
+    '''
+    output_format = request.get("format", "tokens")
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'"format" must be one of {", ".join(OUTPUT_FORMATS)}')
+    if output_format != "midi":
+        return output_format, None
+    try:
+        bpm = float(request.get("bpm", 120.))
+    except (TypeError, ValueError):
+        raise ValueError('"bpm" must be a number')
+    if not 0 < bpm <= MAX_BPM:
+        raise ValueError(f'"bpm" must be in (0, {MAX_BPM:g}]')
+    return output_format, bpm
+
+
+class GrooveServer:
+    '''
+    Inputs:
+        (1) batcher: DynamicBatcher running the model
+        (2) cache (opt): GenerationCache for the responses. Its disk reads, writes
+                and evictions run in the default executor, off the event loop
+        (3) model_id (opt): id of the served model in the cache keys, see
+                TransformerRunner._model_id
+    '''
+    def __init__(self, batcher: DynamicBatcher, cache: GenerationCache = None, model_id: str = None):
+        self.batcher = batcher
+        self.cache = cache
+        self.model_id = model_id
+
+    async def _in_executor(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+    async def generate(self, body: bytes):
+        start = time.perf_counter()
+        metrics = self.batcher.metrics
+        metrics.requests += 1
+        try:
+            request = json.loads(body or b"{}")
+            tokens = parse_groove(request)
+            output_format, bpm = parse_output(request)
+        except (TypeError, ValueError) as e:
+            metrics.errors += 1
+            return 400, "application/json", json.dumps({"error": str(e)}).encode()
+
+        # The server decodes greedily, so every response is cacheable
+        key = None if self.cache is None else cache_key(tokens, self.model_id, "greedy",
+                                                        format=output_format, bpm=bpm)
+        output = None if key is None else await self._in_executor(self.cache.get, key)
+        if output is None:
+            try:
+                generated = await self.batcher.submit(tokens)
+            except Exception as e:
+                metrics.errors += 1
+                return 500, "application/json", json.dumps({"error": repr(e)}).encode()
+            output = (gt.hits_to_midi_bytes(gt.tokens_to_hits(generated), bpm=bpm)
+                      if output_format == "midi" else generated)
+            if key is not None:
+                await self._in_executor(self.cache.put, key, output)
+        metrics.latencies.append(time.perf_counter() - start)
+
+        if isinstance(output, bytes):
+            return 200, "audio/midi", output
+        return 200, "application/json", json.dumps({"tokens": output.tolist()}).encode()
+
+    async def route(self, method: str, path: str, body: bytes):
+        if method == "POST" and path == "/generate":
+            return await self.generate(body)
+        if method == "GET" and path == "/metrics":
+            snapshot = self.batcher.metrics.snapshot(self.batcher.queue.qsize())
+            if self.cache is not None:
+                snapshot["cache"] = await self._in_executor(self.cache.stats)
+            return 200, "application/json", json.dumps(snapshot).encode()
+        return 404, "application/json", b'{"error": "not found"}'
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Minimal HTTP/1.1 with keep-alive, enough for local clients and load tests
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, value = line.decode("latin-1").split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, content_type, payload = await self.route(method, path, body)
+                writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                             f"Content-Type: {content_type}\r\n"
+                             f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(args: argparse.Namespace):
+    runner = TransformerRunner()
+    batcher = DynamicBatcher(runner, args.max_batch_size, args.max_wait_ms)
+    cache = None
+    if args.cache_dir:
+        cache = GenerationCache(args.cache_dir, max_memory_bytes=int(args.cache_memory_mb * 2 ** 20),
+                                max_disk_bytes=int(args.cache_disk_mb * 2 ** 20),
+                                max_age_secs=args.cache_max_age_hours * 3600. if args.cache_max_age_hours else None)
+    server = GrooveServer(batcher, cache, runner.model_id)
+    if args.unix:
+        listener = await asyncio.start_unix_server(server.handle, path=args.unix)
+        print(f"Serving on unix socket {args.unix}")
+    else:
+        listener = await asyncio.start_server(server.handle, args.host, args.port)
+        print(f"Serving on http://{args.host}:{args.port}")
+    async with listener:
+        await asyncio.gather(listener.serve_forever(), batcher.run())
+
+
+#######################################################################################
+##################### LOAD-TEST CLIENT ################################################
+#######################################################################################
+
+async def _open(args: argparse.Namespace):
+    if args.unix:
+        return await asyncio.open_unix_connection(args.unix)
+    return await asyncio.open_connection(args.host, args.port)
+
+
+async def _request(reader, writer, method: str, path: str, body: bytes = b""):
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":")[1])
+    return status, await reader.readexactly(length)
+
+
+async def load_test(args: argparse.Namespace):
+    '''
+    Sends args.requests random 2-bar grooves over args.concurrency keep-alive
+    connections and prints client-side throughput and latency next to the
+    server's own /metrics.
+    '''
+    latencies = []
+    remaining = [args.requests]
+
+    async def worker():
+        reader, writer = await _open(args)
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            taps = [int(random.random() < 0.4) for _ in range(2 * gt.STEPS_PER_BAR)]
+            body = json.dumps({"taps": taps, "format": args.format}).encode()
+            start = time.perf_counter()
+            status, _ = await _request(reader, writer, "POST", "/generate", body)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                print(f"request failed with status {status}")
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies_ms = np.array(latencies) * 1000.
+    print(f"{len(latencies)} requests in {elapsed:.2f} secs ({len(latencies) / elapsed:.1f} req/s)")
+    print(f"client latency p50 {np.percentile(latencies_ms, 50):.1f} ms, "
+          f"p99 {np.percentile(latencies_ms, 99):.1f} ms")
+
+    reader, writer = await _open(args)
+    _, body = await _request(reader, writer, "GET", "/metrics")
+    writer.close()
+    print("server metrics:", json.dumps(json.loads(body), indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["serve", "load-test"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--unix", default=None, help="serve on / connect to this unix socket instead of TCP")
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--format", choices=["tokens", "midi"], default="tokens")
+    parser.add_argument("--cache-dir", default=None, help="cache generated grooves in this directory")
+    parser.add_argument("--cache-memory-mb", type=float, default=64)
+    parser.add_argument("--cache-disk-mb", type=float, default=1024)
+    parser.add_argument("--cache-max-age-hours", type=float, default=None)
+    args = parser.parse_args()
+
+    asyncio.run(serve(args) if args.command == "serve" else load_test(args))
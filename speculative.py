@@ -0,0 +1,262 @@
+"""
+Speculative decoding: a small draft Transformer proposes k steps, the main Transformer
+checks all of them in one cached forward pass.
+
+Every round the draft model samples k tokens autoregressively (cheap), then the main
+model scores the k proposals plus one more position at once. Proposal i is accepted
+with probability min(1, p(x) / q(x)) (p: main model, q: draft); at the first rejection
+a token is drawn from max(0, p - q) instead, and when all k are accepted one more
+token is drawn from p. The generated sequences are distributed exactly as when
+sampling from the main model alone. At temperature 0 both models are argmax, so the
+output is Code.greedy_decode's.
+
+Within a batch every sequence advances by the shortest accepted prefix of the
+batch, which keeps the key/value caches aligned.
+
+The draft is typically a student from distill.py (same vocabulary). Model specs are
+LAYERSxD_MODELxHEADSxDFF as in distill.py.
+
+Usage:
+    python speculative.py --draft 1x128x4x256 --draft-checkpoint ./checkpoints/students/1x128x4x256 \\
+        [--target 2x128x8x512 --target-checkpoint ./checkpoints/train] [--k 4] [--temperature 0]
+"""
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import Code
+from distill import load_teacher
+
+
+#######################################################################################
+##################### DECODING ########################################################
+#######################################################################################
+
+def _probs(logits: np.ndarray, temperature: float) -> np.ndarray:
+    '''
+    Sampling distribution over the last axis: softmax at temperature, or one-hot
+    argmax at temperature 0
+    '''
+    if temperature == 0:
+        return np.eye(logits.shape[-1])[np.argmax(logits, axis=-1)]
+    logits = logits.astype(np.float64) / temperature
+    exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+def _sample(probs: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    '''
+    One index per row of (batch_size, vocab_size) probs
+    '''
+    cdf = np.cumsum(probs, axis=-1)
+    u = rng.random(len(probs))[:, np.newaxis] * cdf[:, -1:]
+    return np.minimum((cdf <= u).sum(axis=-1), probs.shape[-1] - 1)
+
+
+class CachedModel(object):
+    '''
+    A Transformer with an encoded input batch and the decoder's key/value cache.
+    feed() runs the decoder on the committed tokens the cache has not seen yet plus
+    any extra ones, and rollback() drops cached positions that were not committed.
+    '''
+    def __init__(self, transformer, inp: tf.Tensor):
+        self.transformer = transformer
+        self.padding_mask = Code.create_padding_mask(inp)
+        enc_output = transformer.encoder(inp, False, self.padding_mask)
+        self.cache = transformer.decoder.init_cache(enc_output)
+        self.calls = 0
+
+    def length(self) -> int:
+        return int(self.cache['tokens'].shape[1])
+
+    def feed(self, committed: np.ndarray, extra: np.ndarray = None) -> np.ndarray:
+        '''
+        Output:
+            (1) logits (batch_size, new_len, vocab_size) for the fed positions
+        '''
+        tokens = committed[:, self.length():]
+        if extra is not None:
+            tokens = np.concatenate([tokens, extra], axis=1)
+        dec_output, self.cache = self.transformer.decoder.call_cached(
+            tf.constant(tokens, dtype=tf.int64), self.cache, self.padding_mask)
+        self.calls += 1
+        return self.transformer.final_layer(dec_output).numpy()
+
+    def rollback(self, length: int):
+        if length >= self.length():
+            return
+        layers = [dict(layer, v=layer['v'][:, :, :length], k=layer['k'][:, :, :length])
+                  for layer in self.cache['layers']]
+        self.cache = {'tokens': self.cache['tokens'][:, :length], 'layers': layers}
+
+
+def autoregressive_decode(transformer, inp, max_len: int = None, temperature: float = 0.,
+                          rng: np.random.Generator = None) -> np.ndarray:
+    '''
+    Reference decoding with the main model only: one cached decoder call per step,
+    seeded with the first input step like Code.greedy_decode
+    '''
+    rng = rng or np.random.default_rng()
+    inp = tf.convert_to_tensor(inp, dtype=tf.int64)
+    max_len = max_len or int(inp.shape[1])
+    model = CachedModel(transformer, inp)
+    committed = inp[:, :1].numpy()
+    while committed.shape[1] < max_len:
+        probs = _probs(model.feed(committed)[:, -1], temperature)
+        committed = np.concatenate([committed, _sample(probs, rng)[:, np.newaxis]], axis=1)
+    return committed
+
+
+class SpeculativeStats(object):
+    def __init__(self):
+        self.rounds = 0
+        self.proposed = 0
+        self.accepted = 0       # per sequence, before taking the batch minimum
+        self.generated = 0      # tokens appended per sequence
+        self.target_calls = 0
+        self.draft_calls = 0
+
+    def acceptance_rate(self) -> float:
+        return self.accepted / max(self.proposed, 1)
+
+    def tokens_per_target_call(self) -> float:
+        return self.generated / max(self.target_calls, 1)
+
+
+def speculative_decode(target, draft, inp, k: int = 4, max_len: int = None, temperature: float = 0.,
+                       rng: np.random.Generator = None, stats: SpeculativeStats = None) -> np.ndarray:
+    '''
+    Inputs:
+        (1) target, draft: Code.Transformer models over the same vocabulary
+        (2) inp: (batch_size, inp_seq_len) input ids
+        (3) k: draft tokens proposed per round
+        (4) max_len (opt): output length, seed included, inp_seq_len by default
+        (5) temperature (opt): 0 for greedy
+        (6) stats (opt): SpeculativeStats updated in place
+
+    Output:
+        (1) (batch_size, max_len) int64 ids
+    '''
+    rng = rng or np.random.default_rng()
+    inp = tf.convert_to_tensor(inp, dtype=tf.int64)
+    batch_size = int(inp.shape[0])
+    max_len = max_len or int(inp.shape[1])
+    target_model, draft_model = CachedModel(target, inp), CachedModel(draft, inp)
+    committed = inp[:, :1].numpy()
+    rows = np.arange(batch_size)
+
+    while committed.shape[1] < max_len:
+        n_draft = min(k, max_len - committed.shape[1] - 1)
+        start = committed.shape[1]
+
+        # 1. Draft proposals d_1..d_n and their distributions q_1..q_n
+        proposals, q = [], []
+        extra = None
+        for _ in range(n_draft):
+            q_i = _probs(draft_model.feed(committed, extra)[:, -1], temperature)
+            d_i = _sample(q_i, rng)
+            proposals.append(d_i)
+            q.append(q_i)
+            extra = d_i[:, np.newaxis]
+        proposals = np.stack(proposals, axis=1) if proposals else np.zeros((batch_size, 0), dtype=np.int64)
+
+        # 2. One target pass over all of them: p_1..p_{n+1}
+        p = _probs(target_model.feed(committed, proposals)[:, -(n_draft + 1):], temperature)
+
+        # 3. Accept the longest prefix, correct the first rejected position
+        if n_draft:
+            q = np.stack(q, axis=1)
+            cols = np.arange(n_draft)
+            p_d = p[rows[:, np.newaxis], cols, proposals]
+            q_d = q[rows[:, np.newaxis], cols, proposals]
+            accepted = rng.random((batch_size, n_draft)) * q_d < p_d
+            n_accepted = np.where(accepted.all(axis=1), n_draft, np.argmin(accepted, axis=1))
+        else:
+            n_accepted = np.zeros(batch_size, dtype=np.int64)
+        n = int(n_accepted.min())
+
+        if n == n_draft:
+            last = _sample(p[:, n], rng)
+        else:
+            residual = np.maximum(p[:, n] - q[:, n], 0.)
+            # p == q is never rejected; the fallback only guards rounding
+            empty = residual.sum(axis=-1, keepdims=True) <= 0
+            residual = np.where(empty, p[:, n], residual)
+            # Sequences that accepted position n keep the draft token there
+            last = np.where(n_accepted > n, proposals[:, n], _sample(residual, rng))
+
+        committed = np.concatenate([committed, proposals[:, :n], last[:, np.newaxis]], axis=1)
+        target_model.rollback(start + n)
+        draft_model.rollback(start + n)
+
+        if stats is not None:
+            stats.rounds += 1
+            stats.proposed += batch_size * n_draft
+            stats.accepted += int(n_accepted.sum())
+            stats.generated += batch_size * (n + 1)
+
+    if stats is not None:
+        stats.target_calls += target_model.calls
+        stats.draft_calls += draft_model.calls
+    return committed[:, :max_len]
+
+
+#######################################################################################
+##################### REPORT ##########################################################
+#######################################################################################
+
+def benchmark(target, draft, batches, k: int, temperature: float, seed: int):
+    '''
+    Wall time of autoregressive vs speculative decoding over the same batches
+    '''
+    def timed(fn):
+        fn(batches[0])
+        start = time.time()
+        outputs = [fn(inp) for inp in batches]
+        return outputs, time.time() - start
+
+    rng = np.random.default_rng(seed)
+    baseline, baseline_secs = timed(lambda inp: autoregressive_decode(target, inp, temperature=temperature, rng=rng))
+    stats = SpeculativeStats()
+    speculative, speculative_secs = timed(
+        lambda inp: speculative_decode(target, draft, inp, k, temperature=temperature, rng=rng, stats=stats))
+
+    tokens = sum(inp.shape[0] * (inp.shape[1] - 1) for inp in batches)
+    print(f"k {k} temperature {temperature} batches {len(batches)} tokens {tokens}")
+    print(f"acceptance rate {stats.acceptance_rate():.3f}  "
+          f"tokens per target call {stats.tokens_per_target_call():.2f}  "
+          f"draft calls {stats.draft_calls}  target calls {stats.target_calls}")
+    print(f"autoregressive {1000. * baseline_secs / len(batches):.2f} ms/batch  "
+          f"speculative {1000. * speculative_secs / len(batches):.2f} ms/batch  "
+          f"speedup {baseline_secs / speculative_secs:.2f}x")
+    if temperature == 0:
+        matches = all(np.array_equal(b, s) for b, s in zip(baseline, speculative))
+        print(f"identical to greedy decoding: {matches}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--draft", required=True)
+    parser.add_argument("--draft-checkpoint", required=True)
+    parser.add_argument("--target", default=None, help="spec of the main model, Code.transformer by default")
+    parser.add_argument("--target-checkpoint", default=Code.checkpoint_path)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--temperature", type=float, default=0.)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--batches", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.target is None:
+        target = Code.transformer
+        assert Code.restore_latest_checkpoint(), f"no checkpoint in {Code.checkpoint_path}"
+    else:
+        target = load_teacher(args.target, args.target_checkpoint)
+    draft = load_teacher(args.draft, args.draft_checkpoint)
+
+    dataset = Code.initialize_dataset_as_iterator(Code.configs_add_closed_hh, args.batch_size, vocab=Code.vocab)
+    batches = [inp.numpy() for inp, *_ in dataset.take(args.batches)]
+    with tf.device('/CPU:0'):
+        benchmark(target, draft, batches, args.k, args.temperature, args.seed)
@@ -0,0 +1,105 @@
+"""
+Streaming long-form groove generation, one bar at a time.
+
+The Transformer is trained on 2-bar windows, so a long performance is generated
+with a sliding window: each new bar is decoded against the encoder output of the
+last `context_bars` input bars plus the new one, after the last `context_bars`
+generated bars have been fed to the decoder as a prefix. The prefix is carried
+over from the previous window and filled into the decoder cache in a single
+parallel pass rather than decoded again step by step, and the new bar is decoded
+incrementally on the cache. Every bar therefore costs the same, and the total
+cost grows linearly with the number of bars.
+
+Usage:
+    python streaming.py [--bars 64] [--input taps.npy] [--output long_groove.mid]
+"""
+import argparse
+import collections
+import time
+from typing import Iterable, Iterator
+
+import numpy as np
+import tensorflow as tf
+
+import Code
+from PythonFiles import groove_tokens as gt
+
+
+def generate_stream(transformer, input_bars: Iterable[np.ndarray], context_bars: int = 1) -> Iterator[np.ndarray]:
+    '''
+    Generates drums bar by bar for a stream of input bars
+
+    Inputs:
+        (1) transformer: Code.Transformer with restored weights
+        (2) input_bars: iterable of (batch_size, STEPS_PER_BAR) drum tokens, e.g. tap
+                patterns from groove_tokens.taps_to_tokens. It is consumed lazily, so
+                it may be a live source
+        (3) context_bars (opt): bars of input and generated context kept in the
+                window. With the default of 1 a window spans the 2 bars the model
+                was trained on
+
+    Output:
+        (1) generator of (batch_size, STEPS_PER_BAR) generated drum tokens, one per
+                input bar, yielded as soon as the bar is decoded
+    '''
+    decoder = transformer.decoder
+    inputs = collections.deque(maxlen=context_bars + 1)
+    generated = collections.deque(maxlen=context_bars)
+
+    for bar in input_bars:
+        inputs.append(Code.encode_tokens(np.asarray(bar, dtype=np.int64)))
+        inp = tf.constant(np.concatenate(inputs, axis=1))
+        padding_mask = Code.create_padding_mask(inp)
+        cache = decoder.init_cache(transformer.encoder(inp, False, padding_mask))
+
+        if generated:
+            # Carried-over bars go through the decoder in one pass
+            bar_tokens = []
+            dec_output, cache = decoder.call_cached(tf.constant(np.concatenate(generated, axis=1)),
+                                                    cache, padding_mask)
+        else:
+            # The very first bar is seeded like Code.greedy_decode
+            bar_tokens = [inp[:, :1]]
+            dec_output, cache = decoder.call_cached(inp[:, :1], cache, padding_mask)
+
+        while len(bar_tokens) < gt.STEPS_PER_BAR:
+            next_token = tf.argmax(transformer.final_layer(dec_output[:, -1:, :]), axis=-1)
+            bar_tokens.append(next_token)
+            if len(bar_tokens) < gt.STEPS_PER_BAR:
+                dec_output, cache = decoder.call_cached(next_token, cache, padding_mask)
+
+        bar_ids = tf.concat(bar_tokens, axis=1).numpy()
+        generated.append(bar_ids)
+        yield Code.decode_tokens(bar_ids)
+
+
+def _random_tap_bars(n_bars: int, density: float = 0.4):
+    for _ in range(n_bars):
+        yield gt.taps_to_tokens(np.random.rand(1, gt.STEPS_PER_BAR) < density)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bars", type=int, default=64)
+    parser.add_argument("--input", default=None,
+                        help=".npy file with one tap flag per step; random taps when omitted")
+    parser.add_argument("--context-bars", type=int, default=1)
+    parser.add_argument("--output", default="long_groove.mid")
+    args = parser.parse_args()
+
+    Code.restore_latest_checkpoint()
+    if args.input:
+        taps = np.load(args.input).reshape(-1, gt.STEPS_PER_BAR)[:args.bars]
+        input_bars = (gt.taps_to_tokens(bar[np.newaxis]) for bar in taps)
+    else:
+        input_bars = _random_tap_bars(args.bars)
+
+    bars = []
+    start = time.time()
+    for i, bar in enumerate(generate_stream(Code.transformer, input_bars, args.context_bars)):
+        bars.append(bar[0])
+        print(f"bar {i + 1}: {1000 * (time.time() - start) / (i + 1):.1f} ms/bar on average")
+
+    with open(args.output, "wb") as f:
+        f.write(gt.hits_to_midi_bytes(gt.tokens_to_hits(np.concatenate(bars))))
+    print(f"Generated midi file: {args.output}")
@@ -0,0 +1,302 @@
+"""
+Parallel hyperparameter sweep over the Transformer in Code.py with successive halving.
+
+Every trial is a separate `python sweep.py trial` process, pinned to its own
+--threads-per-trial CPUs, which trains Code.transformer with the trial's
+hyperparameters (passed through GROOVE_HPARAMS) and reports validation loss after
+every epoch. All trials read one preprocessed copy of the dataset, converted once
+into <sweep dir>/dataset.npz, instead of converting the MIDI themselves.
+
+Successive halving: all trials train up to the first rung (--min-epochs); the best
+1/--eta by validation loss continue to the next rung (--eta times as many epochs)
+and the rest are stopped, until --max-epochs. A trial waiting for its rung to
+finish is paused and gives its CPUs to the next trial.
+
+Results of all trials go to <sweep dir>/results.tsv, best first.
+
+Usage:
+    python sweep.py run [--trials 32] [--threads-per-trial 4] [--min-epochs 1] [--max-epochs 9]
+                        [--eta 3] [--space space.json] [--sweep-dir ./sweeps/default]
+
+space.json maps hyperparameter names of Code.py to lists of values, e.g.
+    {"num_layers": [1, 2, 4], "d_model": [64, 128, 256], "dropout_rate": [0.1, 0.25]}
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+DEFAULT_SPACE = {
+    "num_layers": [1, 2, 4],
+    "d_model": [64, 128, 256],
+    "num_heads": [4, 8],
+    "dff": [256, 512, 1024],
+    "dropout_rate": [0.1, 0.25],
+}
+LINE_PREFIX = b"SWEEP "
+
+
+#######################################################################################
+##################### SHARED DATASET ##################################################
+#######################################################################################
+
+def prepare_dataset(path: str, batch_size: int = 64):
+    '''
+    Converts the training and validation splits once into token arrays
+    '''
+    import numpy as np
+    import Code
+
+    arrays = {}
+    for split, is_training in (("train", True), ("val", False)):
+        inps, tars = [], []
+        for inp, tar in Code.initialize_dataset_as_iterator(Code.configs_add_closed_hh, batch_size,
+                                                            is_training=is_training, vocab=Code.vocab):
+            inps.append(inp.numpy())
+            tars.append(tar.numpy())
+        arrays[f"{split}_inp"], arrays[f"{split}_tar"] = np.concatenate(inps), np.concatenate(tars)
+    np.savez(path + ".tmp.npz", **arrays)
+    os.replace(path + ".tmp.npz", path)
+
+
+def load_dataset(path: str, split: str, batch_size: int):
+    import numpy as np
+    import tensorflow as tf
+
+    with np.load(path) as f:
+        inp, tar = f[f"{split}_inp"], f[f"{split}_tar"]
+    dataset = tf.data.Dataset.from_tensor_slices((inp, tar))
+    if split == "train":
+        dataset = dataset.shuffle(buffer_size=10 * batch_size)
+    return dataset.batch(batch_size, drop_remainder=True).prefetch(tf.data.experimental.AUTOTUNE)
+
+
+#######################################################################################
+##################### TRIAL PROCESS ###################################################
+#######################################################################################
+
+def run_trial(args: argparse.Namespace):
+    '''
+    Trains for up to args.max_epochs and prints one result line per epoch. After
+    each rung epoch it waits on stdin: "continue" resumes, anything else stops.
+    '''
+    os.environ['GROOVE_HPARAMS'] = args.hparams
+    import Code
+
+    rungs = {int(e) for e in args.rungs.split(",")}
+    train_dataset = load_dataset(args.dataset, "train", args.batch_size)
+    val_dataset = load_dataset(args.dataset, "val", args.batch_size)
+
+    for epoch in range(1, args.max_epochs + 1):
+        start = time.time()
+        for metric in (Code.train_loss, Code.train_accuracy, Code.val_loss, Code.val_accuracy):
+            metric.reset_states()
+        for inp, tar in train_dataset:
+            Code.train_step(inp, tar)
+        for inp, tar in val_dataset:
+            Code.val_step(inp, tar)
+
+        result = {"epoch": epoch,
+                  "train_loss": float(Code.train_loss.result()),
+                  "val_loss": float(Code.val_loss.result()),
+                  "val_accuracy": float(Code.val_accuracy.result()),
+                  "epoch_secs": time.time() - start}
+        sys.stdout.buffer.write(LINE_PREFIX + json.dumps(result).encode() + b"\n")
+        sys.stdout.flush()
+        if epoch in rungs and epoch < args.max_epochs and sys.stdin.readline().strip() != "continue":
+            return
+
+
+#######################################################################################
+##################### SCHEDULER #######################################################
+#######################################################################################
+
+class Trial:
+    def __init__(self, trial_id: int, hparams: dict):
+        self.trial_id = trial_id
+        self.hparams = hparams
+        self.process = None
+        self.history = []
+        self.status = "pending"
+
+    @property
+    def val_loss(self) -> float:
+        return self.history[-1]["val_loss"] if self.history else float("inf")
+
+
+def sample_hparams(space: dict, n_trials: int, seed: int = 0):
+    '''
+    The full grid if it has at most n_trials points, n_trials random grid points otherwise.
+    Combinations where num_heads does not divide d_model are skipped.
+    '''
+    keys = sorted(space)
+    grid = [dict(zip(keys, values)) for values in itertools.product(*(space[k] for k in keys))]
+    grid = [h for h in grid if h.get("d_model", 128) % h.get("num_heads", 8) == 0]
+    if len(grid) <= n_trials:
+        return grid
+    return random.Random(seed).sample(grid, n_trials)
+
+
+def rung_epochs(min_epochs: int, max_epochs: int, eta: int):
+    rungs, epochs = [], min_epochs
+    while epochs < max_epochs:
+        rungs.append(epochs)
+        epochs *= eta
+    return rungs + [max_epochs]
+
+
+def _pin(pid: int, cpus):
+    # sched_setaffinity applies to one thread, so every thread of the trial is re-pinned
+    for tid in os.listdir(f"/proc/{pid}/task"):
+        try:
+            os.sched_setaffinity(int(tid), cpus)
+        except OSError:
+            pass
+
+
+class Sweep:
+    def __init__(self, args: argparse.Namespace, trials, rungs):
+        self.args = args
+        self.trials = trials
+        self.rungs = rungs
+        self.dataset = os.path.join(args.sweep_dir, "dataset.npz")
+
+        cpus = sorted(os.sched_getaffinity(0))
+        n_slots = max(1, len(cpus) // args.threads_per_trial)
+        self.slots = [cpus[slot * args.threads_per_trial:(slot + 1) * args.threads_per_trial] or cpus
+                      for slot in range(n_slots)]
+        # Created in run(): before Python 3.10 a queue binds to the event loop
+        # current at construction, which is not the one asyncio.run() starts
+        self.cpu_sets = None
+        print(f"{len(trials)} trials on {n_slots} slots of {args.threads_per_trial} CPUs, rungs at epochs {rungs}")
+
+    async def _start(self, trial: Trial, cpus):
+        args = self.args
+        threads = str(len(cpus))
+        env = dict(os.environ, TF_NUM_INTRAOP_THREADS=threads, TF_NUM_INTEROP_THREADS="1",
+                   OMP_NUM_THREADS=threads, TF_CPP_MIN_LOG_LEVEL="2")
+        log = open(os.path.join(args.sweep_dir, f"trial_{trial.trial_id:03d}.log"), "wb")
+        trial.process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), "trial",
+            "--hparams", json.dumps(trial.hparams), "--dataset", self.dataset,
+            "--rungs", ",".join(map(str, self.rungs)), "--max-epochs", str(args.max_epochs),
+            "--batch-size", str(args.batch_size),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=log, env=env,
+            preexec_fn=lambda: os.sched_setaffinity(0, cpus))
+        log.close()
+
+    async def advance(self, trial: Trial, epochs: int):
+        '''
+        Runs a trial on a free CPU slot until it has reported `epochs` epochs
+        '''
+        cpus = await self.cpu_sets.get()
+        try:
+            if trial.process is None:
+                await self._start(trial, cpus)
+            else:
+                _pin(trial.process.pid, cpus)
+                trial.process.stdin.write(b"continue\n")
+                await trial.process.stdin.drain()
+            trial.status = "running"
+            while not trial.history or trial.history[-1]["epoch"] < epochs:
+                line = await trial.process.stdout.readline()
+                if not line:
+                    trial.status = "failed"
+                    return
+                if line.startswith(LINE_PREFIX):
+                    trial.history.append(json.loads(line[len(LINE_PREFIX):]))
+            trial.status = "paused"
+        finally:
+            self.cpu_sets.put_nowait(cpus)
+
+    async def stop(self, trial: Trial, status: str):
+        trial.status = status
+        if trial.process is not None and trial.process.returncode is None:
+            trial.process.stdin.close()
+            await trial.process.wait()
+
+    async def run(self):
+        self.cpu_sets = asyncio.Queue()
+        for cpus in self.slots:
+            self.cpu_sets.put_nowait(cpus)
+        alive = self.trials
+        for rung, epochs in enumerate(self.rungs):
+            start = time.time()
+            await asyncio.gather(*(self.advance(trial, epochs) for trial in alive))
+            alive = sorted((t for t in alive if t.status != "failed"), key=lambda t: t.val_loss)
+            print(f"rung {rung} ({epochs} epochs): {len(alive)} trials in {time.time() - start:.1f} secs, "
+                  f"best val_loss {alive[0].val_loss if alive else float('nan'):.4f}")
+            if rung == len(self.rungs) - 1:
+                break
+            keep = max(1, len(alive) // self.args.eta)
+            await asyncio.gather(*(self.stop(t, f"stopped at {epochs} epochs") for t in alive[keep:]))
+            alive = alive[:keep]
+        await asyncio.gather(*(self.stop(t, "finished") for t in alive))
+
+
+def write_results(path: str, trials, space_keys):
+    columns = ["trial"] + list(space_keys) + ["epochs", "val_loss", "val_accuracy", "epoch_secs", "status"]
+    rows = []
+    for trial in sorted(trials, key=lambda t: t.val_loss):
+        last = trial.history[-1] if trial.history else {}
+        rows.append([trial.trial_id] + [trial.hparams.get(k) for k in space_keys] +
+                    [last.get("epoch", 0), "{:.4f}".format(trial.val_loss), "{:.4f}".format(last.get("val_accuracy", 0.)),
+                     "{:.1f}".format(sum(h["epoch_secs"] for h in trial.history) / max(1, len(trial.history))),
+                     trial.status])
+    with open(path, "w") as f:
+        for row in [columns] + rows:
+            f.write("\t".join(map(str, row)) + "\n")
+    with open(path) as f:
+        print(f.read())
+
+
+def run_sweep(args: argparse.Namespace):
+    os.makedirs(args.sweep_dir, exist_ok=True)
+    space = DEFAULT_SPACE
+    if args.space:
+        with open(args.space) as f:
+            space = json.load(f)
+
+    dataset = os.path.join(args.sweep_dir, "dataset.npz")
+    if not os.path.exists(dataset):
+        # In a child process, so the scheduler itself never loads TensorFlow
+        start = time.time()
+        subprocess.run([sys.executable, os.path.abspath(__file__), "prepare", "--dataset", dataset,
+                        "--batch-size", str(args.batch_size)], check=True)
+        print(f"Prepared shared dataset {dataset} in {time.time() - start:.1f} secs")
+
+    trials = [Trial(i, hparams) for i, hparams in enumerate(sample_hparams(space, args.trials, args.seed))]
+    sweep = Sweep(args, trials, rung_epochs(args.min_epochs, args.max_epochs, args.eta))
+    asyncio.run(sweep.run())
+    write_results(os.path.join(args.sweep_dir, "results.tsv"), trials, sorted(space))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["run", "prepare", "trial"])
+    parser.add_argument("--sweep-dir", default="./sweeps/default")
+    parser.add_argument("--space", default=None)
+    parser.add_argument("--trials", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--threads-per-trial", type=int, default=4)
+    parser.add_argument("--min-epochs", type=int, default=1)
+    parser.add_argument("--max-epochs", type=int, default=9)
+    parser.add_argument("--eta", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=64)
+    # Used by the child processes
+    parser.add_argument("--dataset", help=argparse.SUPPRESS)
+    parser.add_argument("--hparams", help=argparse.SUPPRESS)
+    parser.add_argument("--rungs", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run_sweep(args)
+    elif args.command == "prepare":
+        prepare_dataset(args.dataset, args.batch_size)
+    else:
+        run_trial(args)